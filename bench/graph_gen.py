@@ -0,0 +1,120 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import random
+
+'''
+  ' Synthetic social-graph generators for the benchmark suite.
+	'
+	' Every generator is deterministic for a given seed, and returns a
+	' (names, edges) tuple, where names is a list of unique node names and
+	' edges is a list of (i, j) index pairs into names with i != j and no
+	' duplicate undirected edges.
+'''
+
+
+def node_names(n):
+	return ['n' + str(i) for i in range(n)]
+
+
+def _add_edge(edges, seen, i, j):
+	if i == j:
+		return False
+	key = (min(i, j), max(i, j))
+	if key in seen:
+		return False
+	seen.add(key)
+	edges.append((i, j))
+	return True
+
+
+def erdos_renyi(n, avg_degree=4, seed=0):
+	'''
+	  ' G(n, m) random graph with m = n * avg_degree / 2 edges chosen
+		' uniformly among all node pairs.
+	'''
+	rng = random.Random(seed)
+	max_edges = n * (n - 1) // 2
+	m = min(int(n * avg_degree / 2), max_edges)
+	edges = []
+	seen = set()
+	while len(edges) < m:
+		_add_edge(edges, seen, rng.randrange(n), rng.randrange(n))
+	return node_names(n), edges
+
+
+def barabasi_albert(n, m=2, seed=0):
+	'''
+	  ' Preferential-attachment graph: every new node connects to m
+		' existing nodes chosen with probability proportional to degree.
+	'''
+	rng = random.Random(seed)
+	edges = []
+	seen = set()
+	targets = list(range(min(m, n)))
+	repeated = [] # every node appears here once per incident edge
+	for source in range(len(targets), n):
+		for target in set(targets):
+			if _add_edge(edges, seen, source, target):
+				repeated.append(source)
+				repeated.append(target)
+
+		chosen = set()
+		while len(chosen) < min(m, source + 1):
+			chosen.add(rng.choice(repeated))
+		targets = list(chosen)
+	return node_names(n), edges
+
+
+def small_world(n, k=4, beta=0.1, seed=0):
+	'''
+	  ' Watts-Strogatz small-world graph: a ring lattice where every node
+		' connects to its k nearest neighbours, with each edge rewired to a
+		' random endpoint with probability beta.
+	'''
+	rng = random.Random(seed)
+	edges = []
+	seen = set()
+	for i in range(n):
+		for offset in range(1, k // 2 + 1):
+			j = (i + offset) % n
+			if rng.random() < beta:
+				for attempt in range(10):
+					if _add_edge(edges, seen, i, rng.randrange(n)):
+						break
+			else:
+				_add_edge(edges, seen, i, j)
+	return node_names(n), edges
+
+
+GENERATORS = {
+	'er':erdos_renyi,
+	'ba':barabasi_albert,
+	'ws':small_world
+}
+
+
+def generate(model, n, seed=0):
+	'''
+	  ' Generates a graph using one of the models in GENERATORS with its
+		' default density parameters.
+	'''
+	return GENERATORS[model](n, seed=seed)
@@ -0,0 +1,328 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+'''
+  ' Reproducible benchmark suite.
+	'
+	' Usage (from anywhere):
+	'
+	'    python bench/run_bench.py [-config social-config.json]
+	'        [-models er,ba,ws] [-sizes 100,1000] [-seed 0]
+	'        [-layout-progs fr,sfdp,circo] [-layout-sizes 1000,10000]
+	'        [-output bench/results.json] [-baseline bench/baseline.json]
+	'        [-save-baseline] [-threshold 0.25]
+	'
+	' The benchmark creates its own tables with a throwaway table_prefix
+	' in the configured database and drops them when it is done, so it is
+	' safe to point at a scratch PostgreSQL instance that also holds real
+	' data - but a dedicated local instance gives the most stable numbers.
+	' With `-backend sqlite` it runs against a temporary embedded database
+	' instead and needs no server at all.
+	'
+	' Layout programs are also compared directly on the generated graphs,
+	' without the database: the built-in `fr` engine (including the nop2
+	' pass that routes edges between its positions) against graphviz.
+	'
+	' Results are written as JSON. If a baseline file exists, the median
+	' of every measurement is compared against it and the script exits
+	' with status 1 if anything got slower by more than the threshold.
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import networkx as nx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from social import configurer, database_io
+from social_db import database_cursor
+from social_renderer import renderer
+import social_layout
+from social_ui import none_ui
+from graph_gen import generate, GENERATORS
+
+
+class bench_ui(none_ui):
+	'''
+	  ' Silent UI which agrees to every prompt, so that the throwaway
+		' tables get created without asking.
+	'''
+	def prompt_yn(self, prompt_text, default_resp=False):
+		return True
+
+
+
+def summarize(samples):
+	samples = sorted(samples)
+	return {
+		'n':len(samples),
+		'median':statistics.median(samples),
+		'mean':statistics.mean(samples),
+		'min':samples[0],
+		'max':samples[-1]
+	}
+
+
+def timed(samples, func, *args):
+	start = time.perf_counter()
+	ret = func(*args)
+	samples.append(time.perf_counter() - start)
+	return ret
+
+
+def drop_bench_tables(db_io):
+	with database_cursor(db_io.database) as cur:
+		for table in db_io.schema:
+			cur.execute('DROP TABLE IF EXISTS ' + db_io.database.tablify(table['name']) + ';')
+	db_io.database.commit()
+
+
+def bench_graph(db_io, rend, model, size, seed, args, results):
+	prefix = model + '-' + str(size) + '/'
+	names, edges = generate(model, size, seed=seed)
+	rng = random.Random(seed)
+
+	db_io.open_file_by_name('bench-' + model + '-' + str(size) + '-' + str(seed))
+
+	samples = []
+	for name in names:
+		timed(samples, db_io.add_node, name)
+	results[prefix + 'add_node'] = summarize(samples)
+
+	samples = []
+	for edge in edges:
+		timed(samples, db_io.add_connection_by_name, names[edge[0]], names[edge[1]])
+	results[prefix + 'add_connection_by_name'] = summarize(samples)
+
+	samples = []
+	for i in range(min(args.lookups, size)):
+		timed(samples, db_io.lookup_node_by_name, names[rng.randrange(size)])
+	results[prefix + 'lookup_node_by_name'] = summarize(samples)
+
+	# The same lookups building every statement from scratch, as before the
+	# statement registry (which also disables prepared statements)
+	db_io.database.cache_statements = False
+	try:
+		samples = []
+		for i in range(min(args.lookups, size)):
+			timed(samples, db_io.lookup_node_by_name, names[rng.randrange(size)])
+		results[prefix + 'lookup_node_by_name (no registry)'] = summarize(samples)
+	finally:
+		db_io.database.cache_statements = True
+
+	samples = []
+	for i in range(args.repeat):
+		timed(samples, db_io.list_nodes)
+	results[prefix + 'list_nodes'] = summarize(samples)
+
+	samples = []
+	for i in range(args.repeat):
+		timed(samples, db_io.list_connections)
+	results[prefix + 'list_connections'] = summarize(samples)
+
+	if size <= args.render_max:
+		samples = []
+		with tempfile.TemporaryDirectory() as tmp:
+			for i in range(args.render_repeat):
+				timed(samples, rend.render, os.path.join(tmp, 'bench.png'), args.render_prog)
+		results[prefix + 'render (' + args.render_prog + ')'] = summarize(samples)
+
+
+
+def bench_layout(model, size, seed, args, results):
+	'''
+	  ' Times each layout program on one generated graph. Graphviz programs
+		' are skipped above -layout-max nodes; they get very slow.
+	'''
+	names, edges = generate(model, size, seed=seed)
+	nx_graph = nx.Graph()
+	nx_graph.add_nodes_from(range(len(names)))
+	nx_graph.add_edges_from(edges)
+
+	for prog in args.layout_progs.split(','):
+		if prog != social_layout.LAYOUT_PROG and size > args.layout_max:
+			continue
+		samples = []
+		for i in range(args.render_repeat):
+			start = time.perf_counter()
+			if prog == social_layout.LAYOUT_PROG:
+				positions = social_layout.layout_graph(nx_graph, seed)
+				pgv_graph = nx.drawing.nx_agraph.to_agraph(nx_graph)
+				for node, (x, y) in positions.items():
+					pgv_graph.get_node(node).attr['pos'] = '{:.2f},{:.2f}'.format(x, y)
+				pgv_graph.layout(prog='nop2')
+			else:
+				nx.drawing.nx_agraph.to_agraph(nx_graph).layout(prog=prog)
+			samples.append(time.perf_counter() - start)
+		results[model + '-' + str(size) + '/layout (' + prog + ')'] = summarize(samples)
+
+
+
+def bench_statements(db_io, args, results):
+	'''
+	  ' Microbenchmark of statement composition alone, with and without the
+		' statement registry.
+	'''
+	template = 'SELECT name, id FROM {} WHERE name=%s AND parent_file_id=%s;'
+	for label, cached in (('registry', True), ('no registry', False)):
+		db_io.database.cache_statements = cached
+		samples = []
+		for i in range(args.repeat):
+			start = time.perf_counter()
+			for j in range(1000):
+				db_io.database.compose(template, 'nodes')
+			samples.append((time.perf_counter() - start) / 1000)
+		results['statements/compose (' + label + ')'] = summarize(samples)
+	db_io.database.cache_statements = True
+
+
+
+def compare(results, baseline, threshold):
+	'''
+	  ' Prints a comparison of results against baseline, and returns the
+		' list of measurement names that regressed by more than threshold.
+	'''
+	regressions = []
+	print('{:<50} {:>11} {:>11} {:>8}'.format('measurement', 'baseline', 'current', 'change'))
+	for name in sorted(results.keys()):
+		if name not in baseline:
+			print('{:<50} {:>11} {:>11.6f} {:>8}'.format(name, '-', results[name]['median'], 'new'))
+			continue
+		base = baseline[name]['median']
+		cur = results[name]['median']
+		change = (cur - base) / base if base > 0 else 0.0
+		flag = ''
+		if change > threshold:
+			flag = '  REGRESSION'
+			regressions.append(name)
+		print('{:<50} {:>11.6f} {:>11.6f} {:>+7.1%}{}'.format(name, base, cur, change, flag))
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Pysocial benchmark suite')
+	parser.add_argument('-config', default=os.path.join(REPO_DIR, 'social-config.json'), help='config file with the database to benchmark against')
+	parser.add_argument('-backend', choices=['postgresql', 'sqlite'], help='override the configured backend; sqlite runs in a temporary database file')
+	parser.add_argument('-models', default='er,ba,ws', help='comma-separated generators (' + ','.join(GENERATORS.keys()) + ')')
+	parser.add_argument('-sizes', default='100,1000', help='comma-separated node counts')
+	parser.add_argument('-seed', type=int, default=0)
+	parser.add_argument('-repeat', type=int, default=5, help='repetitions for list benchmarks')
+	parser.add_argument('-lookups', type=int, default=200, help='number of random lookups')
+	parser.add_argument('-render-prog', dest='render_prog', default='sfdp')
+	parser.add_argument('-render-max', dest='render_max', type=int, default=1000, help='skip rendering graphs larger than this')
+	parser.add_argument('-render-repeat', dest='render_repeat', type=int, default=1)
+	parser.add_argument('-layout-progs', dest='layout_progs', default='fr,sfdp,circo', help='comma-separated layout programs to compare')
+	parser.add_argument('-layout-sizes', dest='layout_sizes', help='node counts for the layout comparison (default: -sizes)')
+	parser.add_argument('-layout-max', dest='layout_max', type=int, default=1000, help='skip graphviz layouts of graphs larger than this')
+	parser.add_argument('-output', default=os.path.join(BENCH_DIR, 'results.json'))
+	parser.add_argument('-baseline', default=os.path.join(BENCH_DIR, 'baseline.json'))
+	parser.add_argument('-save-baseline', dest='save_baseline', action='store_true', help='store these results as the new baseline')
+	parser.add_argument('-threshold', type=float, default=0.25, help='relative slowdown that counts as a regression')
+	args = parser.parse_args()
+
+	scratch = tempfile.TemporaryDirectory()
+	if args.backend == 'sqlite':
+		config_path = os.path.join(scratch.name, 'bench-config.json')
+		with open(config_path, 'w') as config_file:
+			json.dump({'db_backend':'sqlite', 'db_path':os.path.join(scratch.name, 'bench.db')}, config_file)
+		config = configurer(config_path)
+	else:
+		config = configurer(args.config)
+		if args.backend:
+			config.config['db_backend'] = args.backend
+	config.config['table_prefix'] = 'pysocial_bench_' + str(os.getpid()) + '_'
+
+	os.chdir(REPO_DIR) # database_io loads social-tables.json from the cwd
+	db_io = database_io(config, bench_ui())
+	rend = renderer(db_io, config, bench_ui())
+
+	results = {}
+	samples = []
+	if timed(samples, db_io.begin) != 0:
+		print('Could not connect to the benchmark database.')
+		return 2
+	results['startup/begin (create tables)'] = summarize(samples)
+
+	try:
+		samples = []
+		for i in range(args.repeat):
+			timed(samples, db_io.database.table_check)
+		results['startup/table_check'] = summarize(samples)
+
+		bench_statements(db_io, args, results)
+
+		for model in args.models.split(','):
+			for size in args.sizes.split(','):
+				print('Benchmarking ' + model + ' graph with ' + size + ' nodes...')
+				bench_graph(db_io, rend, model, int(size), args.seed, args, results)
+			for size in (args.layout_sizes or args.sizes).split(','):
+				print('Comparing layouts of ' + model + ' graph with ' + size + ' nodes...')
+				bench_layout(model, int(size), args.seed, args, results)
+	finally:
+		drop_bench_tables(db_io)
+		scratch.cleanup()
+
+	output = {
+		'meta':{
+			'time':time.time(),
+			'python':platform.python_version(),
+			'platform':platform.platform(),
+			'backend':config.config.get('db_backend', 'postgresql'),
+			'seed':args.seed,
+			'models':args.models,
+			'sizes':args.sizes
+		},
+		'results':results
+	}
+	with open(args.output, 'w') as out_file:
+		json.dump(output, out_file, indent=2)
+	print('Results written to ' + args.output)
+
+	regressions = []
+	if os.path.exists(args.baseline) and not args.save_baseline:
+		with open(args.baseline) as base_file:
+			baseline = json.load(base_file)['results']
+		regressions = compare(results, baseline, args.threshold)
+
+	if args.save_baseline:
+		with open(args.baseline, 'w') as out_file:
+			json.dump(output, out_file, indent=2)
+		print('Baseline written to ' + args.baseline)
+
+	if regressions:
+		print(str(len(regressions)) + ' measurement(s) regressed by more than ' + '{:.0%}'.format(args.threshold))
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -21,14 +21,20 @@ along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
 
 import networkx as nx
 import pygraphviz as pgv
+import collections
+import contextlib
+import itertools
 import json
 import random
 import sys
-from psycopg2 import sql
+import time
 
-
-from social_db import db_connect, database_cursor, db_initialize_error
+from social_db import open_backend, database_cursor, db_initialize_error
 from social_ui import ui, none_ui, basic_console_ui
+from social_session import graph_session
+from social_snapshot import write_snapshot
+from social_export import EXPORT_FORMATS, export_graph, open_export_file
+from social_profile import sampling_profiler, SAMPLE_INTERVAL
 
 '''
   ' Config structure
@@ -38,8 +44,36 @@ from social_ui import ui, none_ui, basic_console_ui
 	'   db_password = password for above
 	'   db_host = host to connect to for postgresql database
 	'   db_port = port for above
+	'
+	'   db_backend = 'postgresql' (default) or 'sqlite'
+	'   db_path = database file for the sqlite backend (default: social.db)
 	'   
 	'   table_prefix = text to prepend to tables (for shared databases)
+	'
+	'   instrument = if true, record per-statement query statistics from
+	'                startup (see the `stats` command)
+	'   profile_sampling = if true, sample the call stacks of rendering,
+	'                      listing and lookups (see `profile -samples`)
+	'   profile_sampling_interval = seconds between samples (default 0.005)
+	'
+	'   write_behind = if true, keep the open file in memory and write
+	'                  changes to the database in batches (see `session`)
+	'   write_behind_interval = if set, flush pending changes once they are
+	'                           this many seconds old
+	'
+	'   render_budget = if set, files with more nodes than this are rendered
+	'                   at a lower level of detail (see `render -budget`)
+	'
+	'   analytics_samples = number of source nodes `analyze` estimates
+	'                       betweenness from (default 64)
+	'
+	'   server_socket = Unix socket for `social_cli.py -serve` and
+	'                   `-connect` (default: pysocial.sock)
+	'
+	'   watch_debounce = seconds without changes before `watch` renders
+	'                    again (default 0.5)
+	'   watch_poll_interval = how often `watch` checks for changes on
+	'                         backends without NOTIFY (default 1 second)
 	' }
 '''
 
@@ -143,6 +177,56 @@ class name_conflict_error(BaseException):
 	pass
 
 
+DISCRIM_MODULUS = 100000
+NODE_ID_ATTEMPTS = 8
+METRIC_COLUMNS = ('pagerank', 'betweenness', 'eigenvector', 'clustering') # node_metrics; see social_analytics.METRICS
+
+
+def discriminator(node_id):
+	'''
+	  ' Returns the discriminator shown after a node's name (name:discrim).
+		' The nodes table stores the same value in its generated discrim
+		' column.
+	'''
+	return abs(int(node_id)) % DISCRIM_MODULUS
+
+
+def resolve_node(ui, nodes, node_name, node_discrim=None):
+	'''
+	  ' Picks the node meant by a name (and optional discriminator) out of
+		' all nodes with that name.
+		'
+		' Parameters:
+		'   ui = UI object for logging
+		'   nodes = list of (name, id) rows with the requested name (and
+		'           discriminator, if the caller already filtered by it)
+		'   node_name = the requested name
+		'   node_discrim = discriminator (see discriminator()), if given
+		'
+		' Returns: the matching row, or None if nothing matches. Raises
+		'   name_conflict_error if the name is ambiguous.
+	'''
+	if node_discrim is not None:
+		nodes = [node for node in nodes if discriminator(node[1]) == int(node_discrim)]
+
+	if len(nodes) == 1:
+		return nodes[0]
+	elif len(nodes) == 0:
+		if node_discrim is not None:
+			ui.log_warning('No matches found for node "' + str(node_name) + '":' + str(node_discrim))
+		else:
+			ui.log_warning('No matches found for node name "' + str(node_name) + '"')
+		return None
+	elif node_discrim is None:
+		ui.log_warning('Multiple matches for node name "' + str(node_name) + '", but no discrim provided.')
+		raise name_conflict_error
+	else:
+		# Only possible if the unique index on (parent_file_id, name,
+		# discrim) could not be created, or when looking across files
+		ui.log_warning('Multiple nodes have the same name "' + str(node_name) + '" and the same discrim ' + str(node_discrim) + '!')
+		raise name_conflict_error
+
+
 class database_io:
 	
 	def __init__(self, configurer_object, ui=None):
@@ -150,6 +234,11 @@ class database_io:
 		self.file_id = None
 		self.file_name = None
 		self.database = None
+		self.session = None
+		self.write_behind = bool(self.config.retrieve('write_behind'))
+		self.sampler = None
+		if self.config.retrieve('profile_sampling'):
+			self.enable_sampling(self.config.retrieve('profile_sampling_interval'))
 		if ui:
 			self.ui = ui
 		else:
@@ -170,7 +259,10 @@ class database_io:
 	
 	def begin(self):
 		self.ui.write('Connecting to database...')
-		self.ui.log('Connecting to database ' + str(self.config.retrieve('db_name')) + ' at ' + str(self.config.retrieve('db_host')) + ':' + str(self.config.retrieve('db_port')) + ' as user ' + str(self.config.retrieve('db_user')))
+		if self.config.retrieve('db_backend') == 'sqlite':
+			self.ui.log('Opening SQLite database ' + str(self.config.retrieve('db_path')))
+		else:
+			self.ui.log('Connecting to database ' + str(self.config.retrieve('db_name')) + ' at ' + str(self.config.retrieve('db_host')) + ':' + str(self.config.retrieve('db_port')) + ' as user ' + str(self.config.retrieve('db_user')))
 		self.ui.log('Loading schema from social-tables.json...')
 		try:
 			with open('social-tables.json') as tables:
@@ -187,26 +279,485 @@ class database_io:
 		
 		self.ui.log('Schema load successful. Connecting...')
 		try:
-			self.database = db_connect(self.ui, self.config.config, self.schema)
+			self.database = open_backend(self.ui, self.config.config, self.schema)
 		except db_initialize_error:
 			self.ui.log_error('Failed to connect to database.')
 			return 4
+		self.__backfill_file_stats()
 		self.ui.write('Connected.')
 		return 0
 	
+	def stats(self):
+		'''
+		  ' Returns the query_stats object collecting instrumentation data,
+			' or None if instrumentation is disabled or we are not connected.
+		'''
+		if self.database:
+			return self.database.stats
+		return None
+	
+
+	def enable_sampling(self, interval=None):
+		'''
+		  ' Starts sampling the call stacks of the instrumented sections
+			' (see sampling()), every interval seconds.
+			'
+			' Returns: the sampling_profiler
+		'''
+		if not self.sampler:
+			self.sampler = sampling_profiler(float(interval or SAMPLE_INTERVAL))
+		return self.sampler
+
+	def disable_sampling(self):
+		if self.sampler:
+			self.sampler.stop()
+		self.sampler = None
+
+	def sampling(self, name):
+		'''
+		  ' Returns a context manager marking a section for the sampling
+			' profiler, which does nothing unless sampling is enabled.
+		'''
+		if self.sampler:
+			return self.sampler.section(name)
+		return contextlib.nullcontext()
+	
 	def __set_file(self, file_name, file_id):
+		if self.flush() != 0:
+			self.ui.log_warning('Pending changes to "' + str(self.file_name) + '" could not be saved and were discarded.')
+		self.session = None
 		self.file_name = file_name
 		self.file_id = file_id
+		if self.write_behind:
+			self.__load_session()
+	
+
+	def __load_session(self):
+		self.ui.log('Loading file ' + str(self.file_id) + ' into memory')
+		self.session = None
+		with database_cursor(self.database) as cur:
+			cur.execute(self.database.compose('SELECT version FROM {} WHERE id=%s;', 'files'), (self.file_id,))
+			version = (cur.fetchone() or (None,))[0]
+		# The session will be written back over the primary, so it must not
+		# start from a replica's older copy of the file
+		self.database.note_write()
+		nodes = self.list_nodes()
+		connections = self.list_connections()
+		self.session = graph_session(self.file_id)
+		self.session.version = version
+		self.session.load(nodes, connections)
+	
+
+	def set_write_behind(self, enabled):
+		'''
+		  ' Turns write-behind mode on or off. In write-behind mode the open
+			' file is kept in memory: lookups and listings never touch the
+			' database, and new nodes and connections are only written when
+			' flush() is called (by `save`, on exit, when switching files, or
+			' once write_behind_interval seconds have passed).
+			'
+			' Returns:
+			'   0 = success
+			'   2 = could not flush pending changes while turning it off
+		'''
+		if enabled:
+			self.write_behind = True
+			if self.current_file() and not self.session:
+				self.__load_session()
+		else:
+			if self.flush() != 0:
+				return 2
+			self.write_behind = False
+			self.session = None
+		return 0
+	
+
+	def pending_changes(self):
+		if self.session:
+			return self.session.pending()
+		return 0
+	
+
+	def flush(self):
+		'''
+		  ' Writes the write-behind mutation log to the database in batched
+			' multi-row INSERTs, within one transaction.
+			'
+			' The file is locked for the duration, so concurrent flushes to the
+			' same file take turns. If another session has deleted the file or
+			' changed its structure (bumped its version, e.g. by merging
+			' duplicates) since it was loaded, nothing is written.
+			'
+			' Otherwise the file's row counts are compared to what the
+			' session last saw. If another session has written to the file,
+			' its rows are fetched and checked against the pending changes: a
+			' node name or connection added by both sessions, or a connection
+			' to a node which has since been removed, is a conflict and
+			' nothing is written. Non-conflicting foreign rows are merged into
+			' the session.
+			'
+			' Returns:
+			'   0 = success (or nothing to flush)
+			'   2 = conflicting writes by another session; nothing was written
+		'''
+		if not self.session or self.session.pending() == 0:
+			return 0
+
+		with database_cursor(self.database) as cur:
+			self.database.lock(cur, 'file', self.file_id)
+			cmd = self.database.compose('SELECT f.version, s.node_count, s.connection_count FROM {} f LEFT JOIN {} s ON s.file_id = f.id WHERE f.id=%s;', 'files', 'file_stats')
+			cur.execute(cmd, (self.file_id,))
+			row = cur.fetchone()
+			if not row:
+				self.ui.log_error('Write conflict: the file was deleted by another session')
+				self.database.rollback()
+				return 2
+			version, node_count, connection_count = row
+			if version != self.session.version:
+				self.ui.log_error('Write conflict: the file was restructured by another session')
+				self.database.rollback()
+				return 2
+
+			if node_count != self.session.db_node_count or connection_count != self.session.db_connection_count:
+				self.ui.log_warning('File was modified by another session; checking for conflicts.')
+				cmd = self.database.compose('SELECT name, id FROM {} WHERE parent_file_id=%s;', 'nodes')
+				cur.execute(cmd, (self.file_id,))
+				db_nodes = cur.fetchall()
+				cmd = self.database.compose('SELECT first_id, second_id, connection_id FROM {} WHERE parent_file_id=%s;', 'connections')
+				cur.execute(cmd, (self.file_id,))
+				db_connections = cur.fetchall()
+
+				conflicts, foreign_nodes, foreign_connections = self.session.find_conflicts(db_nodes, db_connections)
+				if conflicts:
+					for conflict in conflicts:
+						self.ui.log_error('Write conflict: ' + conflict)
+					self.database.rollback()
+					return 2
+				self.session.load(foreign_nodes, foreign_connections)
+
+			self.ui.log('Flushing ' + str(len(self.session.pending_nodes)) + ' node(s) and ' + str(len(self.session.pending_connections)) + ' connection(s)')
+			self.database.insert_many(cur, 'nodes', ['name', 'id', 'parent_file_id'], self.session.pending_nodes)
+			self.database.insert_many(cur, 'connections', ['first_id', 'second_id', 'connection_id', 'parent_file_id'], self.session.pending_connections)
+			self.__count_changes(cur, self.file_id, nodes=len(self.session.pending_nodes), connections=[(cxn[0], cxn[1]) for cxn in self.session.pending_connections])
+			self.database.commit()
+
+		self.session.flushed()
+		return 0
+	
+
+	def __maybe_flush(self):
+		interval = self.config.retrieve('write_behind_interval')
+		if interval and time.time() - self.session.last_flush >= interval:
+			self.flush()
+	
+
+	def discard_pending(self):
+		'''
+		  ' Drops unflushed write-behind changes and reloads the file.
+		'''
+		if self.session:
+			self.__load_session()
+	
+
+	def end(self):
+		'''
+		  ' Flushes any pending changes before the program exits.
+			'
+			' Returns: see flush()
+		'''
+		return self.flush()
 	
 
+	def __count_changes(self, cur, file_id, nodes=0, connections=()):
+		'''
+		  ' Keeps file_stats and node_degrees up to date after adding nodes
+			' and connections to a file, counts the change and notifies
+			' listeners. Does not commit.
+			'
+			' Parameters:
+			'   nodes = number of nodes added
+			'   connections = (first_id, second_id) pairs of added connections
+		'''
+		cmd = self.database.compose('INSERT INTO {} AS t (file_id, node_count, connection_count, change_count) VALUES (%s,%s,%s,0) ON CONFLICT (file_id) DO UPDATE SET node_count = t.node_count + excluded.node_count, connection_count = t.connection_count + excluded.connection_count, change_count = t.change_count + 1;', 'file_stats')
+		cur.execute(cmd, (file_id, nodes, len(connections)))
+		self.database.notify(cur, file_id, 'changed')
+
+		degrees = collections.Counter()
+		for first_id, second_id in connections:
+			degrees[first_id] += 1
+			degrees[second_id] += 1
+		self.database.insert_many(cur, 'node_degrees', ['node_id', 'parent_file_id', 'degree'], [(node_id, file_id, degree) for node_id, degree in degrees.items()], on_conflict='ON CONFLICT (node_id) DO UPDATE SET degree = t.degree + excluded.degree')
+
+
+	def __recompute_file_stats(self, cur, file_id):
+		'''
+		  ' Rebuilds a file's file_stats row and node_degrees rows from its
+			' nodes and connections with set-based statements, counts the
+			' change and notifies listeners. Does not commit.
+		'''
+		cur.execute(self.database.compose('DELETE FROM {} WHERE parent_file_id=%s;', 'node_degrees'), (file_id,))
+		cur.execute(self.database.compose('INSERT INTO {} (node_id, parent_file_id, degree) SELECT n.id, n.parent_file_id, count(*) FROM (SELECT first_id AS id FROM {} WHERE parent_file_id=%s UNION ALL SELECT second_id FROM {} WHERE parent_file_id=%s) e JOIN {} n ON n.id = e.id AND n.parent_file_id=%s GROUP BY n.id, n.parent_file_id;', 'node_degrees', 'connections', 'connections', 'nodes'), (file_id, file_id, file_id))
+		# WHERE true keeps SQLite from parsing ON CONFLICT as a join clause
+		cur.execute(self.database.compose('INSERT INTO {} AS t (file_id, node_count, connection_count, change_count) SELECT %s, (SELECT count(*) FROM {} WHERE parent_file_id=%s), (SELECT count(*) FROM {} WHERE parent_file_id=%s), 0 WHERE true ON CONFLICT (file_id) DO UPDATE SET node_count = excluded.node_count, connection_count = excluded.connection_count, change_count = t.change_count + 1;', 'file_stats', 'nodes', 'connections'), (file_id, file_id, file_id))
+		self.database.notify(cur, file_id, 'changed')
+
+
+	def __backfill_file_stats(self):
+		'''
+		  ' Computes statistics for files which have none yet, such as files
+			' created before the statistics tables existed.
+		'''
+		with database_cursor(self.database) as cur:
+			cur.execute(self.database.compose('SELECT id FROM {} WHERE id NOT IN (SELECT file_id FROM {});', 'files', 'file_stats'))
+			missing = [row[0] for row in cur.fetchall()]
+			if missing:
+				self.ui.log('Computing statistics for ' + str(len(missing)) + ' file(s)')
+				for file_id in missing:
+					self.__recompute_file_stats(cur, file_id)
+				self.database.commit()
+
+
+	def recompute_stats(self, all_files=False):
+		'''
+		  ' Rebuilds the statistics of the open file (or of every file) from
+			' scratch. Statistics are normally kept up to date as nodes and
+			' connections are added; this is for after bulk imports or other
+			' writes which bypass database_io.
+			'
+			' Returns:
+			'   0 = success
+			'   1 = no file is open (and all_files is False)
+			'   3 = database error; nothing was changed
+		'''
+		if all_files:
+			file_ids = [row[1] for row in self.list_files()]
+		elif self.current_file():
+			file_ids = [self.file_id]
+		else:
+			return 1
+
+		try:
+			with database_cursor(self.database) as cur:
+				for file_id in file_ids:
+					self.database.lock(cur, 'file', file_id)
+					self.__recompute_file_stats(cur, file_id)
+				self.database.commit()
+		except self.database.database_error as err:
+			self.database.rollback()
+			self.ui.log_error('Could not recompute statistics: ' + str(err))
+			return 3
+		return 0
+
+
+	def file_info(self):
+		'''
+		  ' Returns a dict with the open file's 'nodes', 'connections',
+			' 'max_degree' and 'changes' (number of committed changes), read
+			' from the statistics tables rather than counted, or None if no
+			' file is open. Unsaved write-behind changes are not included.
+		'''
+		if not self.current_file():
+			return None
+		with database_cursor(self.database, read_only=True) as cur:
+			cur.execute(self.database.compose('SELECT node_count, connection_count, change_count FROM {} WHERE file_id=%s;', 'file_stats'), (self.file_id,))
+			row = cur.fetchone()
+			cur.execute(self.database.compose('SELECT degree FROM {} WHERE parent_file_id=%s ORDER BY degree DESC LIMIT 1;', 'node_degrees'), (self.file_id,))
+			top = cur.fetchone()
+		if not row:
+			row = (0, 0, 0)
+		return {'nodes':row[0], 'connections':row[1], 'max_degree':top[0] if top else 0, 'changes':row[2]}
+
+
+	def change_count(self):
+		'''
+		  ' Returns the open file's committed change counter, which goes up
+			' with every change made through pysocial, or None if no file is
+			' open or it has unsaved write-behind changes. Anything computed
+			' from the file's contents can be cached under (file_id,
+			' change_count()).
+		'''
+		if not self.current_file() or self.pending_changes():
+			return None
+		with database_cursor(self.database, read_only=True) as cur:
+			cur.execute(self.database.compose('SELECT change_count FROM {} WHERE file_id=%s;', 'file_stats'), (self.file_id,))
+			row = cur.fetchone()
+		if not row:
+			return 0
+		return row[0]
+
+
+	def change_listener(self):
+		'''
+		  ' Returns a listener whose wait(timeout) method blocks until the
+			' open file is changed by any session (through NOTIFY on
+			' PostgreSQL, by polling the change counter otherwise), or None if
+			' no file is open. close() it when done.
+		'''
+		if not self.current_file():
+			return None
+		return self.database.change_listener(self.file_id, self.config.retrieve('watch_poll_interval') or 1.0)
+
+
+	def degree_distribution(self):
+		'''
+		  ' Returns (degree, node count) rows for the open file in order of
+			' degree, including unconnected nodes as degree 0, or None if no
+			' file is open.
+		'''
+		info = self.file_info()
+		if info is None:
+			return None
+		with database_cursor(self.database, read_only=True) as cur:
+			cur.execute(self.database.compose('SELECT degree, count(*) FROM {} WHERE parent_file_id=%s GROUP BY degree ORDER BY degree;', 'node_degrees'), (self.file_id,))
+			rows = cur.fetchall()
+		isolated = info['nodes'] - sum(row[1] for row in rows)
+		if isolated > 0:
+			rows = [(0, isolated)] + list(rows)
+		return rows
+
+
+	def top_nodes(self, k=10):
+		'''
+		  ' Returns (name, id, degree) rows for the k most connected nodes of
+			' the open file, or None if no file is open.
+		'''
+		if not self.current_file():
+			return None
+		with database_cursor(self.database, read_only=True) as cur:
+			cur.execute(self.database.compose('SELECT n.name, n.id, d.degree FROM {} d JOIN {} n ON n.id = d.node_id WHERE d.parent_file_id=%s ORDER BY d.degree DESC, d.node_id LIMIT %s;', 'node_degrees', 'nodes'), (self.file_id, int(k)))
+			return cur.fetchall()
+
+
+	def analyze(self, metrics=None, samples=None, seed=0):
+		'''
+		  ' Computes centrality and clustering metrics for every node of the
+			' open file (see social_analytics, which needs numpy and scipy)
+			' and stores them in the node_metrics table, replacing earlier
+			' values of the same metrics. Metrics which are not recomputed keep
+			' their values.
+			'
+			' Parameters:
+			'   metrics = names of the metrics to compute (default: all of
+			'             social_analytics.METRICS)
+			'   samples = number of source nodes betweenness is estimated from
+			'             (default: config analytics_samples, or
+			'             social_analytics.BETWEENNESS_SAMPLES)
+			'   seed = seed for choosing those nodes
+			'
+			' Returns: a dict with the number of 'nodes' and 'connections'
+			'   analyzed and the 'metrics' computed, or None if no file is
+			'   open, numpy or scipy is missing, or the results could not be
+			'   saved (in which case nothing was changed).
+		'''
+		if not self.current_file():
+			self.ui.log_warning('Attempted to analyze, but no file is open')
+			return None
+		try:
+			import social_analytics
+		except ImportError as err:
+			self.ui.log_error('Analytics need numpy and scipy: ' + str(err))
+			return None
+
+		if metrics is None:
+			metrics = social_analytics.METRICS
+		if samples is None:
+			samples = self.config.retrieve('analytics_samples') or social_analytics.BETWEENNESS_SAMPLES
+		stats = self.stats()
+		def timer(name, seconds):
+			if stats:
+				stats.record_timing('analyze.' + name, seconds)
+
+		start = time.perf_counter()
+		ids, first, second = social_analytics.edge_arrays(self.iter_nodes(), self.iter_connections())
+		adj = social_analytics.adjacency(len(ids), first, second)
+		timer('load', time.perf_counter() - start)
+		self.ui.log('Analyzing ' + str(len(ids)) + ' node(s) and ' + str(len(first)) + ' connection(s)')
+		results = social_analytics.analyze(adj, metrics, samples, seed, timer)
+
+		start = time.perf_counter()
+		file_id = self.file_id
+		columns = list(results.keys())
+		rows = zip(ids.tolist(), itertools.repeat(file_id), *[results[column].tolist() for column in columns])
+		try:
+			with database_cursor(self.database) as cur:
+				cur.execute(self.database.compose('DELETE FROM {} WHERE parent_file_id=%s AND node_id NOT IN (SELECT id FROM {} WHERE parent_file_id=%s);', 'node_metrics', 'nodes'), (file_id, file_id))
+				self.database.insert_many(cur, 'node_metrics', ['node_id', 'parent_file_id'] + columns, list(rows), on_conflict='ON CONFLICT (node_id) DO UPDATE SET ' + ', '.join(column + ' = excluded.' + column for column in columns))
+				self.database.commit()
+		except self.database.database_error as err:
+			self.database.rollback()
+			self.ui.log_error('Could not save node metrics: ' + str(err))
+			return None
+		timer('save', time.perf_counter() - start)
+		return {'nodes':len(ids), 'connections':len(first), 'metrics':columns}
+
+
+	def node_metrics(self, metric):
+		'''
+		  ' Returns {node id: value} of a stored metric (see analyze()) for
+			' the open file, leaving out nodes it was not computed for, or
+			' None if no file is open or metric is not a metric.
+		'''
+		if not self.current_file() or metric not in METRIC_COLUMNS:
+			return None
+		with database_cursor(self.database, read_only=True) as cur:
+			cur.execute(self.database.compose('SELECT node_id, ' + metric + ' FROM {} WHERE parent_file_id=%s AND ' + metric + ' IS NOT NULL;', 'node_metrics'), (self.file_id,))
+			return dict(cur.fetchall())
+
+
+	def top_by_metric(self, metric, k=10):
+		'''
+		  ' Returns (name, id, value) rows for the k nodes of the open file
+			' with the highest value of a stored metric, or None if no file is
+			' open or metric is not a metric.
+		'''
+		if not self.current_file() or metric not in METRIC_COLUMNS:
+			return None
+		with database_cursor(self.database, read_only=True) as cur:
+			cur.execute(self.database.compose('SELECT n.name, n.id, m.' + metric + ' FROM {} m JOIN {} n ON n.id = m.node_id WHERE m.parent_file_id=%s AND m.' + metric + ' IS NOT NULL ORDER BY m.' + metric + ' DESC, m.node_id LIMIT %s;', 'node_metrics', 'nodes'), (self.file_id, int(k)))
+			return cur.fetchall()
+
+
+	def __new_file(self, cur, file_name, file_id):
+		'''
+		  ' Creates a file row (with its partitions and statistics) unless a
+			' file with the same name exists. The name stays locked until the
+			' transaction ends, so concurrent sessions cannot create the same
+			' name twice. Does not commit.
+			'
+			' Returns: True if the file was created
+		'''
+		self.database.lock(cur, 'file_name', str(file_name))
+		cur.execute(self.database.compose('SELECT id FROM {} WHERE name = %s;', 'files'), (str(file_name),))
+		if cur.fetchall():
+			return False
+		cur.execute(self.database.compose('INSERT INTO {} (name, id) VALUES (%s,%s);', 'files'), (str(file_name), file_id))
+		self.database.add_file_partitions(cur, file_id)
+		self.__count_changes(cur, file_id)
+		return True
+
+
+	def __bump_version(self, cur, file_id):
+		'''
+		  ' Marks a structural change to a file (one which removes or rewrites
+			' rows rather than adding them), so write-behind sessions holding
+			' an older copy refuse to flush. Does not commit.
+		'''
+		cur.execute(self.database.compose('UPDATE {} SET version = version + 1 WHERE id=%s;', 'files'), (file_id,))
+
+
 	def create_file(self, file_name, file_id=None):
+		'''
+		  ' Returns: the new file's id, or None if a file with that name
+			'   already exists
+		'''
 		if not file_id:
 			file_id = random.randint(-1*sys.maxsize, sys.maxsize)
 			self.ui.log_debug('Generated id ' + str(file_id))
 
-		cmd = sql.SQL('INSERT INTO {} (name, id) VALUES (%s,%s);').format(sql.Identifier(self.database.tablify('files')))
 		with database_cursor(self.database) as cur:
-			cur.execute(cmd, (str(file_name), file_id))
+			if not self.__new_file(cur, file_name, file_id):
+				self.database.rollback()
+				return None
 			self.database.commit()
 
 		return file_id
@@ -214,10 +765,14 @@ class database_io:
 	def open_file_by_name(self, file_name, create=True):
 		with database_cursor(self.database) as cur:
 			self.ui.log('Searching for file named "' + str(file_name) + '"')
-			cmd = sql.SQL('SELECT name, id FROM {} WHERE name = %s;').format(sql.Identifier(self.database.tablify('files')))
+			if create:
+				self.database.lock(cur, 'file_name', str(file_name))
+			cmd = self.database.compose('SELECT name, id FROM {} WHERE name = %s;', 'files')
 			cur.execute(cmd, (str(file_name),))
 			res = cur.fetchall()
 			if res:
+				if create:
+					self.database.rollback() # nothing to create; release the name lock
 				if len(res) == 1:
 					self.__set_file(res[0][0], res[0][1])
 					self.ui.log('File found with id ' + str(res[0][1]))
@@ -233,7 +788,10 @@ class database_io:
 			else:
 				self.ui.log_warning('File not found with name "' + str(file_name) + '"')
 				if create:
-					file_id = self.create_file(file_name)
+					file_id = random.randint(-1*sys.maxsize, sys.maxsize)
+					self.ui.log_debug('Generated id ' + str(file_id))
+					self.__new_file(cur, file_name, file_id)
+					self.database.commit()
 					self.ui.log_warning('Created file with id ' + str(file_id))
 					self.__set_file(file_name, file_id)
 				return 1
@@ -241,7 +799,7 @@ class database_io:
 	def open_file_by_id(self, file_id):
 		with database_cursor(self.database) as cur:
 			self.ui.log('Searching for file with id ' + str(file_id))
-			cmd = sql.SQL('SELECT name, id FROM {} WHERE id = %s;').format(sql.Identifier(self.database.tablify('files')))
+			cmd = self.database.compose('SELECT name, id FROM {} WHERE id = %s;', 'files')
 			cur.execute(cmd, (str(file_id),))
 			res = cur.fetchall()
 			if res:
@@ -268,86 +826,107 @@ class database_io:
 			self.ui.log_warning('Attempted to add node, but no file is open')
 			return 1
 
-		node_id = random.randint(-1*sys.maxsize, sys.maxsize)
-		with database_cursor(self.database) as cur:
-			self.ui.log('Adding node named "' + node_name + '" as id ' + str(node_id) + ' with parent file id ' + str(self.file_id))
-			cmd = sql.SQL('INSERT INTO {}(name, id, parent_file_id) VALUES (%s,%s,%s);').format(sql.Identifier(self.database.tablify('nodes')))
-			cur.execute(cmd, (str(node_name), node_id, self.file_id))
-			self.database.commit()
+		if self.session:
+			# The flush must not trip over the unique (name, discrim) index
+			taken = set(discriminator(node[1]) for node in self.session.lookup(str(node_name)))
+			node_id = random.randint(-1*sys.maxsize, sys.maxsize)
+			while discriminator(node_id) in taken:
+				node_id = random.randint(-1*sys.maxsize, sys.maxsize)
+			self.session.add_node(str(node_name), node_id)
+			self.__maybe_flush()
+			return
+
+		# A new id can collide with an existing one, or give the node the
+		# same discriminator as another node with its name; the database
+		# rejects both, so just draw another id
+		for attempt in range(NODE_ID_ATTEMPTS):
+			node_id = random.randint(-1*sys.maxsize, sys.maxsize)
+			with database_cursor(self.database) as cur:
+				self.ui.log('Adding node named "' + node_name + '" as id ' + str(node_id) + ' with parent file id ' + str(self.file_id))
+				cmd = self.database.compose('INSERT INTO {}(name, id, parent_file_id) VALUES (%s,%s,%s);', 'nodes')
+				try:
+					cur.execute(cmd, (str(node_name), node_id, self.file_id))
+				except self.database.integrity_error:
+					self.database.rollback()
+					self.ui.log_debug('Id ' + str(node_id) + ' is taken; trying another')
+					continue
+				self.__count_changes(cur, self.file_id, nodes=1)
+				self.database.commit()
+				return
+
+		self.ui.log_error('Could not find a free id for node "' + str(node_name) + '"')
+		return 2
 	
 	def lookup_node_by_name(self, node_name, node_discrim=None):
-		nodes = []
-		with database_cursor(self.database) as cur:
-			appendage = ''
-			if self.current_file():
-				appendage = ' AND parent_file_id=%s'
-			cmd = sql.SQL('SELECT name, id FROM {} WHERE name=%s' + appendage + ';').format(sql.Identifier(self.database.tablify('nodes')))
-			if self.current_file():
-				cur.execute(cmd, (str(node_name), str(self.file_id)))
+		with self.sampling('lookup'):
+			nodes = []
+			if self.session:
+				nodes = self.session.lookup(str(node_name))
 			else:
-				cur.execute(cmd, (str(node_name),))
+				with database_cursor(self.database) as cur:
+					# With a discriminator, this is a single probe of the
+					# (parent_file_id, name, discrim) index
+					conditions = ['name=%s']
+					args = [str(node_name)]
+					if self.current_file():
+						conditions.insert(0, 'parent_file_id=%s')
+						args.insert(0, self.file_id)
+					if node_discrim is not None:
+						conditions.append('discrim=%s')
+						args.append(int(node_discrim))
+					cmd = self.database.compose('SELECT name, id FROM {} WHERE ' + ' AND '.join(conditions) + ';', 'nodes')
+					cur.execute(cmd, args)
 
-			nodes = cur.fetchall()
+					nodes = cur.fetchall()
 
-		if not nodes:
-			nodes = []
+			if not nodes:
+				nodes = []
 
-		if len(nodes) == 1:
-			return nodes[0]
-		elif len(nodes) == 0:
-			self.ui.log_warning('No matches found for node name "' + str(node_name) + '"')
-			return None
-		else:
-			if not node_discrim:
-				self.ui.log_warning('Multiple matches for node name " ' + str(node_name) + '", but no discrim provided.')
-				raise name_conflict_error
-			else:
-				self.ui.log_debug('Attempting to resolve name conflict by name discriminator.')
-				found = None       # Check all possibilities for discrim
-				for node in nodes: # conflicts, just in case
-					if abs(node[1]) % 100000 == node_discrim:
-						if found: # Discrim conflict! My paranoia is justified!
-							self.ui.log_warning('Multiple nodes have the same name "' + str(node_name) + '" and the same discrim ' + str(node_discrim) + '!')
-							raise name_conflict_error
-						else:
-							found = node
-				
-				if found:
-					self.ui.log_debug('Conflict successfully resolved by name discriminator.')
-					return found
-				else:
-					self.ui.log_warning('Discriminator did not match any nodes.')
-					return None
+			return resolve_node(self.ui, nodes, node_name, node_discrim)
 					
 
 	def add_connection_by_id(self, origin_id, destination_id):
 		if not self.current_file():
 			self.log_error('Cannot add connections when no file is open.')
 
-		with database_cursor(self.database) as cur:
+		if self.session:
 			connection_id = random.randint(-1*sys.maxsize, sys.maxsize)
-			self.ui.log('Connecting ' + str(origin_id) + ' to ' + str(destination_id) + ' with connection id ' + str(connection_id))
-			cmd = sql.SQL('INSERT INTO {} (first_id, second_id, connection_id, parent_file_id) VALUES (%s,%s,%s,%s);').format(sql.Identifier(self.database.tablify('connections')))
+			self.session.add_connection(int(origin_id), int(destination_id), connection_id)
+			self.__maybe_flush()
+			return 0
 
-			cur.execute(cmd, (origin_id,destination_id,connection_id,self.file_id))
+		with database_cursor(self.database) as cur:
+			self.__insert_connection(cur, origin_id, destination_id)
 			self.database.commit()
 
 		return 0
 
 
+	def __insert_connection(self, cur, origin_id, destination_id):
+		# Convert before writing anything, so a bad id leaves no stray row
+		origin_id = int(origin_id)
+		destination_id = int(destination_id)
+		connection_id = random.randint(-1*sys.maxsize, sys.maxsize)
+		self.ui.log('Connecting ' + str(origin_id) + ' to ' + str(destination_id) + ' with connection id ' + str(connection_id))
+		cmd = self.database.compose('INSERT INTO {} (first_id, second_id, connection_id, parent_file_id) VALUES (%s,%s,%s,%s);', 'connections')
+
+		cur.execute(cmd, (origin_id,destination_id,connection_id,self.file_id))
+		self.__count_changes(cur, self.file_id, connections=[(origin_id, destination_id)])
+
+
 	
 	def add_connection_by_name(self, origin_name, destination_name, origin_discrim=None, destination_discrim=None):
 		if not self.current_file():
 			self.log_error('Cannot add connections when no file is open.')
 
-		if origin_discrim:
+		if origin_discrim is not None:
 			self.ui.log('Looking up "' + str(origin_name) + '":' + str(origin_discrim) + ' by name and discrim')
 		else:
 			self.ui.log('Looking up "' + str(origin_name) + '" by name')
 
 		origin = self.lookup_node_by_name(origin_name, origin_discrim)
 
-		if destination_discrim:
+		if destination_discrim is not None:
 			self.ui.log('Looking up "' + str(destination_name) + '":' + str(destination_discrim) + ' by name and discrim')
 		else:
 			self.ui.log('Looking up "' + str(destination_name) + '" by name')
@@ -358,65 +937,582 @@ class database_io:
 			self.ui.log_error('Could not identify nodes to connect.')
 			return 1
 
+		if self.session:
+			if self.session.has_connection(origin[1], destination[1]):
+				self.ui.log_warning('Connection between "' + str(origin_name) + '" and "' + str(destination_name) + '" already exists.')
+				return 2
+			self.add_connection_by_id(origin[1], destination[1])
+			return 0
+
 		with database_cursor(self.database) as cur:
-			cmd = sql.SQL('SELECT connection_id FROM {} WHERE (first_id=%s AND second_id=%s) OR (first_id=%s AND second_id=%s);').format(sql.Identifier(self.database.tablify('connections')))
+			# Lock the pair so that two sessions can't both see it missing
+			# and insert it; connections between other nodes are unaffected
+			self.database.lock(cur, 'pair', min(origin[1], destination[1]), max(origin[1], destination[1]))
+			cmd = self.database.compose('SELECT connection_id FROM {} WHERE (first_id=%s AND second_id=%s) OR (first_id=%s AND second_id=%s);', 'connections')
 			cur.execute(cmd, (origin[1],destination[1],destination[1],origin[1]))
 
 			res = cur.fetchall()
 			if res:
+				self.database.rollback()
 				self.ui.log_warning('Connection between "' + str(origin_name) + '" and "' + str(destination_name) + '" already exists.')
 				return 2
 
-		self.add_connection_by_id(origin[1], destination[1])
+			self.__insert_connection(cur, origin[1], destination[1])
+			self.database.commit()
 		return 0
 
 
 	
-	def list_nodes(self):
-		file_filter = None
-		if self.current_file():
-			file_filter = self.file_id
-		else:
-			self.ui.log('Listing all nodes')
-		with database_cursor(self.database) as cur:
-			cmd = ''
-			appendage = ''
-			if file_filter:
-				appendage = ' WHERE parent_file_id=%s'
-			cmd = sql.SQL('SELECT name, id FROM {}' + appendage + ';').format(sql.Identifier(self.database.tablify('nodes')))
+	def list_nodes(self, limit=None, after=None, where=None):
+		'''
+		  ' Lists the nodes in the current file, or in all files if no file is
+			' open, as (name, id) rows.
+			'
+			' Parameters:
+			'   limit = if given, return at most this many rows
+			'   after = if given, only return nodes with an id greater than this.
+			'           Pass the id of the last row of one page to get the next
+			'           page; pages are ordered by id, which turns every page
+			'           into a cheap range scan of the (parent_file_id, id)
+			'           index no matter how deep into the file it is.
+			'   where = if given, only return nodes whose name matches this SQL
+			'           LIKE pattern
+		'''
+		with self.sampling('list_nodes'):
+			if self.session:
+				return self.session.list_nodes(limit, after, where)
 
-			if file_filter:
-				cur.execute(cmd, (self.file_id,))
+			conditions = []
+			args = []
+			if self.current_file():
+				conditions.append('parent_file_id=%s')
+				args.append(self.file_id)
 			else:
-				cur.execute(cmd)
+				self.ui.log('Listing all nodes')
+			if after is not None:
+				conditions.append('id>%s')
+				args.append(int(after))
+			if where is not None:
+				conditions.append('name LIKE %s')
+				args.append(str(where))
 
-			return cur.fetchall()
+			appendage = ''
+			if conditions:
+				appendage = ' WHERE ' + ' AND '.join(conditions)
+			if limit is not None or after is not None:
+				appendage = appendage + ' ORDER BY id'
+			if limit is not None:
+				appendage = appendage + ' LIMIT %s'
+				args.append(int(limit))
 
+			with database_cursor(self.database, read_only=True) as cur:
+				cmd = self.database.compose('SELECT name, id FROM {}' + appendage + ';', 'nodes')
+				cur.execute(cmd, args)
+				return cur.fetchall()
+
+
+	def list_connections(self, limit=None, after=None, where=None):
+		'''
+		  ' Lists the connections in the current file, or in all files if no
+			' file is open, as (first_id, second_id, connection_id) rows.
+			'
+			' Parameters:
+			'   limit, after = keyset pagination on connection_id, as for
+			'                  list_nodes()
+			'   where = if given, only return connections where at least one of
+			'           the endpoints' names matches this SQL LIKE pattern
+		'''
+		with self.sampling('list_connections'):
+			if self.session:
+				return self.session.list_connections(limit, after, where)
+
+			conditions = []
+			args = []
+			if self.current_file():
+				conditions.append('parent_file_id=%s')
+				args.append(self.file_id)
+			else:
+				self.ui.log('Listing all connections')
+			if after is not None:
+				conditions.append('connection_id>%s')
+				args.append(int(after))
+			if where is not None:
+				conditions.append('EXISTS (SELECT 1 FROM {} n WHERE n.id IN (first_id, second_id) AND n.name LIKE %s)')
+				args.append(str(where))
 
-	def list_connections(self):
-		file_filter = None
-		if self.current_file():
-			file_filter = self.file_id
-		else:
-			self.ui.log('Listing all connections')
-		with database_cursor(self.database) as cur:
-			cmd = ''
 			appendage = ''
-			if file_filter:
-				appendage = ' WHERE parent_file_id=%s'
-			cmd = sql.SQL('SELECT first_id, second_id, connection_id FROM {}' + appendage + ';').format(sql.Identifier(self.database.tablify('connections')))
+			if conditions:
+				appendage = ' WHERE ' + ' AND '.join(conditions)
+			if limit is not None or after is not None:
+				appendage = appendage + ' ORDER BY connection_id'
+			if limit is not None:
+				appendage = appendage + ' LIMIT %s'
+				args.append(int(limit))
 
-			if file_filter:
-				cur.execute(cmd, (self.file_id,))
+			with database_cursor(self.database, read_only=True) as cur:
+				cmd = self.database.compose('SELECT first_id, second_id, connection_id FROM {}' + appendage + ';', 'connections', 'nodes')
+				cur.execute(cmd, args)
+				return cur.fetchall()
+	
+
+	def iter_nodes(self):
+		'''
+		  ' Yields the (name, id) rows of the current file (or of all files)
+			' one at a time, streaming them from the database instead of
+			' loading them all at once.
+		'''
+		if self.session:
+			for node in self.session.list_nodes():
+				yield node
+			return
+
+		with database_cursor(self.database, stream=True, read_only=True) as cur:
+			if self.current_file():
+				cur.execute(self.database.compose('SELECT name, id FROM {} WHERE parent_file_id=%s;', 'nodes'), (self.file_id,))
+			else:
+				cur.execute(self.database.compose('SELECT name, id FROM {};', 'nodes'))
+			for node in cur:
+				yield node
+
+
+	def iter_connections(self):
+		'''
+		  ' Yields the (first_id, second_id, connection_id) rows of the
+			' current file (or of all files), streamed like iter_nodes().
+		'''
+		if self.session:
+			for cxn in self.session.list_connections():
+				yield cxn
+			return
+
+		with database_cursor(self.database, stream=True, read_only=True) as cur:
+			if self.current_file():
+				cur.execute(self.database.compose('SELECT first_id, second_id, connection_id FROM {} WHERE parent_file_id=%s;', 'connections'), (self.file_id,))
 			else:
-				cur.execute(cmd)
+				cur.execute(self.database.compose('SELECT first_id, second_id, connection_id FROM {};', 'connections'))
+			for cxn in cur:
+				yield cxn
+
 
+	def snapshot(self, path):
+		'''
+		  ' Writes the current file to a binary snapshot (see
+			' social_snapshot) which can be memory-mapped with graph_snapshot.
+			'
+			' Returns:
+			'   0 = success
+			'   1 = no file is open
+			'   3 = permission error
+		'''
+		if not self.current_file():
+			self.ui.log_warning('Attempted to write a snapshot, but no file is open')
+			return 1
+
+		try:
+			counts = write_snapshot(self, path)
+		except PermissionError:
+			self.ui.log_error('Could not write snapshot to ' + str(path) + ' due to permission error!')
+			return 3
+		self.ui.log('Wrote snapshot of ' + str(counts[0]) + ' node(s) and ' + str(counts[1]) + ' connection(s) to ' + str(path))
+		return 0
+
+
+	def list_tag_names(self):
+		'''
+		  ' Returns the distinct tag names used in the current file.
+		'''
+		with database_cursor(self.database, read_only=True) as cur:
+			cur.execute(self.database.compose('SELECT DISTINCT name FROM {} WHERE parent_file_id=%s ORDER BY name;', 'tags'), (self.file_id,))
+			return [row[0] for row in cur.fetchall()]
+
+
+	def __iter_tagged(self, template, table, id_count):
+		'''
+		  ' Streams rows of (ids..., tag name, tag contents), ordered by the
+			' first id, and groups them into (ids..., {tag name: contents}).
+		'''
+		with database_cursor(self.database, stream=True, read_only=True) as cur:
+			cur.execute(self.database.compose(template, table, 'tag_associations', 'tags'), (self.file_id,))
+			current = None
+			tags = {}
+			for row in cur:
+				if current is None or row[0] != current[0]:
+					if current is not None:
+						yield current + (tags,)
+					current = tuple(row[:id_count])
+					tags = {}
+				if row[id_count] is not None:
+					tags[row[id_count]] = row[id_count + 1]
+			if current is not None:
+				yield current + (tags,)
+
+
+	def iter_tagged_nodes(self):
+		'''
+		  ' Yields (id, name, {tag name: contents}) for every node in the
+			' current file, streamed from the database in id order.
+		'''
+		return self.__iter_tagged('SELECT n.id, n.name, t.name, t.contents FROM {} n LEFT JOIN {} a ON a.id = n.id LEFT JOIN {} t ON t.id = a.tag WHERE n.parent_file_id=%s ORDER BY n.id;', 'nodes', 2)
+
+
+	def iter_tagged_connections(self):
+		'''
+		  ' Yields (connection_id, first_id, second_id, {tag name: contents})
+			' for every connection in the current file, streamed from the
+			' database in id order.
+		'''
+		return self.__iter_tagged('SELECT c.connection_id, c.first_id, c.second_id, t.name, t.contents FROM {} c LEFT JOIN {} a ON a.id = c.connection_id LEFT JOIN {} t ON t.id = a.tag WHERE c.parent_file_id=%s ORDER BY c.connection_id;', 'connections', 3)
+
+
+	def export(self, fmt, path, compress=None):
+		'''
+		  ' Streams the current file, with its tags, to a graph file.
+			'
+			' Parameters:
+			'   fmt = one of EXPORT_FORMATS (graphml, gexf, dot, jsonl)
+			'   path = output path
+			'   compress = gzip the output; if None, gzip when path ends in .gz
+			'
+			' Returns:
+			'   0 = success
+			'   1 = no file is open
+			'   2 = unknown format, or unsaved changes could not be flushed
+			'   3 = permission error
+		'''
+		if not self.current_file():
+			self.ui.log_warning('Attempted to export, but no file is open')
+			return 1
+		if fmt not in EXPORT_FORMATS:
+			self.ui.log_error('Unknown export format "' + str(fmt) + '"')
+			return 2
+		if self.flush() != 0:
+			self.ui.log_error('Could not save pending changes before exporting.')
+			return 2
+
+		try:
+			with open_export_file(path, compress) as out:
+				counts = export_graph(self, fmt, out)
+		except PermissionError:
+			self.ui.log_error('Could not write export to ' + str(path) + ' due to permission error!')
+			return 3
+		self.ui.log('Exported ' + str(counts[0]) + ' node(s) and ' + str(counts[1]) + ' connection(s) to ' + str(path))
+		return 0
+
+
+	def find_duplicates(self):
+		'''
+		  ' Finds groups of same-named nodes in the current file with a single
+			' GROUP BY query.
+			'
+			' Returns: a list of (name, count, survivor id) rows, largest groups
+			'   first. The survivor is the node the others would be merged into
+			'   by merge_duplicates(). Returns None if no file is open.
+		'''
+		if not self.current_file():
+			self.ui.log_warning('Attempted to look for duplicates, but no file is open')
+			return None
+		if self.flush() != 0:
+			self.ui.log_warning('Unsaved changes could not be flushed; looking for duplicates in the saved file only')
+
+		with database_cursor(self.database) as cur:
+			cur.execute(self.database.compose('SELECT name, count(*), min(id) FROM {} WHERE parent_file_id=%s GROUP BY name HAVING count(*) > 1 ORDER BY count(*) DESC, name;', 'nodes'), (self.file_id,))
 			return cur.fetchall()
-	
 
-	def list_files(self):
-		cmd = sql.SQL('SELECT name, id FROM {};').format(sql.Identifier(self.database.tablify('files')))
+
+	def merge_duplicates(self):
+		'''
+		  ' Merges every group of same-named nodes in the current file into
+			' one survivor (the node with the lowest id), set-based and in one
+			' transaction:
+			'   - a temporary table maps each duplicate to its survivor
+			'   - connections and tag associations are repointed through it
+			'   - self-loops and duplicate connections left behind are removed
+			'   - the duplicate nodes are deleted
+			'
+			' Returns: a dict counting the merged nodes ('merged'), rewritten
+			'   connection endpoints ('rewritten'), removed self-loops
+			'   ('self_loops') and removed duplicate connections
+			'   ('duplicate_connections'), or None if no file is open or the
+			'   merge failed (in which case nothing was changed).
+		'''
+		if not self.current_file():
+			self.ui.log_warning('Attempted to merge duplicates, but no file is open')
+			return None
+		if self.flush() != 0:
+			self.ui.log_error('Could not save pending changes before merging duplicates.')
+			return None
+
+		report = {}
+		file_id = self.file_id
+		self.ui.log('Merging duplicate nodes in file ' + str(file_id))
+		try:
+			with database_cursor(self.database) as cur:
+				self.database.lock(cur, 'file', file_id)
+				cur.execute('CREATE TEMP TABLE pysocial_merge_map (old_id BIGINT PRIMARY KEY, new_id BIGINT);')
+				cur.execute(self.database.compose('INSERT INTO pysocial_merge_map (old_id, new_id) SELECT n.id, d.survivor FROM {} n JOIN (SELECT name, min(id) AS survivor FROM {} WHERE parent_file_id=%s GROUP BY name HAVING count(*) > 1) d ON d.name = n.name WHERE n.parent_file_id=%s AND n.id <> d.survivor;', 'nodes', 'nodes'), (file_id, file_id))
+				report['merged'] = cur.rowcount
+
+				report['rewritten'] = 0
+				for column in ('first_id', 'second_id'):
+					cur.execute(self.database.compose('UPDATE {} SET ' + column + ' = (SELECT new_id FROM pysocial_merge_map WHERE old_id = ' + column + ') WHERE parent_file_id=%s AND ' + column + ' IN (SELECT old_id FROM pysocial_merge_map);', 'connections'), (file_id,))
+					report['rewritten'] = report['rewritten'] + cur.rowcount
+
+				cur.execute(self.database.compose('DELETE FROM {} WHERE parent_file_id=%s AND first_id = second_id;', 'connections'), (file_id,))
+				report['self_loops'] = cur.rowcount
+
+				cur.execute(self.database.compose('DELETE FROM {} AS c WHERE c.parent_file_id=%s AND EXISTS (SELECT 1 FROM {} d WHERE d.parent_file_id=%s AND d.connection_id < c.connection_id AND ((d.first_id = c.first_id AND d.second_id = c.second_id) OR (d.first_id = c.second_id AND d.second_id = c.first_id)));', 'connections', 'connections'), (file_id, file_id))
+				report['duplicate_connections'] = cur.rowcount
+
+				cur.execute(self.database.compose('UPDATE {} SET id = (SELECT new_id FROM pysocial_merge_map WHERE old_id = id) WHERE id IN (SELECT old_id FROM pysocial_merge_map);', 'tag_associations'))
+				cur.execute(self.database.compose('DELETE FROM {} WHERE parent_file_id=%s AND id IN (SELECT old_id FROM pysocial_merge_map);', 'nodes'), (file_id,))
+				cur.execute(self.database.compose('DELETE FROM {} WHERE node_id IN (SELECT old_id FROM pysocial_merge_map);', 'node_metrics'))
+
+				cur.execute('DROP TABLE pysocial_merge_map;')
+				self.__recompute_file_stats(cur, file_id)
+				if report['merged'] or report['self_loops'] or report['duplicate_connections']:
+					self.__bump_version(cur, file_id)
+				self.database.commit()
+		except self.database.database_error as err:
+			self.database.rollback()
+			self.ui.log_error('Could not merge duplicates: ' + str(err))
+			return None
+
+		if self.session:
+			self.__load_session()
+		return report
+
+
+	'''
+	  ' Set differences used by diff. Both take (file id, other file id)
+		' and return the rows of the first file missing from the other:
+		' node names, or connections as endpoint-name pairs ordered so that
+		' direction does not matter.
+	'''
+	_EDGE_NAMES = 'SELECT CASE WHEN a.name <= b.name THEN a.name ELSE b.name END AS lo, CASE WHEN a.name <= b.name THEN b.name ELSE a.name END AS hi FROM {} c JOIN {} a ON a.id = c.first_id AND a.parent_file_id = c.parent_file_id JOIN {} b ON b.id = c.second_id AND b.parent_file_id = c.parent_file_id WHERE c.parent_file_id=%s'
+	DIFF_SQL = {
+		'nodes':('SELECT name FROM {} WHERE parent_file_id=%s EXCEPT SELECT name FROM {} WHERE parent_file_id=%s', ('nodes', 'nodes')),
+		'edges':(_EDGE_NAMES + ' EXCEPT ' + _EDGE_NAMES, ('connections', 'nodes', 'nodes', 'connections', 'nodes', 'nodes'))
+	}
+
+
+	def iter_diff(self, old_name, new_name):
+		'''
+		  ' Compares two files inside the database and streams the
+			' differences, as ('node', '+' or '-', name) and ('edge', '+' or
+			' '-', name, name) tuples. '+' means present only in the new file.
+			'
+			' Returns: the generator, or None if either file could not be found
+		'''
+		old_file = self.__find_one_file(old_name)
+		new_file = self.__find_one_file(new_name)
+		if not (old_file and new_file):
+			return None
+		if self.file_id in (old_file[1], new_file[1]) and self.flush() != 0:
+			self.ui.log_warning('Unsaved changes could not be flushed; comparing the saved files only')
+		return self.__iter_diff(old_file[1], new_file[1])
+
+
+	def __iter_diff(self, old_id, new_id):
+		for kind in ('nodes', 'edges'):
+			template, tables = self.DIFF_SQL[kind]
+			query = self.database.compose(template + ' ORDER BY 1;', *tables)
+			for sign, first, second in (('-', old_id, new_id), ('+', new_id, old_id)):
+				with database_cursor(self.database, stream=True) as cur:
+					cur.execute(query, (first, second))
+					for row in cur:
+						yield (kind[:-1], sign) + tuple(row)
+
+
+	def diff_to_file(self, old_name, new_name, delta_name):
+		'''
+		  ' Compares two files and writes the differences to a new file, all
+			' inside the database in one transaction. The new file holds every
+			' added or removed node and connection (plus the endpoints of those
+			' connections), with a 'color' tag of green for added and red for
+			' removed elements.
+			'
+			' Returns: a dict counting 'added_nodes', 'removed_nodes',
+			'   'added_edges' and 'removed_edges', or None if a file could not
+			'   be found, the delta file already exists or the database failed.
+		'''
+		old_file = self.__find_one_file(old_name)
+		new_file = self.__find_one_file(new_name)
+		if not (old_file and new_file):
+			return None
+		if self.find_files(delta_name):
+			self.ui.log_warning('A file named "' + str(delta_name) + '" already exists')
+			return None
+		if self.file_id in (old_file[1], new_file[1]) and self.flush() != 0:
+			self.ui.log_warning('Unsaved changes could not be flushed; comparing the saved files only')
+
+		old_id = old_file[1]
+		new_id = new_file[1]
+		delta_id = random.randint(-1*sys.maxsize, sys.maxsize)
+		added_tag = random.randint(-1*sys.maxsize, sys.maxsize)
+		removed_tag = random.randint(-1*sys.maxsize, sys.maxsize)
+		rand = self.database.random_id_sql()
+		node_diff, node_tables = self.DIFF_SQL['nodes']
+		edge_diff, edge_tables = self.DIFF_SQL['edges']
+		report = {}
+		self.ui.log('Writing differences between files ' + str(old_id) + ' and ' + str(new_id) + ' to "' + str(delta_name) + '" with id ' + str(delta_id))
+		try:
+			with database_cursor(self.database) as cur:
+				if not self.__new_file(cur, delta_name, delta_id):
+					self.database.rollback()
+					self.ui.log_warning('A file named "' + str(delta_name) + '" already exists')
+					return None
+
+				cur.execute('CREATE TEMP TABLE pysocial_diff_nodes (name TEXT PRIMARY KEY, id BIGINT, change TEXT);')
+				cur.execute('CREATE TEMP TABLE pysocial_diff_edges (lo TEXT, hi TEXT, id BIGINT, change TEXT);')
+				for change, first, second in (('removed', old_id, new_id), ('added', new_id, old_id)):
+					cur.execute(self.database.compose('INSERT INTO pysocial_diff_nodes (name, id, change) SELECT name, ' + rand + ', %s FROM (' + node_diff + ') x;', *node_tables), (change, first, second))
+					report[change + '_nodes'] = cur.rowcount
+					cur.execute(self.database.compose('INSERT INTO pysocial_diff_edges (lo, hi, id, change) SELECT lo, hi, ' + rand + ', %s FROM (' + edge_diff + ') x;', *edge_tables), (change, first, second))
+					report[change + '_edges'] = cur.rowcount
+				cur.execute('INSERT INTO pysocial_diff_nodes (name, id, change) SELECT name, ' + rand + ', NULL FROM (SELECT lo AS name FROM pysocial_diff_edges UNION SELECT hi FROM pysocial_diff_edges) e WHERE name NOT IN (SELECT name FROM pysocial_diff_nodes);')
+
+				cur.execute(self.database.compose('INSERT INTO {} (name, id, parent_file_id) SELECT name, id, %s FROM pysocial_diff_nodes;', 'nodes'), (delta_id,))
+				cur.execute(self.database.compose('INSERT INTO {} (first_id, second_id, connection_id, parent_file_id) SELECT a.id, b.id, e.id, %s FROM pysocial_diff_edges e JOIN pysocial_diff_nodes a ON a.name = e.lo JOIN pysocial_diff_nodes b ON b.name = e.hi;', 'connections'), (delta_id,))
+
+				cur.execute(self.database.compose('INSERT INTO {} (name, id, contents, parent_file_id) VALUES (%s,%s,%s,%s), (%s,%s,%s,%s);', 'tags'), ('color', added_tag, 'green', delta_id, 'color', removed_tag, 'red', delta_id))
+				for change, tag in (('added', added_tag), ('removed', removed_tag)):
+					cur.execute(self.database.compose('INSERT INTO {} (id, tag) SELECT id, %s FROM pysocial_diff_nodes WHERE change = %s UNION ALL SELECT id, %s FROM pysocial_diff_edges WHERE change = %s;', 'tag_associations'), (tag, change, tag, change))
+
+				cur.execute('DROP TABLE pysocial_diff_nodes;')
+				cur.execute('DROP TABLE pysocial_diff_edges;')
+				self.__recompute_file_stats(cur, delta_id)
+				self.database.commit()
+		except self.database.database_error as err:
+			self.database.rollback()
+			self.ui.log_error('Could not write differences: ' + str(err))
+			return None
+		return report
+
+
+	def find_files(self, file_name):
+		'''
+		  ' Returns the (name, id) rows of all files with the given name.
+		'''
 		with database_cursor(self.database) as cur:
+			cur.execute(self.database.compose('SELECT name, id FROM {} WHERE name = %s;', 'files'), (str(file_name),))
+			return cur.fetchall()
+
+
+	def __find_one_file(self, file_name):
+		files = self.find_files(file_name)
+		if len(files) == 0:
+			self.ui.log_warning('File not found with name "' + str(file_name) + '"')
+			return None
+		elif len(files) > 1:
+			self.ui.log_warning('Name conflict: ' + str(len(files)) + ' files have the same name "' + str(file_name) + '"')
+			return None
+		return files[0]
+
+
+	def clone_file(self, source_name, destination_name):
+		'''
+		  ' Copies a file, with all of its nodes, connections and tags, to a
+			' new file. Everything happens inside the database in one
+			' transaction: a temporary table maps every old id to a new random
+			' id (keeping the discriminator, for nodes), and each table is
+			' copied with a single INSERT ... SELECT through that mapping, so
+			' no rows travel through the client.
+			'
+			' Returns:
+			'   0 = success
+			'   1 = source file not found (or ambiguous)
+			'   2 = destination file already exists
+			'   3 = database error; nothing was changed
+		'''
+		source = self.__find_one_file(source_name)
+		if not source:
+			return 1
+		if self.find_files(destination_name):
+			self.ui.log_warning('A file named "' + str(destination_name) + '" already exists')
+			return 2
+		if source[1] == self.file_id and self.flush() != 0:
+			self.ui.log_error('Could not save pending changes before cloning.')
+			return 3
+
+		source_id = source[1]
+		destination_id = random.randint(-1*sys.maxsize, sys.maxsize)
+		new_id = self.database.random_id_sql()
+		self.ui.log('Cloning file ' + str(source_id) + ' to "' + str(destination_name) + '" with id ' + str(destination_id))
+		try:
+			with database_cursor(self.database) as cur:
+				if not self.__new_file(cur, destination_name, destination_id):
+					self.database.rollback()
+					self.ui.log_warning('A file named "' + str(destination_name) + '" already exists')
+					return 2
+				self.database.lock(cur, 'file', source_id)
+				cur.execute('CREATE TEMP TABLE pysocial_id_map (old_id BIGINT PRIMARY KEY, new_id BIGINT);')
+				# Cloned nodes keep their discriminators (see discriminator()), so
+				# they cannot collide in the (parent_file_id, name, discrim) index
+				new_node_id = '(CASE WHEN id < 0 THEN -1 ELSE 1 END) * ((abs(' + new_id + ') % ' + str(sys.maxsize // DISCRIM_MODULUS) + ') * ' + str(DISCRIM_MODULUS) + ' + abs(id) % ' + str(DISCRIM_MODULUS) + ')'
+				cur.execute(self.database.compose('INSERT INTO pysocial_id_map (old_id, new_id) SELECT id, ' + new_node_id + ' FROM {} WHERE parent_file_id=%s;', 'nodes'), (source_id,))
+				cur.execute(self.database.compose('INSERT INTO pysocial_id_map (old_id, new_id) SELECT connection_id, ' + new_id + ' FROM {} WHERE parent_file_id=%s;', 'connections'), (source_id,))
+				cur.execute(self.database.compose('INSERT INTO pysocial_id_map (old_id, new_id) SELECT id, ' + new_id + ' FROM {} WHERE parent_file_id=%s;', 'tags'), (source_id,))
+
+				cur.execute(self.database.compose('INSERT INTO {} (name, id, parent_file_id) SELECT n.name, m.new_id, %s FROM {} n JOIN pysocial_id_map m ON m.old_id = n.id WHERE n.parent_file_id=%s;', 'nodes', 'nodes'), (destination_id, source_id))
+				cur.execute(self.database.compose('INSERT INTO {} (first_id, second_id, connection_id, parent_file_id) SELECT COALESCE(f.new_id, c.first_id), COALESCE(s.new_id, c.second_id), m.new_id, %s FROM {} c JOIN pysocial_id_map m ON m.old_id = c.connection_id LEFT JOIN pysocial_id_map f ON f.old_id = c.first_id LEFT JOIN pysocial_id_map s ON s.old_id = c.second_id WHERE c.parent_file_id=%s;', 'connections', 'connections'), (destination_id, source_id))
+				cur.execute(self.database.compose('INSERT INTO {} (name, id, contents, parent_file_id) SELECT t.name, m.new_id, t.contents, %s FROM {} t JOIN pysocial_id_map m ON m.old_id = t.id WHERE t.parent_file_id=%s;', 'tags', 'tags'), (destination_id, source_id))
+				cur.execute(self.database.compose('INSERT INTO {} (id, tag) SELECT e.new_id, g.new_id FROM {} a JOIN pysocial_id_map g ON g.old_id = a.tag JOIN pysocial_id_map e ON e.old_id = a.id;', 'tag_associations', 'tag_associations'))
+
+				cur.execute('DROP TABLE pysocial_id_map;')
+				self.__recompute_file_stats(cur, destination_id)
+				self.database.commit()
+		except self.database.database_error as err:
+			self.database.rollback()
+			self.ui.log_error('Could not clone file: ' + str(err))
+			return 3
+		return 0
+
+
+	def delete_file(self, file_name):
+		'''
+		  ' Deletes a file with all of its nodes, connections, tags and tag
+			' associations, using one set-based DELETE per table in a single
+			' transaction. Tables which are LIST-partitioned by file simply have
+			' the file's partition dropped. If the file is open, it is closed first and any
+			' unsaved changes to it are dropped.
+			'
+			' Returns:
+			'   0 = success
+			'   1 = file not found (or ambiguous)
+			'   3 = database error; nothing was changed
+		'''
+		target = self.__find_one_file(file_name)
+		if not target:
+			return 1
+		file_id = target[1]
+		if file_id == self.file_id:
+			self.session = None
+			self.file_name = None
+			self.file_id = None
+
+		self.ui.log('Deleting file ' + str(file_id))
+		try:
+			with database_cursor(self.database) as cur:
+				self.database.lock(cur, 'file', file_id)
+				cur.execute(self.database.compose('DELETE FROM {} WHERE tag IN (SELECT id FROM {} WHERE parent_file_id=%s) OR id IN (SELECT id FROM {} WHERE parent_file_id=%s) OR id IN (SELECT connection_id FROM {} WHERE parent_file_id=%s);', 'tag_associations', 'tags', 'nodes', 'connections'), (file_id, file_id, file_id))
+				dropped = self.database.drop_file_partitions(cur, file_id)
+				for table in ('tags', 'connections', 'nodes', 'node_degrees', 'node_metrics'):
+					if table not in dropped:
+						cur.execute(self.database.compose('DELETE FROM {} WHERE parent_file_id=%s;', table), (file_id,))
+				cur.execute(self.database.compose('DELETE FROM {} WHERE file_id=%s;', 'file_stats'), (file_id,))
+				cur.execute(self.database.compose('DELETE FROM {} WHERE id=%s;', 'files'), (file_id,))
+				self.database.notify(cur, file_id, 'deleted')
+				self.database.commit()
+		except self.database.database_error as err:
+			self.database.rollback()
+			self.ui.log_error('Could not delete file: ' + str(err))
+			return 3
+		return 0
+
+
+	def list_files(self):
+		cmd = self.database.compose('SELECT name, id FROM {};', 'files')
+		with database_cursor(self.database, read_only=True) as cur:
 			cur.execute(cmd)
 			return cur.fetchall()
 
@@ -0,0 +1,357 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import asyncpg
+import json
+import random
+import re
+import sys
+
+from social import NODE_ID_ATTEMPTS, name_conflict_error, resolve_node
+from social_db import advisory_key, change_channel, partition_name
+from social_ui import none_ui
+
+'''
+  ' Config structure (in addition to the keys used by database_io)
+	' {
+	'   async_pool_min = minimum number of pooled connections (default 1)
+	'   async_pool_max = maximum number of pooled connections (default 10)
+	' }
+'''
+
+
+class file_handle:
+	'''
+	  ' An open file in async_database_io. Unlike database_io, which keeps
+		' one current file per object, every async operation takes the
+		' handle of the file it works on, so any number of files can be
+		' used concurrently through the same pool.
+	'''
+	def __init__(self, file_name, file_id):
+		self.file_name = file_name
+		self.file_id = file_id
+
+	def __repr__(self):
+		return 'file_handle(' + repr(self.file_name) + ', ' + str(self.file_id) + ')'
+
+
+
+class async_database_io:
+	'''
+	  ' asyncio counterpart of database_io for services which serve many
+		' independent requests at once. Statements run on connections
+		' borrowed from an asyncpg pool, so hundreds of concurrent coroutines
+		' can share a handful of connections without threads.
+		'
+		' The tables must already exist - run the console (or database_io)
+		' once to initialize the database.
+		'
+		'    io = async_database_io(configurer())
+		'    await io.begin()
+		'    handle = await io.open_file_by_name('friends')
+		'    await io.add_node(handle, 'alice')
+		'    await io.end()
+	'''
+
+	def __init__(self, configurer_object, ui=None):
+		self.config = configurer_object
+		self.pool = None
+		if 'table_prefix' in self.config.config:
+			self.table_prefix = self.config.config['table_prefix']
+		else:
+			self.table_prefix = ""
+		self.statements = {}
+		self.list_partitioned = []
+		if ui:
+			self.ui = ui
+		else:
+			self.ui = none_ui()
+
+	def hook_ui(self, ui_to_hook):
+		if ui_to_hook:
+			self.ui = ui_to_hook
+			return 0
+		else:
+			return 1
+
+	def is_connected(self):
+		if self.pool:
+			return True
+		else:
+			return False
+
+	async def begin(self):
+		'''
+		  ' Opens the connection pool and checks that the tables exist.
+			'
+			' Returns:
+			'   0 = success
+			'   1-3 = could not load social-tables.json (as database_io.begin)
+			'   4 = could not connect, or the tables are missing
+		'''
+		self.ui.log('Loading schema from social-tables.json...')
+		try:
+			with open('social-tables.json') as tables:
+				self.schema = json.load(tables)
+		except FileNotFoundError:
+			self.ui.log_error('Could not find social-tables.json! Aborting connection!')
+			return 1
+		except json.decoder.JSONDecodeError:
+			self.ui.log_error('Could not parse social-tables.json! Aborting connection!')
+			return 2
+		except PermissionError:
+			self.ui.log_error('Could not open social-tables.json due to permission error! Aborting connection!')
+			return 3
+
+		cfg = self.config.config
+		self.ui.log('Opening connection pool to database ' + str(cfg['db_name']) + ' at ' + str(cfg['db_host']) + ':' + str(cfg['db_port']) + ' as user ' + str(cfg['db_user']))
+		try:
+			self.pool = await asyncpg.create_pool(database=cfg['db_name'], user=cfg['db_user'], password=cfg['db_password'], host=cfg['db_host'], port=int(cfg['db_port']), min_size=cfg.get('async_pool_min', 1), max_size=cfg.get('async_pool_max', 10))
+		except (OSError, asyncpg.PostgresError) as err:
+			self.ui.log_error('Failed to connect to database: ' + str(err))
+			return 4
+
+		expected = [self.tablify(table['name']) for table in self.schema]
+		rows = await self.pool.fetch("SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE' AND table_schema = 'public' AND table_name = ANY($1::text[]);", expected)
+		present = set(row[0] for row in rows)
+		for tname in expected:
+			if tname not in present:
+				self.ui.log_error('Missing table ' + tname + '! Initialize the database with the console first.')
+				await self.end()
+				return 4
+
+		# Files get their own partitions of list-partitioned tables, as in
+		# db_connect.setup_partitions()
+		rows = await self.pool.fetch("SELECT c.relname FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE p.partstrat = 'l' AND c.relname = ANY($1::text[]);", expected)
+		listed = set(row[0] for row in rows)
+		self.list_partitioned = [tname for tname in expected if tname in listed]
+		return 0
+
+	async def end(self):
+		if self.pool:
+			await self.pool.close()
+			self.pool = None
+
+	def tablify(self, tname):
+		return str(self.table_prefix) + str(tname)
+
+	def compose(self, template, *tables):
+		'''
+		  ' Same template format as db_backend.compose() ({} for tables, %s
+			' for parameters), converted to asyncpg's $1, $2, ... style. The
+			' result is cached, since templates are static.
+		'''
+		key = (template,) + tables
+		if key not in self.statements:
+			text = template.format(*['"' + self.tablify(table).replace('"', '""') + '"' for table in tables])
+			counter = iter(range(1, text.count('%s') + 1))
+			self.statements[key] = re.sub('%s', lambda match: '$' + str(next(counter)), text)
+		return self.statements[key]
+
+
+	async def lock(self, conn, kind, *key):
+		'''
+		  ' Same advisory locks as db_connect.lock(), held until conn's
+			' transaction ends.
+		'''
+		await conn.execute('SELECT pg_advisory_xact_lock($1, $2);', *advisory_key(self.table_prefix, kind, *key))
+
+
+	async def add_file_partitions(self, conn, file_id):
+		'''
+		  ' Creates a new file's partitions, like
+			' db_connect.add_file_partitions().
+		'''
+		for tname in self.list_partitioned:
+			await conn.execute('CREATE TABLE IF NOT EXISTS ' + partition_name(tname, file_id) + ' PARTITION OF ' + tname + ' FOR VALUES IN (' + str(int(file_id)) + ');')
+
+	async def count_changes(self, conn, file_id, nodes=0, first_id=None, second_id=None):
+		'''
+		  ' Keeps file_stats and node_degrees up to date and notifies
+			' listeners, like database_io: adds nodes to the file's node
+			' count, and a connection between first_id and second_id if they
+			' are given.
+		'''
+		await conn.execute(self.compose('INSERT INTO {} AS t (file_id, node_count, connection_count, change_count) VALUES (%s,%s,%s,0) ON CONFLICT (file_id) DO UPDATE SET node_count = t.node_count + excluded.node_count, connection_count = t.connection_count + excluded.connection_count, change_count = t.change_count + 1;', 'file_stats'), file_id, nodes, 0 if first_id is None else 1)
+		await conn.execute('SELECT pg_notify($1, $2);', change_channel(self.table_prefix, file_id), 'changed')
+		if first_id is not None:
+			cmd = self.compose('INSERT INTO {} AS t (node_id, parent_file_id, degree) VALUES (%s,%s,%s) ON CONFLICT (node_id) DO UPDATE SET degree = t.degree + excluded.degree;', 'node_degrees')
+			if first_id == second_id:
+				await conn.execute(cmd, first_id, file_id, 2)
+			else:
+				await conn.execute(cmd, first_id, file_id, 1)
+				await conn.execute(cmd, second_id, file_id, 1)
+
+
+	async def create_file(self, file_name, file_id=None):
+		'''
+		  ' Returns: the new file's id, or None if a file with that name
+			'   already exists
+		'''
+		if not file_id:
+			file_id = random.randint(-1*sys.maxsize, sys.maxsize)
+			self.ui.log_debug('Generated id ' + str(file_id))
+
+		async with self.pool.acquire() as conn:
+			async with conn.transaction():
+				await self.lock(conn, 'file_name', str(file_name))
+				if await conn.fetch(self.compose('SELECT id FROM {} WHERE name = %s;', 'files'), str(file_name)):
+					return None
+				await conn.execute(self.compose('INSERT INTO {} (name, id) VALUES (%s,%s);', 'files'), str(file_name), file_id)
+				await self.add_file_partitions(conn, file_id)
+				await self.count_changes(conn, file_id)
+		return file_id
+
+	async def open_file_by_name(self, file_name, create=True):
+		'''
+		  ' Returns: a file_handle, or None if the file does not exist (and
+			'   create is False) or the name is ambiguous.
+		'''
+		self.ui.log('Searching for file named "' + str(file_name) + '"')
+		async with self.pool.acquire() as conn:
+			async with conn.transaction():
+				if create:
+					# Held until the file is created, so that concurrent
+					# callers can't both create it
+					await self.lock(conn, 'file_name', str(file_name))
+				res = await conn.fetch(self.compose('SELECT name, id FROM {} WHERE name = %s;', 'files'), str(file_name))
+				if len(res) == 1:
+					self.ui.log('File found with id ' + str(res[0][1]))
+					return file_handle(res[0][0], res[0][1])
+				elif len(res) > 1:
+					self.ui.log_warning('Name conflict: files with ids ' + ' '.join(str(r[1]) for r in res) + ' have the same name "' + str(file_name) + '"')
+					return None
+				self.ui.log_warning('File not found with name "' + str(file_name) + '"')
+				if not create:
+					return None
+				file_id = random.randint(-1*sys.maxsize, sys.maxsize)
+				await conn.execute(self.compose('INSERT INTO {} (name, id) VALUES (%s,%s);', 'files'), str(file_name), file_id)
+				await self.add_file_partitions(conn, file_id)
+				await self.count_changes(conn, file_id)
+		self.ui.log_warning('Created file with id ' + str(file_id))
+		return file_handle(str(file_name), file_id)
+
+	async def open_file_by_id(self, file_id):
+		'''
+		  ' Returns: a file_handle, or None if there is no such file.
+		'''
+		self.ui.log('Searching for file with id ' + str(file_id))
+		row = await self.pool.fetchrow(self.compose('SELECT name, id FROM {} WHERE id = %s;', 'files'), int(file_id))
+		if row:
+			self.ui.log('File found with name "' + str(row[0]) + '"')
+			return file_handle(row[0], row[1])
+		self.ui.log_warning('File not found with id ' + str(file_id))
+		return None
+
+
+	async def add_node(self, handle, node_name):
+		'''
+		  ' Returns: the new node's id, or None if no free id was found
+		'''
+		async with self.pool.acquire() as conn:
+			for attempt in range(NODE_ID_ATTEMPTS):
+				node_id = random.randint(-1*sys.maxsize, sys.maxsize)
+				self.ui.log('Adding node named "' + str(node_name) + '" as id ' + str(node_id) + ' with parent file id ' + str(handle.file_id))
+				try:
+					async with conn.transaction():
+						await conn.execute(self.compose('INSERT INTO {}(name, id, parent_file_id) VALUES (%s,%s,%s);', 'nodes'), str(node_name), node_id, handle.file_id)
+						await self.count_changes(conn, handle.file_id, nodes=1)
+				except asyncpg.UniqueViolationError:
+					# id or (name, discrim) taken; see database_io.add_node()
+					continue
+				return node_id
+		self.ui.log_error('Could not find a free id for node "' + str(node_name) + '"')
+		return None
+
+	async def lookup_node_by_name(self, handle, node_name, node_discrim=None):
+		'''
+		  ' Returns: the (name, id) of the node, or None. Raises
+			'   name_conflict_error if the name is ambiguous.
+		'''
+		if node_discrim is None:
+			rows = await self.pool.fetch(self.compose('SELECT name, id FROM {} WHERE parent_file_id=%s AND name=%s;', 'nodes'), handle.file_id, str(node_name))
+		else:
+			rows = await self.pool.fetch(self.compose('SELECT name, id FROM {} WHERE parent_file_id=%s AND name=%s AND discrim=%s;', 'nodes'), handle.file_id, str(node_name), int(node_discrim))
+		return resolve_node(self.ui, [tuple(row) for row in rows], node_name, node_discrim)
+
+	async def add_connection_by_id(self, handle, origin_id, destination_id, conn=None):
+		connection_id = random.randint(-1*sys.maxsize, sys.maxsize)
+		self.ui.log('Connecting ' + str(origin_id) + ' to ' + str(destination_id) + ' with connection id ' + str(connection_id))
+		cmd = self.compose('INSERT INTO {} (first_id, second_id, connection_id, parent_file_id) VALUES (%s,%s,%s,%s);', 'connections')
+		if conn:
+			await conn.execute(cmd, int(origin_id), int(destination_id), connection_id, handle.file_id)
+			await self.count_changes(conn, handle.file_id, first_id=int(origin_id), second_id=int(destination_id))
+		else:
+			async with self.pool.acquire() as conn:
+				async with conn.transaction():
+					await conn.execute(cmd, int(origin_id), int(destination_id), connection_id, handle.file_id)
+					await self.count_changes(conn, handle.file_id, first_id=int(origin_id), second_id=int(destination_id))
+		return 0
+
+	async def add_connection_by_name(self, handle, origin_name, destination_name, origin_discrim=None, destination_discrim=None):
+		'''
+		  ' Returns:
+			'   0 = success
+			'   1 = could not identify the nodes
+			'   2 = the connection already exists
+		'''
+		origin = await self.lookup_node_by_name(handle, origin_name, origin_discrim)
+		destination = await self.lookup_node_by_name(handle, destination_name, destination_discrim)
+		if not (origin and destination):
+			self.ui.log_error('Could not identify nodes to connect.')
+			return 1
+
+		async with self.pool.acquire() as conn:
+			async with conn.transaction():
+				await self.lock(conn, 'pair', min(origin[1], destination[1]), max(origin[1], destination[1]))
+				cmd = self.compose('SELECT connection_id FROM {} WHERE (first_id=%s AND second_id=%s) OR (first_id=%s AND second_id=%s);', 'connections')
+				if await conn.fetchval(cmd, origin[1], destination[1], destination[1], origin[1]) is not None:
+					self.ui.log_warning('Connection between "' + str(origin_name) + '" and "' + str(destination_name) + '" already exists.')
+					return 2
+				await self.add_connection_by_id(handle, origin[1], destination[1], conn=conn)
+		return 0
+
+
+	async def list_nodes(self, handle=None):
+		'''
+		  ' Returns: (name, id) rows for the file, or for all files if handle
+			'   is None
+		'''
+		if handle:
+			rows = await self.pool.fetch(self.compose('SELECT name, id FROM {} WHERE parent_file_id=%s;', 'nodes'), handle.file_id)
+		else:
+			rows = await self.pool.fetch(self.compose('SELECT name, id FROM {};', 'nodes'))
+		return [tuple(row) for row in rows]
+
+	async def list_connections(self, handle=None):
+		'''
+		  ' Returns: (first_id, second_id, connection_id) rows for the file,
+			'   or for all files if handle is None
+		'''
+		if handle:
+			rows = await self.pool.fetch(self.compose('SELECT first_id, second_id, connection_id FROM {} WHERE parent_file_id=%s;', 'connections'), handle.file_id)
+		else:
+			rows = await self.pool.fetch(self.compose('SELECT first_id, second_id, connection_id FROM {};', 'connections'))
+		return [tuple(row) for row in rows]
+
+	async def list_files(self):
+		rows = await self.pool.fetch(self.compose('SELECT name, id FROM {};', 'files'))
+		return [tuple(row) for row in rows]
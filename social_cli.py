@@ -19,6 +19,33 @@ along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
 
+import sys
+
+'''
+  ' Usage:
+	'   python social_cli.py
+	'       interactive console
+	'   python social_cli.py -serve [socket path]
+	'       keep running and serve commands over a Unix socket
+	'   python social_cli.py -connect [-socket <path>] [command ...]
+	'       run a command on the server (or, with no command, every line of
+	'       standard input) and print the output
+'''
+
+args = sys.argv[1:]
+if args and args[0] == '-connect':
+	# The client skips importing the rest of pysocial, so it starts quickly
+	from social_server import run_client
+	path = None
+	args = args[1:]
+	if len(args) >= 2 and args[0] == '-socket':
+		path = args[1]
+		args = args[2:]
+	commands = None
+	if args:
+		commands = [' '.join(args)]
+	sys.exit(run_client(path, commands))
+
 from social import configurer, database_io
 from social_renderer import renderer
 from social_ui import basic_console_ui
@@ -27,7 +54,11 @@ config = configurer()
 db_io = database_io(config)
 rend = renderer(db_io, config)
 u = basic_console_ui(config, db_io, rend)
-if u.begin() == 0:
-	u.loop()
-else:
+if u.begin() != 0:
 	u.log_severe('Fatal error!')
+elif args and args[0] == '-serve':
+	from social_server import command_server
+	server = command_server(config, db_io, rend, u, args[1] if len(args) > 1 else None)
+	sys.exit(server.serve_forever())
+else:
+	u.loop()
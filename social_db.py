@@ -23,8 +23,13 @@ import pygraphviz as pgv
 import psycopg2
 from psycopg2 import sql
 import json
+import re
+import select
+import time
+import zlib
 
-from social_ui import ui
+from social_ui import ui, polymorphism_error
+from social_stats import query_stats
 
 '''
   ' Config structure
@@ -34,8 +39,36 @@ from social_ui import ui
 	'   db_password = password for above
 	'   db_host = host to connect to for postgresql database
 	'   db_port = port for above
+	'
+	'   db_backend = 'postgresql' (default) or 'sqlite'
+	'   db_path = database file for the sqlite backend (default: social.db)
 	'   
 	'   table_prefix = text to prepend to tables (for shared databases)
+	'
+	'   instrument = if true, record per-statement query statistics from
+	'                startup (see the `stats` command)
+	'
+	'   prepare_threshold = postgresql only: run a statement as a
+	'                       server-side prepared statement once it has
+	'                       been executed this many times (default 2,
+	'                       0 = never, e.g. behind a transaction-pooling
+	'                       proxy)
+	'
+	'   db_replicas = postgresql only: read replicas (streaming standbys)
+	'                 of the database above, as a list of libpq connection
+	'                 strings or of dicts overriding db_host, db_port,
+	'                 db_name, db_user and db_password. Listing, rendering
+	'                 and analytics reads are spread over them
+	'                 round-robin; everything else uses the primary.
+	'   replica_read_after_write = seconds after each commit during which
+	'                              reads stay on the primary, so that a
+	'                              session sees its own writes (default 5)
+	'   replica_max_lag = skip replicas which are more than this many
+	'                     seconds behind the primary (default: no limit)
+	'   replica_check_interval = how often a replica in use is checked
+	'                            (default 5 seconds)
+	'   replica_retry = seconds before a replica which failed is tried
+	'                   again (default 30)
 	' }
 '''
 
@@ -48,12 +81,28 @@ class database_cursor:
 		'      do_things_with(cursor)
 		'     
 		'    do_other_things() # Cursor object is closed before this line
+		'
+		' With stream=True, db must be a db_backend, and the cursor fetches
+		' rows from the server in batches as it is iterated instead of
+		' loading the whole result set at once.
+		'
+		' With read_only=True, db must be a db_backend, and the statements
+		' may run on a read replica (see db_backend.read_cursor). Only use
+		' it for statements which write nothing and need not see the
+		' current transaction's writes.
 	'''
-	def __init__(self, db):
+	def __init__(self, db, stream=False, read_only=False):
 		self.db = db
+		self.stream = stream
+		self.read_only = read_only
 	
 	def __enter__(self):
-		self.cur = self.db.cursor()
+		if self.read_only:
+			self.cur = self.db.read_cursor(self.stream)
+		elif self.stream:
+			self.cur = self.db.stream_cursor()
+		else:
+			self.cur = self.db.cursor()
 		return self.cur
 	
 	def __exit__(self, xtype, xvalue, xtraceback):
@@ -61,6 +110,197 @@ class database_cursor:
 
 
 
+class instrumented_cursor:
+	'''
+	  ' Wraps a cursor, recording the latency of every execute() and the
+		' number of rows fetched against the statement's SQL template.
+		' Anything not overridden here is passed through to the real cursor.
+	'''
+	def __init__(self, cur, stats, db):
+		self.cur = cur
+		self.stats = stats
+		self.db = db
+		self.template = None
+
+	def execute(self, query, args=None):
+		self.template = self.db.sql_text(query)
+		start = time.perf_counter()
+		try:
+			if args is None:
+				return self.cur.execute(query)
+			return self.cur.execute(query, args)
+		finally:
+			self.stats.record_query(self.template, time.perf_counter() - start)
+
+	def fetchone(self):
+		row = self.cur.fetchone()
+		if row is not None:
+			self.stats.record_rows(self.template, 1)
+		return row
+
+	def fetchmany(self, size=None):
+		if size is None:
+			rows = self.cur.fetchmany()
+		else:
+			rows = self.cur.fetchmany(size)
+		self.stats.record_rows(self.template, len(rows))
+		return rows
+
+	def fetchall(self):
+		rows = self.cur.fetchall()
+		self.stats.record_rows(self.template, len(rows))
+		return rows
+
+	def __iter__(self):
+		for row in self.cur:
+			self.stats.record_rows(self.template, 1)
+			yield row
+
+	def __getattr__(self, attr):
+		return getattr(self.cur, attr)
+
+
+
+class prepared_cursor:
+	'''
+	  ' Wraps a PostgreSQL cursor, running statements from the backend's
+		' statement registry with EXECUTE once the backend has prepared them
+		' (see db_connect.prepared_name()). Everything else, and anything not
+		' overridden here, goes straight to the real cursor.
+	'''
+	def __init__(self, cur, db):
+		self.cur = cur
+		self.db = db
+
+	def execute(self, query, args=None):
+		name = self.db.prepared_name(self.cur, query)
+		if name is None:
+			if args is None:
+				return self.cur.execute(query)
+			return self.cur.execute(query, args)
+		if not args:
+			return self.cur.execute('EXECUTE ' + name + ';')
+		return self.cur.execute('EXECUTE ' + name + ' (' + ','.join(['%s'] * len(args)) + ');', args)
+
+	def __iter__(self):
+		return iter(self.cur)
+
+	def __getattr__(self, attr):
+		return getattr(self.cur, attr)
+
+
+
+def advisory_key(table_prefix, kind, *parts):
+	'''
+	  ' Maps a lock name to the (int, int) key of a PostgreSQL advisory
+		' lock. The table prefix is part of the key, so programs sharing a
+		' database under different prefixes never block each other (except
+		' for the rare hash collision, which only costs some waiting).
+	'''
+	def signed(value):
+		if value >= 2 ** 31:
+			return value - 2 ** 32
+		return value
+	return (signed(zlib.crc32((str(table_prefix) + ':' + str(kind)).encode('utf-8'))), signed(zlib.crc32(repr(parts).encode('utf-8'))))
+
+
+
+def change_channel(table_prefix, file_id):
+	'''
+	  ' Name of the NOTIFY channel announcing changes to a file.
+	'''
+	return str(table_prefix) + 'file_' + str(int(file_id))
+
+
+def partition_name(tname, file_id):
+	'''
+	  ' Name of a file's partition of a list-partitioned table.
+	'''
+	file_id = int(file_id)
+	if file_id < 0:
+		return tname + '_fn' + str(-file_id)
+	return tname + '_f' + str(file_id)
+
+
+
+class change_listener:
+	'''
+	  ' Waits for changes to one file by polling its change counter in
+		' file_stats. Used by backends without a change feed; see
+		' notify_listener for PostgreSQL.
+	'''
+	def __init__(self, backend, file_id, poll_interval=1.0):
+		self.backend = backend
+		self.file_id = file_id
+		self.poll_interval = poll_interval
+		self.last_count = self.change_count()
+
+	def change_count(self):
+		'''
+		  ' Returns the file's change counter, or None if the file is gone.
+		'''
+		with database_cursor(self.backend) as cur:
+			cur.execute(self.backend.compose('SELECT change_count FROM {} WHERE file_id=%s;', 'file_stats'), (self.file_id,))
+			row = cur.fetchone()
+		if row:
+			return row[0]
+		return None
+
+	def wait(self, timeout):
+		'''
+		  ' Blocks for up to timeout seconds.
+			'
+			' Returns: True if the file changed (or was deleted) since the
+			'   last call
+		'''
+		deadline = time.monotonic() + timeout
+		while True:
+			count = self.change_count()
+			if count != self.last_count:
+				self.last_count = count
+				return True
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				return False
+			time.sleep(min(self.poll_interval, remaining))
+
+	def close(self):
+		pass
+
+
+
+class notify_listener(change_listener):
+	'''
+	  ' Waits for changes to one file with LISTEN on its channel, on a
+		' dedicated connection: notifications are only delivered between
+		' transactions, and the main connection may sit in one.
+	'''
+	def __init__(self, backend, file_id, cfg):
+		self.backend = backend
+		self.file_id = file_id
+		self.conn = _pg_connect(cfg)
+		self.conn.autocommit = True
+		with self.conn.cursor() as cur:
+			cur.execute(sql.SQL('LISTEN {};').format(sql.Identifier(change_channel(backend.table_prefix, file_id))))
+		self.last_count = self.change_count()
+
+	def wait(self, timeout):
+		if select.select([self.conn], [], [], timeout) == ([], [], []):
+			return False
+		self.conn.poll()
+		changed = bool(self.conn.notifies)
+		del self.conn.notifies[:]
+		if changed:
+			# Whatever reacts to the change must not read from a replica
+			# which has not seen it yet
+			self.backend.note_write()
+		return changed
+
+	def close(self):
+		self.conn.close()
+
+
+
 class db_initialize_error(BaseException):
 	'''
 	  ' Raised when the database can't be initialized properly
@@ -68,7 +308,38 @@ class db_initialize_error(BaseException):
 
 
 
-class db_connect:
+def open_backend(ui, cfg, tables):
+	'''
+	  ' Opens a connection using the backend selected by the 'db_backend'
+		' config key.
+		'
+		' Parameters:
+		'   ui = UI object for user-interface
+		'   cfg = configuration dict
+		'   tables = expected schema dict loaded from social-tables.json
+		'
+		' Returns: a connected db_backend object
+	'''
+	backend = cfg.get('db_backend', 'postgresql')
+	if backend in ('postgresql', 'postgres'):
+		return db_connect(ui, cfg, tables)
+	elif backend == 'sqlite':
+		from social_sqlite import sqlite_connect
+		return sqlite_connect(ui, cfg, tables)
+	else:
+		ui.log_severe('Unknown database backend "' + str(backend) + '"!')
+		raise db_initialize_error('Unknown database backend "' + str(backend) + '"!')
+
+
+
+class db_backend:
+	'''
+	  ' Base class for database backends. It holds everything that does not
+		' depend on the database engine: the table check / initialization
+		' dialogue, instrumentation and cursor handling. Subclasses provide
+		' the connection and the engine-specific catalog queries and SQL
+		' composition; do not initialize this class directly.
+	'''
 
 	def __init__(self, ui, cfg, tables):
 		''' Open database connection 
@@ -85,13 +356,16 @@ class db_connect:
 		else:
 			self.table_prefix = ""
 
-		self.ui.log('Connecting to database ' + str(cfg['db_name']) + ' as ' + str(cfg['db_user']) + '@' + str(cfg['db_host']) + ':' + str(cfg['db_port']))
+		self.stats = None
+		if cfg.get('instrument'):
+			self.enable_stats()
 
-		self.db = psycopg2.connect(dbname=cfg['db_name'], user=cfg['db_user'], password=cfg['db_password'], host=cfg['db_host'], port=cfg['db_port'])
-		if 'table_prefix' in cfg:
-			chk = self.table_check(schema=tables, table_prefix=cfg['table_prefix'])
-		else:
-			chk = self.table_check(schema=tables)
+		self.statements = {}
+		self.cache_statements = True
+
+		self.db = self.connect(cfg)
+
+		chk = self.table_check(schema=tables)
 		if chk == 1:
 			if self.ui.prompt_yn('The database looks empty. Initialize tables?'):
 				self.setup_tables(force=False)
@@ -104,6 +378,7 @@ class db_connect:
 					self.setup_tables(force=True)
 				else:
 					self.setup_tables(force=False)
+					self.add_missing_columns()
 			else:
 				self.ui.log_severe('Database was incomplete and user rejected re-initialization request!')
 				raise db_initialize_error('Database was incomplete and user rejected re-initialization request!')
@@ -113,8 +388,87 @@ class db_connect:
 			else:
 				self.ui.log_severe('Database was corrupt and user rejected re-initialization request!')
 				raise db_initialize_error('Database was corrupt and user rejected re-initialization request!')
+		elif chk == 4:
+			if self.ui.prompt_yn('Some tables are missing columns added by a newer version of pysocial. Add them?'):
+				self.add_missing_columns()
+			else:
+				self.ui.log_severe('Database was outdated and user rejected upgrade request!')
+				raise db_initialize_error('Database was outdated and user rejected upgrade request!')
+
+		self.setup_partitions()
+		self.setup_indexes()
 	
 
+	def connect(self, cfg):
+		'''
+		  ' Opens and returns the underlying DB-API connection.
+		'''
+		raise polymorphism_error('Cannot call a method from an abstract class!')
+
+	def list_tables(self):
+		'''
+		  ' Returns the names of all tables in the database.
+		'''
+		raise polymorphism_error('Cannot call a method from an abstract class!')
+
+	def list_columns(self, tname):
+		'''
+		  ' Returns a list of (column_name, data_type) tuples for a table.
+		'''
+		raise polymorphism_error('Cannot call a method from an abstract class!')
+
+	def compose(self, template, *tables):
+		'''
+		  ' Returns an executable statement for a SQL template, from the
+			' statement registry. Each template is only built once per
+			' backend (and so per table prefix); templates are static, so the
+			' registry stays small.
+			'
+			' Parameters:
+			'   template = SQL text with {} in place of table names and %s in
+			'              place of query parameters
+			'   tables = unprefixed names of the tables to substitute for the
+			'            {} placeholders, in order
+		'''
+		if not self.cache_statements:
+			return self.build_statement(template, *tables)
+		key = (template,) + tables
+		query = self.statements.get(key)
+		if query is None:
+			query = self.build_statement(template, *tables)
+			self.statements[key] = query
+		return query
+
+	def build_statement(self, template, *tables):
+		'''
+		  ' Builds an executable statement from a SQL template; see compose().
+		'''
+		raise polymorphism_error('Cannot call a method from an abstract class!')
+
+	def sql_text(self, query):
+		'''
+		  ' Returns the SQL text of a statement produced by compose().
+		'''
+		raise polymorphism_error('Cannot call a method from an abstract class!')
+
+	def random_id_sql(self):
+		'''
+		  ' Returns a SQL expression which evaluates to a new random BIGINT id
+			' for every row, for generating ids server-side. Like the ids made
+			' in Python, it never produces the most negative BIGINT, whose
+			' absolute value would overflow.
+		'''
+		raise polymorphism_error('Cannot call a method from an abstract class!')
+
+	def lock(self, cur, kind, *key):
+		'''
+		  ' Takes an exclusive lock named by kind and key (e.g. 'file' and a
+			' file id), held until the current transaction commits or rolls
+			' back. Only other pysocial sessions taking the same lock wait;
+			' plain reads and writes are not blocked.
+		'''
+		raise polymorphism_error('Cannot call a method from an abstract class!')
+
 
 	def table_check(self, schema=None, table_prefix=None):
 		'''
@@ -132,6 +486,8 @@ class db_connect:
 			'   1 if the database is empty
 			'   2 if some tables are present but others are absent
 			'   3 if tables do not follow the expected schema
+			'   4 if the only problem is that columns are missing from some
+			'     tables (see add_missing_columns())
 		'''
 		if not schema:
 			schema = self.schema
@@ -142,26 +498,21 @@ class db_connect:
 		all_tables_present = True
 		database_empty = True
 		schema_ok = True
+		self.missing_columns = []
 
-		with database_cursor(self.db) as cur:
-			cur.execute("SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE' AND table_schema = 'public';")
-			res_raw = cur.fetchall()
-
-		res_fixed = []
-		for result in res_raw:
-			res_fixed.append(result[0])
+		res_fixed = self.list_tables()
 
 		for table in schema:
 			tname = table_prefix + table['name']
 			if tname in res_fixed:
 				database_empty = False
-				with database_cursor(self.db) as cur:
-					cur.execute("SELECT column_name, data_type from INFORMATION_SCHEMA.COLUMNS where table_name = '" + tname+ "';")
-					res = cur.fetchall()
+				res = self.list_columns(tname)
 				
-				if len(res) != len(table['schema']):
-					self.ui.log_severe('Schema problem in table check! (in table ' + tname + ': missing column(s))')
-					schema_ok = False # missing column(s)
+				present = [column[0] for column in res]
+				for col_descriptor in table['schema']:
+					if col_descriptor['name'] not in present:
+						self.ui.log_warning('Missing column in table check! (in table ' + tname + ': column ' + col_descriptor['name'] + ')')
+						self.missing_columns.append((tname, col_descriptor)) # can be added
 
 				for column in res:
 					match = False
@@ -188,13 +539,15 @@ class db_connect:
 			return 1
 		elif not all_tables_present:
 			return 2
+		elif self.missing_columns:
+			return 4
 		else:
 			return 0
 	
 
 	def setup_tables(self, force=False):
 		'''
-		  ' Sets up the proper tables in the postgresql database
+		  ' Sets up the proper tables in the database
 			' 
 			' Parameters:
 			'   force = whether to delete all tables and re-initialize. This
@@ -204,56 +557,632 @@ class db_connect:
 
 		if force: # delete all present tables
 			with database_cursor(self.db) as cur:
-				cur.execute("SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE' AND table_schema = 'public';")
-				table_list_unfixed = cur.fetchall()
-
-				for table in table_list_unfixed:
-					tname = table[0]
-					cmd = 'DROP TABLE ' + tname + ';'
+				for tname in self.list_tables():
+					cmd = 'DROP TABLE IF EXISTS ' + tname + ';'
 					self.ui.log_warning('Removing table ' + tname)
 					cur.execute(cmd)
 
 				self.db.commit()
 
-		with database_cursor(self.db) as cur:
-			cur.execute("SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE' AND table_schema = 'public';")
-			table_list_unfixed = cur.fetchall()
-
-			table_list = []
-
-			for table in table_list_unfixed:
-				table_list.append(table[0])
-				self.ui.log_debug('Found table ' + str(table[0]))
+		table_list = self.list_tables()
+		for tname in table_list:
+			self.ui.log_debug('Found table ' + str(tname))
 
+		with database_cursor(self.db) as cur:
 			for table in self.schema:
 				tname = self.table_prefix + table['name']
 				if tname in table_list:
 					continue # ignore tables which already exist
 				else:
-					cmd = 'CREATE TABLE ' + tname + ' ('
-					for index, column in enumerate(table['schema']):
-						if index != 0:
-							cmd = cmd + ', '
-						cmd = cmd + column['name'] + ' ' + column['type']
-						if 'primary' in column: # columns with primary:true are PRIMARY KEY columns
-							if column['primary']:
-								cmd = cmd + ' PRIMARY KEY'
-					
-					cmd = cmd + ');'
-					self.ui.log('Creating table ' + tname + ' with command ' + cmd)
-					cur.execute(cmd) # create table
+					for cmd in self.create_table_sql(tname, table):
+						self.ui.log('Creating table ' + tname + ' with command ' + cmd)
+						cur.execute(cmd) # create table
 			self.db.commit()
 	
 
+	def create_table_sql(self, tname, table):
+		'''
+		  ' Returns the list of statements which create a table described in
+			' the schema. Backends which support partitioning override this to
+			' honour the table's 'partition' declaration.
+		'''
+		cmd = 'CREATE TABLE ' + tname + ' ('
+		for index, column in enumerate(table['schema']):
+			if index != 0:
+				cmd = cmd + ', '
+			cmd = cmd + self.column_sql(column)
+			if 'primary' in column: # columns with primary:true are PRIMARY KEY columns
+				if column['primary']:
+					cmd = cmd + ' PRIMARY KEY'
+		
+		cmd = cmd + ');'
+		return [cmd]
+	
+
+	def column_sql(self, column):
+		'''
+		  ' Returns the definition of a column described in the schema, as
+			' used in CREATE TABLE and ALTER TABLE, without PRIMARY KEY.
+		'''
+		cmd = column['name'] + ' ' + column['type']
+		if 'default' in column:
+			cmd = cmd + ' DEFAULT ' + str(column['default'])
+		if 'generated' in column: # computed from other columns of the row
+			cmd = cmd + ' GENERATED ALWAYS AS (' + column['generated'] + ') STORED'
+		return cmd
+	
+
+	def add_missing_columns(self):
+		'''
+		  ' Adds the columns which the last table_check() found missing, so
+			' databases created by older versions can be upgraded in place.
+			' Existing rows get the column's default.
+		'''
+		with database_cursor(self.db) as cur:
+			for tname, column in getattr(self, 'missing_columns', []):
+				cmd = 'ALTER TABLE ' + tname + ' ADD COLUMN ' + self.column_sql(column) + ';'
+				self.ui.log('Adding column to ' + tname + ' with command ' + cmd)
+				cur.execute(cmd)
+			self.db.commit()
+		self.missing_columns = []
+	
+
+	def setup_partitions(self):
+		'''
+		  ' Inspects the partitioning of the existing tables. Backends without
+			' partitioning support have nothing to do.
+		'''
+		self.partitioning = {}
+	
+
+	def add_file_partitions(self, cur, file_id):
+		'''
+		  ' Creates the per-file partitions for a new file, if any tables are
+			' LIST-partitioned. Does not commit.
+		'''
+		pass
+	
+
+	def notify(self, cur, file_id, payload):
+		'''
+		  ' Announces a change to a file to change listeners, once the
+			' transaction commits. Backends without a change feed do nothing;
+			' their listeners poll the change counter instead.
+		'''
+		pass
+	
+
+	def change_listener(self, file_id, poll_interval=1.0):
+		'''
+		  ' Returns an object whose wait(timeout) method blocks until the
+			' file changes (see change_listener). close() it when done.
+		'''
+		return change_listener(self, file_id, poll_interval)
+	
+
+	def drop_file_partitions(self, cur, file_id):
+		'''
+		  ' Drops the per-file partitions of a file, if any tables are
+			' LIST-partitioned. Does not commit.
+			'
+			' Returns: the unprefixed names of the tables whose rows for the
+			'   file were removed this way
+		'''
+		return []
+	
+
+	def setup_indexes(self):
+		'''
+		  ' Creates any secondary indexes listed under 'indexes' in the schema
+			' which do not exist yet. Safe to call on every startup.
+			'
+			' Indexes with "unique":true make the database reject duplicate
+			' keys. If existing rows already contain duplicates, the index is
+			' left out with a warning, and created once they are gone.
+		'''
+		with database_cursor(self.db) as cur:
+			for table in self.schema:
+				tname = self.table_prefix + table['name']
+				for index in table.get('indexes', []):
+					iname = tname + '_' + index['name']
+					kind = 'UNIQUE INDEX' if index.get('unique') else 'INDEX'
+					cmd = 'CREATE ' + kind + ' IF NOT EXISTS ' + iname + ' ON ' + tname + ' (' + ', '.join(index['columns']) + ');'
+					self.ui.log_debug('Ensuring index ' + iname + ' with command ' + cmd)
+					try:
+						cur.execute(cmd)
+						self.db.commit()
+					except self.integrity_error as err:
+						self.db.rollback()
+						self.ui.log_warning('Could not create unique index ' + iname + ': ' + tname + ' has rows with the same ' + ', '.join(index['columns']) + ' (' + str(err).strip() + ')')
+	
+
+	def insert_many(self, cur, table, columns, rows, page_size=500, on_conflict=None):
+		'''
+		  ' Inserts rows using multi-row INSERT statements, page_size rows per
+			' statement (the last few rows in smaller power-of-two pages),
+			' instead of one round trip per row. Does not commit.
+			'
+			' Parameters:
+			'   cur = cursor to execute the statements on
+			'   table = unprefixed table name
+			'   columns = list of column names
+			'   rows = list of tuples, one value per column
+			'   on_conflict = optional ON CONFLICT clause, turning the INSERT
+			'                 into an upsert. The existing row can be referred
+			'                 to as t, the new one as excluded. A key must not
+			'                 appear twice in rows.
+		'''
+		row_template = '(' + ','.join(['%s'] * len(columns)) + ')'
+		head = 'INSERT INTO {} ('
+		tail = ';'
+		if on_conflict:
+			head = 'INSERT INTO {} AS t ('
+			tail = ' ' + on_conflict + ';'
+		start = 0
+		while start < len(rows):
+			# Full pages, then the rest in pages of decreasing powers of two,
+			# so that only a few statement shapes reach the registry (and
+			# get prepared) however many rows there are
+			size = page_size
+			remaining = len(rows) - start
+			if remaining < page_size:
+				size = 1 << (remaining.bit_length() - 1)
+			page = rows[start:start + size]
+			start = start + size
+			cmd = self.compose(head + ', '.join(columns) + ') VALUES ' + ','.join([row_template] * len(page)) + tail, table)
+			args = []
+			for row in page:
+				args.extend(row)
+			cur.execute(cmd, args)
+	
+
 	def tablify(self, tname):
 		return str(self.table_prefix) + str(tname)
 	
 
-	def cursor(self):
+	def enable_stats(self):
+		if not self.stats:
+			self.stats = query_stats()
+		return self.stats
+
+	def disable_stats(self):
+		self.stats = None
+	
+
+	def raw_cursor(self):
+		'''
+		  ' Returns a cursor without instrumentation.
+		'''
 		return self.db.cursor()
+
+	def cursor(self):
+		if self.stats:
+			return instrumented_cursor(self.raw_cursor(), self.stats, self)
+		return self.raw_cursor()
+	
+	def stream_cursor(self):
+		'''
+		  ' Returns a cursor suitable for iterating over very large results.
+			' By default this is a normal cursor; backends which would
+			' otherwise buffer the whole result client-side override it.
+		'''
+		return self.cursor()
+
+	def read_cursor(self, stream=False):
+		'''
+		  ' Returns a cursor for statements which only read (see
+			' database_cursor). By default this is a normal cursor (or a
+			' stream_cursor()); backends with read replicas override it.
+		'''
+		if stream:
+			return self.stream_cursor()
+		return self.cursor()
+
+	def note_write(self):
+		'''
+		  ' Records that the database has just changed, so that reads are
+			' not sent to replicas which may not have the change yet.
+		'''
+		pass
 	
 	def commit(self):
+		if self.stats:
+			start = time.perf_counter()
+			try:
+				return self.db.commit()
+			finally:
+				self.stats.record_timing('commit', time.perf_counter() - start)
 		return self.db.commit()
 	
 	def rollback(self):
 		return self.db.rollback()
+
+
+
+def _pg_connect(cfg):
+	if 'dsn' in cfg:
+		return psycopg2.connect(cfg['dsn'])
+	return psycopg2.connect(dbname=cfg['db_name'], user=cfg['db_user'], password=cfg['db_password'], host=cfg['db_host'], port=cfg['db_port'])
+
+
+
+# Seconds of replay lag: 0 when the replica has applied everything it has
+# received, NULL on a server which is not replaying (e.g. a primary)
+REPLICA_LAG_SQL = 'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END;'
+
+
+class replica_pool:
+	'''
+	  ' Connections to the read replicas of a PostgreSQL primary, handed
+		' out round-robin. Each replica is checked (and its replication lag
+		' measured) before it is used, at most every check_interval
+		' seconds; one which cannot be reached is skipped for retry
+		' seconds, and one which lags more than max_lag seconds until its
+		' next check.
+	'''
+	def __init__(self, ui, primary_cfg, replicas, check_interval=5.0, retry=30.0, max_lag=None):
+		self.ui = ui
+		self.configs = []
+		for replica in replicas:
+			if isinstance(replica, dict):
+				cfg = dict(primary_cfg)
+				cfg.update(replica)
+				self.configs.append(cfg)
+			else:
+				self.configs.append({'dsn':str(replica)})
+		self.conns = [None] * len(self.configs)
+		self.cursors = [0] * len(self.configs) # open replica_cursors
+		self.checked = [None] * len(self.configs)
+		self.skip_until = [0.0] * len(self.configs)
+		self.check_interval = check_interval
+		self.retry = retry
+		self.max_lag = max_lag
+		self.next = 0
+
+	def describe(self, index):
+		cfg = self.configs[index]
+		if 'dsn' in cfg:
+			cfg = psycopg2.extensions.parse_dsn(cfg['dsn'])
+			return str(cfg.get('host', 'localhost')) + ':' + str(cfg.get('port', 5432))
+		return str(cfg['db_host']) + ':' + str(cfg['db_port'])
+
+	def connection(self):
+		'''
+		  ' Returns: (index, connection) of the next healthy replica, or None
+			'   if none is available
+		'''
+		for attempt in range(len(self.configs)):
+			index = self.next
+			self.next = (self.next + 1) % len(self.configs)
+			if time.monotonic() < self.skip_until[index]:
+				continue
+			conn = self.__check(index)
+			if conn is not None:
+				return index, conn
+		return None
+
+	def __check(self, index):
+		now = time.monotonic()
+		try:
+			conn = self.conns[index]
+			if conn is None or conn.closed:
+				conn = _pg_connect(self.configs[index])
+				conn.set_session(readonly=True)
+				self.conns[index] = conn
+				self.checked[index] = None
+				self.ui.log_debug('Connected to read replica ' + self.describe(index))
+			if self.checked[index] is not None and now - self.checked[index] < self.check_interval:
+				return conn
+
+			with conn.cursor() as cur:
+				cur.execute(REPLICA_LAG_SQL)
+				lag = cur.fetchone()[0]
+			conn.rollback()
+			self.checked[index] = now
+			if self.max_lag is not None and lag is not None and float(lag) > self.max_lag:
+				self.ui.log_debug('Read replica ' + self.describe(index) + ' is ' + '{:.1f}'.format(float(lag)) + ' seconds behind; not using it')
+				self.skip_until[index] = now + self.check_interval
+				return None
+			return conn
+		except psycopg2.Error as err:
+			self.fail(index, err)
+			return None
+
+	def fail(self, index, err):
+		'''
+		  ' Stops using a replica for retry seconds after an error.
+		'''
+		self.ui.log_warning('Read replica ' + self.describe(index) + ' failed (' + str(err).strip() + '); not using it for ' + str(self.retry) + ' seconds')
+		self.skip_until[index] = time.monotonic() + self.retry
+		conn = self.conns[index]
+		self.conns[index] = None
+		self.cursors[index] = 0
+		if conn is not None:
+			try:
+				conn.close()
+			except psycopg2.Error:
+				pass
+
+
+
+class replica_cursor:
+	'''
+	  ' Cursor on a read replica. If the replica fails while executing a
+		' statement, or cancels it because it conflicts with replication,
+		' the statement runs on the primary instead. Closing the cursor ends
+		' its read-only transaction, so that the replica is not held back
+		' by an old snapshot. Anything not overridden here is passed
+		' through to the real cursor.
+	'''
+	def __init__(self, backend, index, conn, stream=False):
+		self.backend = backend
+		self.index = index
+		self.conn = conn
+		self.stream = stream
+		if stream:
+			self.cur = backend.named_cursor(conn)
+		else:
+			self.cur = conn.cursor()
+		backend.replicas.cursors[index] += 1
+
+	def execute(self, query, args=None):
+		try:
+			if args is None:
+				return self.cur.execute(query)
+			return self.cur.execute(query, args)
+		except psycopg2.OperationalError as err:
+			if self.conn is None:
+				raise
+			# A named cursor left open would linger on the connection
+			try:
+				self.cur.close()
+			except psycopg2.Error:
+				pass
+			if isinstance(err, psycopg2.extensions.TransactionRollbackError):
+				self.backend.ui.log_debug('Read replica ' + self.backend.replicas.describe(self.index) + ' cancelled a statement; running it on the primary')
+				self.conn.rollback()
+			else:
+				self.backend.replicas.fail(self.index, err)
+			self.release()
+			self.cur = self.backend.primary_cursor(self.stream)
+			return self.execute(query, args)
+
+	def release(self):
+		# The transaction is shared by every cursor on the connection, so
+		# it ends when the last of them is done
+		if self.conn is None:
+			return
+		pool = self.backend.replicas
+		if pool.conns[self.index] is self.conn:
+			pool.cursors[self.index] -= 1
+			if pool.cursors[self.index] == 0 and not self.conn.closed:
+				self.conn.rollback()
+		self.conn = None
+
+	def close(self):
+		self.cur.close()
+		self.release()
+
+	def __iter__(self):
+		return iter(self.cur)
+
+	def __getattr__(self, attr):
+		return getattr(self.cur, attr)
+
+
+
+class db_connect(db_backend):
+	'''
+	  ' PostgreSQL backend, using psycopg2.
+	'''
+	database_error = psycopg2.Error
+	integrity_error = psycopg2.IntegrityError
+
+	def connect(self, cfg):
+		self.cfg = cfg
+		self.prepare_threshold = int(cfg.get('prepare_threshold', 2))
+		self.statement_uses = {}
+		self.prepared = {}
+		self.ui.log('Connecting to database ' + str(cfg['db_name']) + ' as ' + str(cfg['db_user']) + '@' + str(cfg['db_host']) + ':' + str(cfg['db_port']))
+
+		self.replicas = None
+		self.last_write = None
+		self.read_after_write = float(cfg.get('replica_read_after_write', 5.0))
+		if cfg.get('db_replicas'):
+			max_lag = cfg.get('replica_max_lag')
+			self.replicas = replica_pool(self.ui, cfg, cfg['db_replicas'], float(cfg.get('replica_check_interval', 5.0)), float(cfg.get('replica_retry', 30.0)), float(max_lag) if max_lag is not None else None)
+			self.ui.log('Reading from ' + str(len(self.replicas.configs)) + ' replica(s) where possible')
+
+		return _pg_connect(cfg)
+
+	def list_tables(self):
+		with database_cursor(self.db) as cur:
+			cur.execute("SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE' AND table_schema = 'public';")
+			return [result[0] for result in cur.fetchall()]
+
+	def list_columns(self, tname):
+		with database_cursor(self.db) as cur:
+			cur.execute("SELECT column_name, data_type from INFORMATION_SCHEMA.COLUMNS where table_name = %s;", (tname,))
+			return cur.fetchall()
+
+	def named_cursor(self, conn):
+		'''
+		  ' Returns a server-side cursor on conn, which fetches rows in
+			' batches as it is iterated.
+		'''
+		self.stream_counter = getattr(self, 'stream_counter', 0) + 1
+		cur = conn.cursor(name='pysocial_stream_' + str(self.stream_counter))
+		cur.itersize = 10000
+		return cur
+
+	def stream_cursor(self):
+		cur = self.named_cursor(self.db)
+		if self.stats:
+			return instrumented_cursor(cur, self.stats, self)
+		return cur
+
+	def primary_cursor(self, stream=False):
+		'''
+		  ' Returns an uninstrumented cursor on the primary.
+		'''
+		if stream:
+			return self.named_cursor(self.db)
+		return self.raw_cursor()
+
+	def read_cursor(self, stream=False):
+		'''
+		  ' Returns a cursor on the next healthy replica (see replica_pool),
+			' or on the primary if there are no replicas, none is available,
+			' or there was a commit in the last replica_read_after_write
+			' seconds (so that a session always reads its own writes).
+		'''
+		if not self.replicas or (self.last_write is not None and time.monotonic() - self.last_write < self.read_after_write):
+			return db_backend.read_cursor(self, stream)
+		replica = self.replicas.connection()
+		if replica is None:
+			return db_backend.read_cursor(self, stream)
+		cur = replica_cursor(self, replica[0], replica[1], stream)
+		if self.stats:
+			return instrumented_cursor(cur, self.stats, self)
+		return cur
+
+	def note_write(self):
+		self.last_write = time.monotonic()
+
+	def commit(self):
+		ret = db_backend.commit(self)
+		self.note_write()
+		return ret
+
+	def build_statement(self, template, *tables):
+		query = sql.SQL(template).format(*[sql.Identifier(self.tablify(table)) for table in tables]).as_string(self.db)
+		if self.cache_statements:
+			self.statement_uses[query] = 0
+		return query
+
+	def raw_cursor(self):
+		if self.prepare_threshold > 0:
+			return prepared_cursor(self.db.cursor(), self)
+		return self.db.cursor()
+
+	def prepared_name(self, cur, query):
+		'''
+		  ' Counts an execution of a registry statement, and once it has been
+			' run prepare_threshold times, PREPAREs it on this connection so
+			' that the server skips parsing and planning from then on.
+			'
+			' Returns: the prepared statement's name, or None to execute the
+			'   query normally (it is not from the registry, not used often
+			'   enough yet, or the server could not prepare it)
+		'''
+		if query in self.prepared:
+			return self.prepared[query]
+		if query not in self.statement_uses:
+			return None
+		self.statement_uses[query] += 1
+		if self.statement_uses[query] < self.prepare_threshold:
+			return None
+
+		name = 'pysocial_s' + str(len(self.prepared) + 1)
+		counter = iter(range(1, query.count('%s') + 1))
+		text = re.sub('%[s%]', lambda match: '$' + str(next(counter)) if match.group(0) == '%s' else '%', query).rstrip().rstrip(';')
+		# A failed PREPARE must not abort the caller's transaction
+		try:
+			cur.execute('SAVEPOINT pysocial_prepare; PREPARE ' + name + ' AS ' + text + '; RELEASE SAVEPOINT pysocial_prepare;')
+		except psycopg2.Error as err:
+			cur.execute('ROLLBACK TO SAVEPOINT pysocial_prepare; RELEASE SAVEPOINT pysocial_prepare;')
+			self.ui.log_debug('Could not prepare statement, running it unprepared: ' + str(err).strip())
+			name = None
+		self.prepared[query] = name
+		return name
+
+	def sql_text(self, query):
+		if isinstance(query, sql.Composable):
+			return query.as_string(self.db)
+		return str(query)
+
+	def partition_spec(self, table):
+		partition = table.get('partition')
+		if partition and partition.get('method') in ('list', 'hash'):
+			return partition
+		return None
+
+	def create_table_sql(self, tname, table):
+		partition = self.partition_spec(table)
+		if not partition:
+			return db_backend.create_table_sql(self, tname, table)
+
+		# A partitioned table's primary key has to include the partition key
+		columns = []
+		primary = []
+		for column in table['schema']:
+			columns.append(self.column_sql(column))
+			if column.get('primary'):
+				primary.append(column['name'])
+		if primary and partition['key'] not in primary:
+			primary.append(partition['key'])
+		if primary:
+			columns.append('PRIMARY KEY (' + ', '.join(primary) + ')')
+
+		cmds = ['CREATE TABLE ' + tname + ' (' + ', '.join(columns) + ') PARTITION BY ' + partition['method'].upper() + ' (' + partition['key'] + ');']
+		if partition['method'] == 'hash':
+			modulus = int(partition.get('modulus', 16))
+			for remainder in range(modulus):
+				cmds.append('CREATE TABLE ' + tname + '_p' + str(remainder) + ' PARTITION OF ' + tname + ' FOR VALUES WITH (MODULUS ' + str(modulus) + ', REMAINDER ' + str(remainder) + ');')
+		else:
+			cmds.append('CREATE TABLE ' + tname + '_default PARTITION OF ' + tname + ' DEFAULT;')
+		return cmds
+
+	def setup_partitions(self):
+		'''
+		  ' Records how each table is actually partitioned, and warns when
+			' that differs from social-tables.json. The layout of an existing
+			' table is never changed automatically; recreate the table (or
+			' migrate the data by hand) to switch layouts.
+		'''
+		with database_cursor(self.db) as cur:
+			cur.execute('SELECT c.relname, p.partstrat FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid;')
+			actual = dict(cur.fetchall())
+
+		self.partitioning = {}
+		strategies = {'l':'list', 'h':'hash'}
+		for table in self.schema:
+			tname = self.tablify(table['name'])
+			declared = self.partition_spec(table)
+			declared_method = declared['method'] if declared else None
+			actual_method = strategies.get(actual.get(tname))
+			if actual.get(tname) and not actual_method:
+				actual_method = 'other'
+			if declared_method != actual_method:
+				self.ui.log_warning('Table ' + tname + ' is ' + (actual_method + '-partitioned' if actual_method else 'not partitioned') + ', but social-tables.json declares ' + (declared_method + ' partitioning' if declared_method else 'no partitioning') + '. Keeping the existing layout.')
+			if actual_method in ('list', 'hash'):
+				self.partitioning[table['name']] = actual_method
+
+	def add_file_partitions(self, cur, file_id):
+		for table, method in self.partitioning.items():
+			if method == 'list':
+				tname = self.tablify(table)
+				cur.execute('CREATE TABLE IF NOT EXISTS ' + partition_name(tname, file_id) + ' PARTITION OF ' + tname + ' FOR VALUES IN (' + str(int(file_id)) + ');')
+
+	def drop_file_partitions(self, cur, file_id):
+		dropped = []
+		for table, method in self.partitioning.items():
+			if method == 'list':
+				pname = partition_name(self.tablify(table), file_id)
+				cur.execute('SELECT to_regclass(%s);', (pname,))
+				if cur.fetchone()[0]:
+					cur.execute('DROP TABLE ' + pname + ';')
+					dropped.append(table)
+		return dropped
+
+	def lock(self, cur, kind, *key):
+		cur.execute('SELECT pg_advisory_xact_lock(%s, %s);', advisory_key(self.table_prefix, kind, *key))
+
+	def notify(self, cur, file_id, payload):
+		cur.execute('SELECT pg_notify(%s, %s);', (change_channel(self.table_prefix, file_id), str(payload)))
+
+	def change_listener(self, file_id, poll_interval=1.0):
+		return notify_listener(self, file_id, self.cfg)
+
+	def random_id_sql(self):
+		return "mod(('x' || substr(md5(random()::text || clock_timestamp()::text), 1, 16))::bit(64)::bigint, 9223372036854775807)"
@@ -0,0 +1,196 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import gzip
+import json
+from xml.sax.saxutils import escape, quoteattr
+
+'''
+  ' Streaming graph exporters.
+	'
+	' Every writer gets the tag names up front (formats like GraphML need to
+	' declare attributes before the first node), then one call per node and
+	' per edge, in that order, so nothing but the current row is ever held
+	' in memory.
+'''
+
+
+class export_writer:
+	'''
+	  ' Base class for exporters. DO NOT initialize it - use one of the
+		' format-specific subclasses listed in EXPORT_FORMATS.
+	'''
+	def __init__(self, out):
+		self.out = out
+
+	def header(self, file_name, tag_names):
+		pass
+
+	def node(self, node_id, name, tags):
+		pass
+
+	def edge(self, connection_id, first_id, second_id, tags):
+		pass
+
+	def footer(self):
+		pass
+
+
+
+class graphml_writer(export_writer):
+	def header(self, file_name, tag_names):
+		self.keys = {}
+		self.out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		self.out.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+		self.out.write('  <key id="name" for="node" attr.name="name" attr.type="string"/>\n')
+		for index, tag in enumerate(tag_names):
+			self.keys[tag] = 'd' + str(index)
+			self.out.write('  <key id="d' + str(index) + '" for="all" attr.name=' + quoteattr(str(tag)) + ' attr.type="string"/>\n')
+		self.out.write('  <graph id=' + quoteattr(str(file_name)) + ' edgedefault="undirected">\n')
+
+	def __data(self, tags):
+		return ''.join('<data key="' + self.keys[tag] + '">' + escape(str(value)) + '</data>' for tag, value in tags.items() if tag in self.keys)
+
+	def node(self, node_id, name, tags):
+		self.out.write('    <node id="n' + str(node_id) + '"><data key="name">' + escape(str(name)) + '</data>' + self.__data(tags) + '</node>\n')
+
+	def edge(self, connection_id, first_id, second_id, tags):
+		self.out.write('    <edge id="e' + str(connection_id) + '" source="n' + str(first_id) + '" target="n' + str(second_id) + '">' + self.__data(tags) + '</edge>\n')
+
+	def footer(self):
+		self.out.write('  </graph>\n</graphml>\n')
+
+
+
+class gexf_writer(export_writer):
+	def header(self, file_name, tag_names):
+		self.keys = {}
+		self.out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		self.out.write('<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n')
+		self.out.write('  <meta><description>' + escape(str(file_name)) + '</description></meta>\n')
+		self.out.write('  <graph defaultedgetype="undirected">\n')
+		for attr_class in ('node', 'edge'):
+			self.out.write('    <attributes class="' + attr_class + '">\n')
+			for index, tag in enumerate(tag_names):
+				self.out.write('      <attribute id="' + str(index) + '" title=' + quoteattr(str(tag)) + ' type="string"/>\n')
+			self.out.write('    </attributes>\n')
+		for index, tag in enumerate(tag_names):
+			self.keys[tag] = str(index)
+		self.out.write('    <nodes>\n')
+		self.in_edges = False
+
+	def __attvalues(self, tags):
+		values = [(self.keys[tag], value) for tag, value in tags.items() if tag in self.keys]
+		if not values:
+			return ''
+		return '<attvalues>' + ''.join('<attvalue for="' + key + '" value=' + quoteattr(str(value)) + '/>' for key, value in values) + '</attvalues>'
+
+	def node(self, node_id, name, tags):
+		self.out.write('      <node id="' + str(node_id) + '" label=' + quoteattr(str(name)) + '>' + self.__attvalues(tags) + '</node>\n')
+
+	def edge(self, connection_id, first_id, second_id, tags):
+		if not self.in_edges:
+			self.out.write('    </nodes>\n    <edges>\n')
+			self.in_edges = True
+		self.out.write('      <edge id="' + str(connection_id) + '" source="' + str(first_id) + '" target="' + str(second_id) + '">' + self.__attvalues(tags) + '</edge>\n')
+
+	def footer(self):
+		if not self.in_edges:
+			self.out.write('    </nodes>\n    <edges>\n')
+		self.out.write('    </edges>\n  </graph>\n</gexf>\n')
+
+
+
+def _dot_quote(text):
+	return '"' + str(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+class dot_writer(export_writer):
+	def header(self, file_name, tag_names):
+		self.out.write('graph ' + _dot_quote(file_name) + ' {\n')
+
+	def __attrs(self, attrs):
+		return ' [' + ', '.join(_dot_quote(key) + '=' + _dot_quote(value) for key, value in attrs) + ']'
+
+	def node(self, node_id, name, tags):
+		self.out.write('  ' + str(node_id) + self.__attrs([('label', name)] + [(tag, value) for tag, value in tags.items() if tag != 'label']) + ';\n')
+
+	def edge(self, connection_id, first_id, second_id, tags):
+		self.out.write('  ' + str(first_id) + ' -- ' + str(second_id) + self.__attrs([('id', connection_id)] + list(tags.items())) + ';\n')
+
+	def footer(self):
+		self.out.write('}\n')
+
+
+
+class jsonl_writer(export_writer):
+	def header(self, file_name, tag_names):
+		self.out.write(json.dumps({'type':'file', 'name':file_name, 'tags':list(tag_names)}) + '\n')
+
+	def node(self, node_id, name, tags):
+		self.out.write(json.dumps({'type':'node', 'id':node_id, 'name':name, 'tags':tags}) + '\n')
+
+	def edge(self, connection_id, first_id, second_id, tags):
+		self.out.write(json.dumps({'type':'edge', 'id':connection_id, 'source':first_id, 'target':second_id, 'tags':tags}) + '\n')
+
+
+
+EXPORT_FORMATS = {
+	'graphml':graphml_writer,
+	'gexf':gexf_writer,
+	'dot':dot_writer,
+	'jsonl':jsonl_writer
+}
+
+
+def open_export_file(path, compress=None):
+	'''
+	  ' Opens an output text stream for an export, gzip-compressed if
+		' compress is true or (when compress is None) the path ends in .gz.
+	'''
+	if compress is None:
+		compress = str(path).endswith('.gz')
+	if compress:
+		return gzip.open(path, 'wt', encoding='utf-8')
+	return open(path, 'w', encoding='utf-8', buffering=1048576)
+
+
+def export_graph(db_io, fmt, out):
+	'''
+	  ' Streams the file open in db_io into out using the named format.
+		'
+		' Returns: (node count, edge count)
+	'''
+	writer = EXPORT_FORMATS[fmt](out)
+	writer.header(db_io.current_file(), db_io.list_tag_names())
+
+	node_count = 0
+	for node_id, name, tags in db_io.iter_tagged_nodes():
+		writer.node(node_id, name, tags)
+		node_count = node_count + 1
+
+	edge_count = 0
+	for connection_id, first_id, second_id, tags in db_io.iter_tagged_connections():
+		writer.edge(connection_id, first_id, second_id, tags)
+		edge_count = edge_count + 1
+
+	writer.footer()
+	return (node_count, edge_count)
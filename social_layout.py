@@ -0,0 +1,262 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import numpy as np
+
+'''
+  ' Built-in force-directed layout (render program 'fr').
+	'
+	' Fruchterman-Reingold on numpy arrays of edge endpoints:
+	'   - repulsion between all pairs of nodes is approximated with a
+	'     Barnes-Hut quadtree, built and walked one level at a time for all
+	'     nodes at once, so every step is O(n log n) vectorised work
+	'   - the graph is first coarsened by repeatedly merging matched pairs
+	'     of neighbours; the coarsest graph is laid out from scratch and
+	'     each finer level starts from the positions of the one above it,
+	'     so only a few refinement steps are needed per level
+	'
+	' layout_graph() scales the result to points for `neato -n2`, leaving
+	' about NODE_SPACING points of room around every node.
+'''
+
+LAYOUT_PROG = 'fr'
+THETA = 1.0
+MAX_DEPTH = 12
+COARSEST_SIZE = 64
+MATCH_ROUNDS = 4
+COARSE_ITERATIONS = 150
+REFINE_ITERATIONS = 30
+NODE_SPACING = 108.0
+
+
+def _morton(cells, depth):
+	'''
+	  ' Interleaves the bits of integer cell coordinates, so the quadtree
+		' cell of a node at any level is its key shifted right by 2 per level.
+	'''
+	key = np.zeros(len(cells), dtype=np.int64)
+	for bit in range(depth):
+		key |= ((cells[:, 0] >> bit) & 1) << (2 * bit + 1)
+		key |= ((cells[:, 1] >> bit) & 1) << (2 * bit)
+	return key
+
+
+def _expand(who, start, count):
+	'''
+	  ' Pairs who[i] with each of start[i] .. start[i] + count[i] - 1
+	'''
+	offsets = np.arange(int(count.sum())) - np.repeat(np.cumsum(count) - count, count)
+	return np.repeat(who, count), np.repeat(start, count) + offsets
+
+
+def _push(disp_x, disp_y, who, dx, dy, dist2, mass, k2):
+	'''
+	  ' Adds the repulsion of masses at offsets (dx, dy) from nodes
+	'''
+	force = k2 * mass / np.maximum(dist2, 1e-6 * k2)
+	disp_x += np.bincount(who, weights=dx * force, minlength=len(disp_x))
+	disp_y += np.bincount(who, weights=dy * force, minlength=len(disp_y))
+
+
+def repulsion(pos, k=1.0, theta=THETA):
+	'''
+	  ' Returns the Fruchterman-Reingold repulsive displacement (k^2 / d away
+		' from every other node) of every node in pos, an (n, 2) array, using
+		' the Barnes-Hut approximation: a quadtree cell is treated as a
+		' single mass at its centroid once it is smaller than theta times its
+		' distance from the node.
+	'''
+	n = len(pos)
+	disp_x = np.zeros(n)
+	disp_y = np.zeros(n)
+	if n < 2:
+		return np.zeros((n, 2))
+
+	x = np.ascontiguousarray(pos[:, 0])
+	y = np.ascontiguousarray(pos[:, 1])
+	low = pos.min(axis=0)
+	span = max(float((pos.max(axis=0) - low).max()), 1e-9) * (1 + 1e-9)
+	depth = int(min(MAX_DEPTH, max(1, np.ceil(np.log(n) / np.log(4)))))
+	cells = np.minimum(((pos - low) * ((1 << depth) / span)).astype(np.int64), (1 << depth) - 1)
+	finest = _morton(cells, depth)
+
+	# Per level: sorted keys of occupied cells, their node counts and
+	# centroids, and the key of the cell each node is in
+	levels = []
+	for level in range(depth + 1):
+		node_keys = finest >> (2 * (depth - level))
+		keys, inverse = np.unique(node_keys, return_inverse=True)
+		mass = np.bincount(inverse).astype(float)
+		levels.append((keys, mass, np.bincount(inverse, weights=x) / mass, np.bincount(inverse, weights=y) / mass, node_keys, span / (1 << level)))
+
+	k2 = k * k
+	who = np.arange(n)
+	which = np.zeros(n, dtype=np.int64)
+	for level in range(depth + 1):
+		keys, mass, centre_x, centre_y, node_keys, size = levels[level]
+		cell_keys = keys[which]
+		dx = x[who] - centre_x[which]
+		dy = y[who] - centre_y[which]
+		dist2 = dx * dx + dy * dy
+		accept = (size * size < theta * theta * dist2) & (node_keys[who] != cell_keys)
+		near = np.flatnonzero(~accept)
+		accept = np.flatnonzero(accept)
+		_push(disp_x, disp_y, who[accept], dx[accept], dy[accept], dist2[accept], mass[which[accept]], k2)
+
+		who = who[near]
+		if level == depth:
+			# Nodes in leaves which are too close interact one by one
+			order = np.argsort(finest, kind='stable')
+			start = np.searchsorted(finest[order], cell_keys[near], 'left')
+			count = mass[which[near]].astype(np.int64)
+			who, others = _expand(who, start, count)
+			others = order[others]
+			distinct = np.flatnonzero(who != others)
+			who = who[distinct]
+			others = others[distinct]
+			dx = x[who] - x[others]
+			dy = y[who] - y[others]
+			_push(disp_x, disp_y, who, dx, dy, dx * dx + dy * dy, 1.0, k2)
+			break
+
+		# Open the other cells: pair each node with the children of its cell
+		child_parents = levels[level + 1][0] >> 2
+		parents = cell_keys[near]
+		start = np.searchsorted(child_parents, parents, 'left')
+		count = np.searchsorted(child_parents, parents, 'right') - start
+		who, which = _expand(who, start, count)
+	return np.stack((disp_x, disp_y), axis=1)
+
+
+def attraction(pos, first, second, k=1.0):
+	'''
+	  ' Returns the Fruchterman-Reingold attractive displacement (d^2 / k
+		' towards each neighbour) of every node.
+	'''
+	n = len(pos)
+	delta = pos[first] - pos[second]
+	pull = np.sqrt((delta * delta).sum(axis=1)) / k
+	disp = np.zeros((n, 2))
+	for axis in (0, 1):
+		disp[:, axis] = np.bincount(second, weights=delta[:, axis] * pull, minlength=n) - np.bincount(first, weights=delta[:, axis] * pull, minlength=n)
+	return disp
+
+
+def _fruchterman_reingold(pos, first, second, iterations, temperature, theta):
+	for i in range(iterations):
+		step = temperature * (1 - i / iterations)
+		disp = repulsion(pos, theta=theta) + attraction(pos, first, second)
+		length = np.sqrt((disp * disp).sum(axis=1))
+		pos += disp * (np.minimum(length, step) / np.maximum(length, 1e-12))[:, None]
+	return pos
+
+
+def _unique_edges(first, second):
+	'''
+	  ' Drops self-loops and repeated edges
+	'''
+	keep = first != second
+	pairs = np.unique(np.stack((np.minimum(first[keep], second[keep]), np.maximum(first[keep], second[keep])), axis=1), axis=0)
+	return pairs[:, 0].copy(), pairs[:, 1].copy()
+
+
+def _match(n, first, second, rng):
+	'''
+	  ' Pairs up neighbouring nodes: each round, every edge gets a random
+		' priority, and edges that are the top priority of both endpoints
+		' join them.
+		'
+		' Returns: (coarse node of every node, number of coarse nodes)
+	'''
+	partner = np.full(n, -1, dtype=np.int64)
+	for _ in range(MATCH_ROUNDS):
+		free = (partner[first] < 0) & (partner[second] < 0)
+		a = first[free]
+		b = second[free]
+		if not len(a):
+			break
+		priority = rng.random(len(a))
+		best = np.full(n, -1.0)
+		np.maximum.at(best, a, priority)
+		np.maximum.at(best, b, priority)
+		chosen = (best[a] == priority) & (best[b] == priority)
+		partner[a[chosen]] = b[chosen]
+		partner[b[chosen]] = a[chosen]
+
+	leader = np.where((partner < 0) | (np.arange(n) < partner), np.arange(n), partner)
+	# Nodes left over (typically the many leaves around a hub, which can
+	# only be matched once) join the pair of any matched neighbour
+	for a, b in ((first, second), (second, first)):
+		join = (partner[a] < 0) & (partner[b] >= 0)
+		leader[a[join]] = leader[b[join]]
+	leaders, parent = np.unique(leader, return_inverse=True)
+	return parent, len(leaders)
+
+
+def layout(node_count, first, second, seed=0, theta=THETA):
+	'''
+	  ' Lays out a graph given as arrays of edge endpoints (indices into
+		' 0 .. node_count - 1).
+		'
+		' Returns: (node_count, 2) array of positions
+	'''
+	rng = np.random.default_rng(seed)
+	first, second = _unique_edges(np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64))
+
+	hierarchy = []
+	n = node_count
+	while n > COARSEST_SIZE and len(first):
+		parent, coarse_n = _match(n, first, second, rng)
+		if coarse_n > 0.8 * n:
+			break
+		hierarchy.append((parent, first, second, n))
+		first, second = _unique_edges(parent[first], parent[second])
+		n = coarse_n
+
+	side = np.sqrt(max(n, 1))
+	pos = rng.uniform(0, side, (n, 2))
+	pos = _fruchterman_reingold(pos, first, second, COARSE_ITERATIONS, side / 4, theta)
+
+	for parent, first, second, fine_n in reversed(hierarchy):
+		pos = pos[parent] * np.sqrt(fine_n / n) + rng.normal(scale=0.1, size=(fine_n, 2))
+		n = fine_n
+		pos = _fruchterman_reingold(pos, first, second, REFINE_ITERATIONS, 1.0, theta)
+	return pos
+
+
+def layout_graph(nx_graph, seed=0):
+	'''
+	  ' Lays out a networkx graph.
+		'
+		' Returns: {node: (x, y)} in points, for `neato -n2`
+	'''
+	nodes = list(nx_graph.nodes())
+	index = {node: i for i, node in enumerate(nodes)}
+	edge_count = nx_graph.number_of_edges()
+	first = np.fromiter((index[edge[0]] for edge in nx_graph.edges()), dtype=np.int64, count=edge_count)
+	second = np.fromiter((index[edge[1]] for edge in nx_graph.edges()), dtype=np.int64, count=edge_count)
+
+	pos = layout(len(nodes), first, second, seed)
+	if len(nodes):
+		extent = pos.max(axis=0) - pos.min(axis=0)
+		spacing = max(np.sqrt(extent[0] * extent[1] / len(nodes)), extent.max() / len(nodes), 1e-9)
+		pos = (pos - pos.min(axis=0)) * (NODE_SPACING / spacing)
+	return {node: (pos[i, 0], pos[i, 1]) for i, node in enumerate(nodes)}
@@ -0,0 +1,215 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import math
+
+import networkx as nx
+from networkx.algorithms import community
+
+'''
+  ' Level-of-detail reduction for rendering very large graphs.
+	'
+	' reduce_graph() turns a graph into one with at most `budget` nodes:
+	'   1. leaves (nodes with a single connection) are folded into their
+	'      neighbour, which shows how many it absorbed as a badge
+	'   2. while there are still too many nodes, communities (Louvain) are
+	'      merged into super-nodes, repeating on the coarsened graph
+	'   3. if that stops making progress, the smallest nodes are lumped
+	'      together into one
+	' Every node of the result lists the original node ids it stands for
+	' in its 'members' attribute, and every edge counts the original
+	' connections it stands for in 'weight'.
+'''
+
+MAX_RESOLUTION = 64
+
+
+def collapse_leaves(graph):
+	'''
+	  ' Returns a copy of graph (nodes labelled with 'label') in the reduced
+		' form described above, with every leaf folded into its neighbour.
+		' Of two nodes connected only to each other, the one with the
+		' higher id is folded into the other.
+	'''
+	reduced = nx.Graph()
+	for node, data in graph.nodes(data=True):
+		reduced.add_node(node, label=data.get('label', str(node)), members=[node], leaves=0)
+	for first, second in graph.edges():
+		if first == second:
+			continue
+		if reduced.has_edge(first, second):
+			reduced[first][second]['weight'] += 1
+		else:
+			reduced.add_edge(first, second, weight=1)
+
+	for node in list(reduced.nodes()):
+		if node not in reduced or reduced.degree(node) != 1:
+			continue
+		parent = next(iter(reduced[node]))
+		if reduced.degree(parent) == 1 and parent > node:
+			continue # the parent will be folded into this node instead
+		reduced.nodes[parent]['members'].extend(reduced.nodes[node]['members'])
+		reduced.nodes[parent]['leaves'] += 1 + reduced.nodes[node]['leaves']
+		reduced.remove_node(node)
+	return reduced
+
+
+def _quotient(reduced, parts):
+	'''
+	  ' Merges each set of nodes in parts into one super-node, named after
+		' its best-connected member.
+	'''
+	strength = dict(reduced.degree(weight='weight'))
+	owner = {}
+	coarse = nx.Graph()
+	for part in parts:
+		hub = max(part, key=lambda node: (strength[node], len(reduced.nodes[node]['members']), -node))
+		members = []
+		leaves = 0
+		for node in part:
+			owner[node] = hub
+			members.extend(reduced.nodes[node]['members'])
+			leaves = leaves + reduced.nodes[node]['leaves']
+		coarse.add_node(hub, label=reduced.nodes[hub]['label'], members=members, leaves=leaves)
+
+	for first, second, data in reduced.edges(data=True):
+		first = owner[first]
+		second = owner[second]
+		if first == second:
+			continue
+		if coarse.has_edge(first, second):
+			coarse[first][second]['weight'] += data['weight']
+		else:
+			coarse.add_edge(first, second, weight=data['weight'])
+	return coarse
+
+
+def coarsen(reduced, budget, seed=0):
+	'''
+	  ' Merges communities of a reduced graph until at most budget nodes
+		' are left.
+	'''
+	budget = max(int(budget), 1)
+	level = reduced
+	while level.number_of_nodes() > budget:
+		parts = community.louvain_communities(level, weight='weight', seed=seed)
+		# Louvain tends to overshoot the budget by a lot on big graphs; a
+		# higher resolution gives smaller communities, so use as much
+		# detail as fits
+		resolution = 1
+		while len(parts) < budget // 2 and resolution < MAX_RESOLUTION:
+			resolution = resolution * 2
+			finer = community.louvain_communities(level, weight='weight', resolution=resolution, seed=seed)
+			if len(finer) > budget:
+				break
+			parts = finer
+		if len(parts) >= level.number_of_nodes():
+			break
+		level = _quotient(level, parts)
+
+	if level.number_of_nodes() > budget:
+		# No more community structure to exploit (e.g. many disconnected
+		# pieces): keep the largest nodes and lump the rest together
+		by_size = sorted(level.nodes(), key=lambda node: (-len(level.nodes[node]['members']), node))
+		kept = by_size[:budget - 1]
+		rest = by_size[budget - 1:]
+		level = _quotient(level, [[node] for node in kept] + [rest])
+		for node in rest:
+			if node in level:
+				level.nodes[node]['label'] = str(len(rest)) + ' others'
+	return level
+
+
+def reduce_graph(graph, budget, expand=None, seed=0):
+	'''
+	  ' Reduces graph to at most budget nodes (see the top of this file).
+		'
+		' Parameters:
+		'   graph = networkx graph of the file, nodes labelled with 'label'
+		'   budget = maximum number of nodes to keep
+		'   expand = optional original node id: the super-node containing
+		'            it is opened up, itself reduced to budget nodes, and
+		'            connected to the other super-nodes
+		'   seed = community detection seed, so renders are repeatable
+		'
+		' Returns: the reduced graph
+	'''
+	reduced = collapse_leaves(graph)
+	coarse = coarsen(reduced, budget, seed)
+	if expand is None:
+		return coarse
+
+	owner = {}
+	for node, data in coarse.nodes(data=True):
+		for member in data['members']:
+			owner[member] = node
+	cluster = owner.get(expand)
+	if cluster is None:
+		return coarse
+
+	inside = [node for node in reduced.nodes() if owner[node] == cluster]
+	detail = coarsen(reduced.subgraph(inside).copy(), budget, seed)
+	for node, data in detail.nodes(data=True):
+		for member in data['members']:
+			owner[member] = ('detail', node)
+
+	expanded = nx.Graph()
+	for node, data in coarse.nodes(data=True):
+		if node != cluster:
+			expanded.add_node(node, **data)
+	for node, data in detail.nodes(data=True):
+		expanded.add_node(('detail', node), **data)
+	for first, second, data in reduced.edges(data=True):
+		first = owner[first]
+		second = owner[second]
+		if first == second:
+			continue
+		if expanded.has_edge(first, second):
+			expanded[first][second]['weight'] += data['weight']
+		else:
+			expanded.add_edge(first, second, weight=data['weight'])
+	return expanded
+
+
+def display_graph(reduced, styles=None):
+	'''
+	  ' Converts a reduced graph into one carrying only graphviz
+		' attributes: super-nodes grow with the number of people they stand
+		' for and carry it as a badge, and edges thicken with the number of
+		' connections they stand for. styles optionally maps nodes of the
+		' reduced graph to further attributes, which take precedence.
+	'''
+	display = nx.Graph()
+	index = {}
+	for node, data in reduced.nodes(data=True):
+		index[node] = len(index)
+		size = len(data['members'])
+		label = str(data['label'])
+		if size > 1 + data['leaves']:
+			label = label + '\n(' + str(size) + ' people)'
+		elif data['leaves']:
+			label = label + '\n(+' + str(data['leaves']) + ')'
+		display.add_node(index[node], label=label, width='{:.2f}'.format(0.5 + 0.25 * math.log2(size)))
+		if styles and node in styles:
+			display.nodes[index[node]].update(styles[node])
+	for first, second, data in reduced.edges(data=True):
+		display.add_edge(index[first], index[second], penwidth='{:.2f}'.format(1.0 + math.log2(data['weight'])))
+	return display
@@ -0,0 +1,272 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import collections
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+'''
+  ' Profiling tools:
+	'   command_profile  runs one call under cProfile (and optionally
+	'                    tracemalloc), for the `profile` command
+	'   sampling_profiler  a low-overhead statistical profiler which
+	'                    records the call stacks of threads inside
+	'                    instrumented sections (render, listing and lookup)
+	'                    every few milliseconds, for the profile_sampling
+	'                    config flag
+'''
+
+SAMPLE_INTERVAL = 0.005
+
+
+def _fmt_seconds(seconds):
+	if seconds < 1.0:
+		return '{:.1f}ms'.format(seconds * 1000.0)
+	return '{:.2f}s'.format(seconds)
+
+
+def _frame_label(code):
+	return os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + '(' + code.co_name + ')'
+
+
+def _fmt_bytes(count):
+	for unit in ('B', 'KiB', 'MiB'):
+		if count < 1024:
+			return '{:.1f}'.format(count).rstrip('0').rstrip('.') + unit
+		count = count / 1024.0
+	return '{:.1f}GiB'.format(count)
+
+
+
+class command_profile:
+	'''
+	  ' Deterministic profile of one call: every function call is timed
+		' with cProfile, and with memory=True, allocations are traced with
+		' tracemalloc to find the peak memory use (which slows the call
+		' down considerably).
+	'''
+
+	def __init__(self, memory=False):
+		self.memory = memory
+		self.profiler = cProfile.Profile()
+		self.seconds = None
+		self.peak_memory = None
+
+	def run(self, func, *args):
+		'''
+		  ' Calls func(*args) under the profiler and returns its result.
+			' Exceptions are passed on once profiling has stopped.
+		'''
+		started_tracing = False
+		if self.memory:
+			if tracemalloc.is_tracing():
+				tracemalloc.reset_peak()
+			else:
+				tracemalloc.start()
+				started_tracing = True
+			base = tracemalloc.get_traced_memory()[0]
+
+		start = time.perf_counter()
+		self.profiler.enable()
+		try:
+			return func(*args)
+		finally:
+			self.profiler.disable()
+			self.seconds = time.perf_counter() - start
+			if self.memory:
+				self.peak_memory = tracemalloc.get_traced_memory()[1] - base
+				if started_tracing:
+					tracemalloc.stop()
+
+	def report(self, limit=20):
+		'''
+		  ' Returns human-readable lines: the wall time, the peak memory (if
+			' traced) and the limit functions with the highest cumulative
+			' time.
+		'''
+		lines = ['Took ' + _fmt_seconds(self.seconds) + '.']
+		if self.peak_memory is not None:
+			lines.append('Peak memory: ' + _fmt_bytes(self.peak_memory) + ' above the starting point.')
+		out = io.StringIO()
+		pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+		# Skip pstats' preamble; keep the header row and the table
+		table = out.getvalue().splitlines()
+		for index, line in enumerate(table):
+			if line.lstrip().startswith('ncalls'):
+				table = table[index:]
+				break
+		lines.extend(line for line in table if line.strip())
+		return lines
+
+	def dump(self, path):
+		'''
+		  ' Writes the profile in pstats format (for `python -m pstats`,
+			' snakeviz and similar tools).
+			'
+			' Returns:
+			'   0 = success
+			'   3 = could not write the file
+		'''
+		try:
+			self.profiler.dump_stats(path)
+		except OSError:
+			return 3
+		return 0
+
+
+
+class sampling_profiler:
+	'''
+	  ' Statistical profiler: while any thread is inside a section(), a
+		' background thread wakes up every interval seconds and records the
+		' call stack of each such thread against the section's name. The
+		' profiled code only pays for entering and leaving sections, so it
+		' can stay on in production.
+	'''
+
+	def __init__(self, interval=SAMPLE_INTERVAL):
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.busy = threading.Event()
+		self.active = {}       # thread id -> names of the sections it is in
+		self.stacks = collections.Counter() # (section, stack) -> samples
+		self.started = time.time()
+		self.thread = None
+		self.stopped = False
+
+	@contextlib.contextmanager
+	def section(self, name):
+		'''
+		  ' Samples the calling thread until the block ends. Nested sections
+			' are attributed to the outermost one.
+		'''
+		ident = threading.get_ident()
+		if self.stopped:
+			yield
+			return
+		with self.lock:
+			self.active.setdefault(ident, []).append(name)
+			self.busy.set()
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.__sample, name='pysocial-sampler', daemon=True)
+				self.thread.start()
+		try:
+			yield
+		finally:
+			with self.lock:
+				sections = self.active[ident]
+				sections.pop()
+				if not sections:
+					del self.active[ident]
+				if not self.active:
+					self.busy.clear()
+
+	def __sample(self):
+		while True:
+			self.busy.wait()
+			time.sleep(self.interval)
+			if self.stopped:
+				return
+			with self.lock:
+				targets = dict((ident, sections[0]) for ident, sections in self.active.items())
+			frames = sys._current_frames()
+			for ident, name in targets.items():
+				frame = frames.get(ident)
+				stack = []
+				while frame is not None:
+					stack.append(_frame_label(frame.f_code))
+					frame = frame.f_back
+				stack.reverse()
+				with self.lock:
+					self.stacks[(name, tuple(stack))] += 1
+
+	def stop(self):
+		'''
+		  ' Stops sampling for good and lets the sampling thread exit.
+		'''
+		self.stopped = True
+		self.busy.set()
+		if self.thread is not None:
+			self.thread.join()
+
+	def reset(self):
+		with self.lock:
+			self.stacks.clear()
+			self.started = time.time()
+
+	def report(self, limit=15):
+		'''
+		  ' Returns human-readable lines: per section, the number of samples
+			' and the functions which were running (self) or on the stack
+			' (total) in the largest share of them.
+		'''
+		with self.lock:
+			stacks = list(self.stacks.items())
+		lines = ['Sampling profile for the last ' + _fmt_seconds(time.time() - self.started) + ' (one sample every ' + _fmt_seconds(self.interval) + '):']
+		if not stacks:
+			lines.append('  No samples yet.')
+			return lines
+
+		sections = collections.Counter()
+		for (name, stack), count in stacks:
+			sections[name] += count
+		for name, samples in sections.most_common():
+			own = collections.Counter()
+			total = collections.Counter()
+			for (section, stack), count in stacks:
+				if section != name:
+					continue
+				if stack:
+					own[stack[-1]] += count
+				for label in set(stack):
+					total[label] += count
+			lines.append('  ' + name + ': ' + str(samples) + ' sample(s)')
+			lines.append('    {:>6} {:>6}  {}'.format('self', 'total', 'function'))
+			for label, count in own.most_common(limit):
+				lines.append('    {:>5.1f}% {:>5.1f}%  {}'.format(100.0 * count / samples, 100.0 * total[label] / samples, label))
+		return lines
+
+	def write_collapsed(self, path):
+		'''
+		  ' Writes the samples as collapsed stacks ("section;outer;...;inner
+			' count" per line), the input format of flamegraph.pl, speedscope
+			' and similar tools.
+			'
+			' Returns:
+			'   0 = success
+			'   3 = could not write the file
+		'''
+		with self.lock:
+			stacks = list(self.stacks.items())
+		try:
+			with open(path, 'w') as out:
+				for (name, stack), count in sorted(stacks):
+					out.write(';'.join((name,) + stack) + ' ' + str(count) + '\n')
+		except OSError:
+			return 3
+		return 0
@@ -21,15 +21,34 @@ along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
 
 import networkx as nx
 import pygraphviz as pgv
+import bisect
+import math
+import time
 
 from social import database_io, configurer
 from social_ui import ui, none_ui
+from social_snapshot import graph_snapshot, snapshot_error
+import social_layout
+import social_lod
+
+'''
+  ' Node metric mapping (render -size / -color): widths run from
+	' MIN_WIDTH to MAX_WIDTH inches with the square root of the value, and
+	' fill colours step through the graphviz/ColorBrewer scheme
+	' COLOR_SCHEME by rank.
+'''
+MIN_WIDTH = 0.4
+MAX_WIDTH = 2.5
+COLOR_SCHEME = 'ylorrd9'
+COLOR_STEPS = 9
 
 class renderer:
 	
 	def __init__(self, db, config, ui=None):
 		self.config = config
 		self.db = db
+		self.graph_cache = None
+		self.reduce_cache = None
 		if ui:
 			self.ui = ui
 		else:
@@ -42,29 +61,278 @@ class renderer:
 		else:
 			return 1
 	
-	def render(self, output_path, render_prog=None):
-		if not self.db.is_connected():
-			self.ui.log_error('Cannot render image while database is disconnected!')
-			return 1
+	def render(self, output_path, render_prog=None, snapshot_path=None, budget=None, expand=None, size_metric=None, color_metric=None):
+		'''
+		  ' Renders the open file (or, if snapshot_path is given, a snapshot
+			' written by `snapshot`, without touching the database).
+			'
+			' Graphs with more than budget nodes (default: config render_budget,
+			' unset = no limit) are drawn at a lower level of detail: see
+			' social_lod. expand names a node whose cluster should be drawn
+			' opened up.
+			'
+			' size_metric and color_metric name node metrics stored by
+			' `analyze` (see database_io.node_metrics) to draw as node size and
+			' fill colour. They are ignored for snapshots.
+			'
+			' Returns:
+			'   0 = success
+			'   1 = database is disconnected
+			'   2 = no file is open
+			'   3 = could not load the snapshot
+			'   4 = the node to expand does not exist
+			'   5 = unknown metric
+		'''
+		with self.db.sampling('render'):
+			return self.__render(output_path, render_prog, snapshot_path, budget, expand, size_metric, color_metric)
+
+	def __render(self, output_path, render_prog, snapshot_path, budget, expand, size_metric, color_metric):
+		if snapshot_path:
+			try:
+				with graph_snapshot(snapshot_path) as snap:
+					nx_graph = self.build_graph(snap.nodes(), snap.connections())
+			except snapshot_error as err:
+				self.ui.log_error('Could not load snapshot: ' + str(err))
+				return 3
+		else:
+			if not self.db.is_connected():
+				self.ui.log_error('Cannot render image while database is disconnected!')
+				return 1
+
+			if not self.db.current_file():
+				self.ui.log_error('Cannot render when no file is open!')
+				return 2
+
+			nx_graph = self.file_graph()
+
+		metrics = {}
+		for role, metric in (('size', size_metric), ('color', color_metric)):
+			if not metric:
+				continue
+			if snapshot_path:
+				self.ui.log_warning('Node metrics are not available for snapshots; ignoring -' + role)
+				continue
+			values = self.db.node_metrics(metric)
+			if values is None:
+				self.ui.log_error('Unknown node metric ' + str(metric))
+				return 5
+			metrics[role] = (metric, values)
+
+		if budget is None:
+			budget = self.config.retrieve('render_budget')
+		if expand is not None:
+			expand_ids = sorted(node for node, label in nx_graph.nodes(data='label') if label == expand)
+			if not expand_ids:
+				self.ui.log_error('Could not find a node named ' + str(expand) + ' to expand')
+				return 4
+			if len(expand_ids) > 1:
+				self.ui.log_warning('There are ' + str(len(expand_ids)) + ' nodes named ' + str(expand) + '; expanding the cluster of the first one')
+			if not budget:
+				self.ui.log_warning('-expand has no effect without a node budget')
+		if budget and nx_graph.number_of_nodes() > budget:
+			reduced = self.reduce_graph(nx_graph, budget, expand_ids[0] if expand is not None else None)
+			styles = None
+			if metrics:
+				styles = self.metric_styles({node: members for node, members in reduced.nodes(data='members')}, metrics)
+			nx_graph = social_lod.display_graph(reduced, styles)
+		elif metrics or render_prog == social_layout.LAYOUT_PROG:
+			nx_graph = nx_graph.copy() # the file's graph may be cached
+			if metrics:
+				for node, attributes in self.metric_styles({node: (node,) for node in nx_graph.nodes()}, metrics).items():
+					nx_graph.nodes[node].update(attributes)
+		if render_prog == social_layout.LAYOUT_PROG:
+			self.place(nx_graph)
 
-		if not self.db.current_file():
-			self.ui.log_error('Cannot render when no file is open!')
-			return 2
+		pgv_graph = nx.drawing.nx_agraph.to_agraph(nx_graph)
+		return self.draw(pgv_graph, output_path, render_prog)
+	
+
+	def reduce_graph(self, nx_graph, budget, expand_id=None):
+		'''
+		  ' Reduces nx_graph to at most budget nodes (see social_lod), so
+			' layout and drawing time depend on the budget, not the file size.
+			' The result for the open file is kept until the file changes.
+			' Convert it with social_lod.display_graph() to draw it.
+		'''
+		key = None
+		if self.graph_cache and self.graph_cache[1] is nx_graph:
+			key = (self.graph_cache[0], budget, expand_id)
+			if self.reduce_cache and self.reduce_cache[0] == key:
+				return self.reduce_cache[1]
+
+		stats = self.db.stats()
+		start = time.perf_counter()
+		node_count = nx_graph.number_of_nodes()
+		reduced = social_lod.reduce_graph(nx_graph, budget, expand_id)
+		if stats:
+			stats.record_timing('render.reduce', time.perf_counter() - start)
+		self.ui.log('Drawing ' + str(node_count) + ' nodes as ' + str(reduced.number_of_nodes()) + ' (node budget ' + str(budget) + ')')
+
+		if key:
+			self.reduce_cache = (key, reduced)
+		return reduced
+	
+
+	def metric_styles(self, groups, metrics):
+		'''
+		  ' Maps node metrics to graphviz attributes (see the top of this
+			' file).
+			'
+			' Parameters:
+			'   groups = {graph node: ids of the people it stands for}; a node
+			'            standing for several people takes their highest value
+			'   metrics = {'size' and/or 'color': (metric name, {node id:
+			'             value})}
+			'
+			' Returns: {graph node: {attribute: value}}
+		'''
+		styles = {node: {} for node in groups}
+		for role, (metric, values) in metrics.items():
+			merged = {}
+			for node, members in groups.items():
+				present = [values[member] for member in members if member in values]
+				if present:
+					merged[node] = max(present)
+			if len(merged) < len(groups):
+				self.ui.log_warning(str(len(groups) - len(merged)) + ' node(s) have no ' + metric + ' value; run `analyze` to update them')
+			if not merged:
+				continue
+
+			if role == 'size':
+				top = max(merged.values())
+				for node, value in merged.items():
+					width = MIN_WIDTH
+					if top > 0:
+						width = MIN_WIDTH + (MAX_WIDTH - MIN_WIDTH) * math.sqrt(max(value, 0) / top)
+					styles[node]['width'] = styles[node]['height'] = '{:.2f}'.format(width)
+			else:
+				ranked = sorted(merged.values())
+				for node, value in merged.items():
+					step = 1 + (COLOR_STEPS * bisect.bisect_left(ranked, value)) // len(ranked)
+					styles[node].update(style='filled', colorscheme=COLOR_SCHEME, fillcolor=str(step))
+		return styles
+	
 
+	def file_graph(self):
+		'''
+		  ' Returns the graph of the open file, reusing the one built last
+			' time if the file has not changed since. Do not modify it.
+		'''
+		changes = self.db.change_count()
+		key = (self.db.file_id, changes)
+		if changes is not None and self.graph_cache and self.graph_cache[0] == key:
+			return self.graph_cache[1]
+
+		nx_graph = self.build_graph(self.db.list_nodes(), self.db.list_connections())
+		if changes is not None:
+			self.graph_cache = (key, nx_graph)
+		else:
+			self.graph_cache = None
+		return nx_graph
+	
+
+	def build_graph(self, nodes, connections):
+		'''
+		  ' Builds a networkx graph from (name, id) node rows and
+			' (first_id, second_id, ...) connection rows.
+		'''
 		nx_graph = nx.Graph()
-		nodes = self.db.list_nodes()
-		connections = self.db.list_connections()
 		for node in nodes:
 			nx_graph.add_node(node[1], label=node[0])
 
 		for connection in connections:
 			nx_graph.add_edge(connection[0], connection[1])
 
-		pgv_graph = nx.drawing.nx_agraph.to_agraph(nx_graph)
+		return nx_graph
+	
 
-		if render_prog:
-			pgv_graph.draw(str(output_path),prog=render_prog)
-		else:
-			pgv_graph.draw(str(output_path),prog='circo')
+	def place(self, nx_graph):
+		'''
+		  ' Lays out nx_graph with the built-in engine (see social_layout),
+			' storing the positions in each node's 'pos' attribute (which
+			' to_agraph() passes on to graphviz as pinned positions)
+		'''
+		stats = self.db.stats()
+		start = time.perf_counter()
+		positions = social_layout.layout_graph(nx_graph)
+		for node, (x, y) in positions.items():
+			nx_graph.nodes[node]['pos'] = (round(float(x), 2), round(float(y), 2))
+		if stats:
+			stats.record_timing('render.layout (' + social_layout.LAYOUT_PROG + ')', time.perf_counter() - start)
+	
+
+	def draw(self, pgv_graph, output_path, render_prog=None):
+		if not render_prog:
+			render_prog = 'circo'
+
+		if render_prog == social_layout.LAYOUT_PROG:
+			# Positions were set by place(); nop2 (neato -n2) keeps them and
+			# only routes the edges
+			render_prog = 'nop2'
+
+		stats = self.db.stats()
+		start = time.perf_counter()
+		pgv_graph.layout(prog=render_prog)
+		if stats:
+			stats.record_timing('render.layout (' + render_prog + ')', time.perf_counter() - start)
+
+		start = time.perf_counter()
+		pgv_graph.draw(str(output_path))
+		if stats:
+			stats.record_timing('render.draw', time.perf_counter() - start)
+
+		return 0
+	
+
+	def watch(self, output_path, render_prog=None, debounce=None, max_delay=None, renders=None):
+		'''
+		  ' Renders the open file, then renders it again whenever any session
+			' changes it, until interrupted (KeyboardInterrupt) or the file is
+			' deleted.
+			'
+			' Bursts of changes are coalesced: once a change arrives, further
+			' changes are absorbed until none has arrived for debounce seconds
+			' (config watch_debounce, default 0.5), or max_delay seconds
+			' (default 10 * debounce) have passed, and then the file is
+			' rendered once.
+			'
+			' Parameters:
+			'   renders = stop after this many re-renders (default: never)
+			'
+			' Returns:
+			'   0 = stopped
+			'   1, 2 = as render()
+			'   4 = the file was deleted
+		'''
+		if debounce is None:
+			debounce = self.config.retrieve('watch_debounce') or 0.5
+		if max_delay is None:
+			max_delay = 10 * debounce
+
+		ret = self.render(output_path, render_prog)
+		if ret != 0:
+			return ret
+
+		listener = self.db.change_listener()
+		count = 0
+		try:
+			while renders is None or count < renders:
+				if not listener.wait(1.0):
+					continue
+				deadline = time.monotonic() + max_delay
+				while time.monotonic() < deadline and listener.wait(min(debounce, max(deadline - time.monotonic(), 0))):
+					pass
 
+				if listener.change_count() is None:
+					self.ui.log_warning('The file was deleted; no longer watching it.')
+					return 4
+				self.ui.log('File changed; rendering again')
+				ret = self.render(output_path, render_prog)
+				if ret != 0:
+					return ret
+				count = count + 1
+		except KeyboardInterrupt:
+			pass
+		finally:
+			listener.close()
 		return 0
@@ -0,0 +1,360 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import json
+import os
+import socket
+import sys
+
+from social_ui import basic_console_ui, buffered_writer, parse_yn
+
+'''
+  ' Server mode: one long-lived process keeps the database connection,
+	' the imports and the renderer's caches warm, and runs console commands
+	' sent over a Unix domain socket, one client at a time. All clients
+	' share the server's state, including the open file.
+	'
+	' The client side only needs this module (no networkx, pygraphviz or
+	' database driver), so it starts quickly.
+	'
+	' Protocol: one JSON object per line in each direction.
+	'   client -> server:
+	'     {"command": "<console command line>"}
+	'     {"answer": "<reply to a prompt>"}
+	'   server -> client:
+	'     {"out": "<text to print as-is>"}
+	'     {"prompt": "<yes/no question>"}, answered with "answer"
+	'     {"done": true, "file": <open file name or null>} after each command
+	'     {"error": "<what went wrong>", "file": <as above>} instead, after
+	'       a command which failed (its changes are rolled back)
+	'     {"bye": true} before closing the connection
+'''
+
+DEFAULT_SOCKET = 'pysocial.sock'
+
+
+class connection_closed(BaseException):
+	'''
+	  ' Raised when the client of a socket_ui goes away
+	'''
+
+
+
+def socket_path(config_path='social-config.json'):
+	'''
+	  ' Returns the server_socket path from the config file, without
+		' loading the rest of pysocial, or DEFAULT_SOCKET.
+	'''
+	try:
+		with open(config_path) as config_file:
+			return json.load(config_file).get('server_socket') or DEFAULT_SOCKET
+	except (OSError, ValueError):
+		return DEFAULT_SOCKET
+
+
+
+class _out_stream:
+	'''
+	  ' Stream for buffered_writer which sends each chunk as one message
+	'''
+	def __init__(self, client):
+		self.client = client
+
+	def write(self, text):
+		self.client.send({'out':text})
+
+	def flush(self):
+		pass
+
+
+
+class socket_ui(basic_console_ui):
+	'''
+	  ' Console UI for one client of the server: the same commands, with
+		' output and prompts going over the connection. `exit` only ends the
+		' connection; `shutdown` also stops the server.
+	'''
+
+	def __init__(self, config, db_io, rend, stream):
+		basic_console_ui.__init__(self, config, db_io, rend)
+		self.stream = stream
+		self.stop_server = False
+		self.command_lut['shutdown'] = self.cmd_shutdown
+
+	def send(self, message):
+		try:
+			self.stream.write((json.dumps(message) + '\n').encode('utf-8'))
+		except OSError:
+			raise connection_closed()
+
+	def receive(self):
+		try:
+			self.stream.flush()
+			line = self.stream.readline()
+		except OSError:
+			raise connection_closed()
+		if not line:
+			raise connection_closed()
+		try:
+			return json.loads(line.decode('utf-8'))
+		except ValueError:
+			raise connection_closed()
+
+	def serve(self):
+		'''
+		  ' Runs the client's commands until it disconnects or exits
+		'''
+		self.db.hook_ui(self)
+		self.rend.hook_ui(self)
+		try:
+			while self.keep_going:
+				request = self.receive()
+				failure = None
+				try:
+					carryover = self.parse(request.get('command'))
+					while carryover and self.keep_going:
+						carryover = self.parse(carryover)
+				except Exception as err:
+					# One failed command must not take the server down
+					failure = repr(err)
+					self.log_severe('Command failed: ' + failure)
+					self.recover()
+				if failure is not None:
+					self.send({'error':failure, 'file':self.db.current_file()})
+				elif self.keep_going:
+					self.send({'done':True, 'file':self.db.current_file()})
+			self.send({'bye':True})
+			self.stream.flush()
+		except connection_closed:
+			pass
+
+	def recover(self):
+		'''
+		  ' Undoes whatever a failed command left behind: its uncommitted
+			' rows on the connection every client shares (which on PostgreSQL
+			' would also leave the transaction aborted), and any write-behind
+			' changes, which may be half-applied.
+		'''
+		if not self.db.is_connected():
+			return
+		try:
+			self.db.database.rollback()
+			if self.db.pending_changes():
+				self.log_warning('Discarding unsaved write-behind changes after the failed command.')
+			self.db.discard_pending()
+		except Exception as err:
+			self.log_severe('Could not roll back the failed command: ' + repr(err))
+
+	def cmd_exit(self, args):
+		# Unlike the console, leave the database open (and any write-behind
+		# changes pending) for the next client
+		self.write('Goodbye.\n')
+		self.keep_going = False
+
+	def cmd_shutdown(self, args):
+		self.write('Stopping the server.')
+		self.stop_server = True
+		self.keep_going = False
+
+	def cmd_watch(self, args):
+		self.log_error('`watch` would block the server; run it from a console instead.')
+
+	def write(self, message):
+		self.send({'out':str(message) + '\n'})
+
+	def write_lines(self, messages):
+		with buffered_writer(_out_stream(self)) as out:
+			for message in messages:
+				out.write(message)
+
+	def log(self, message, level=5):
+		self.write('[' + str(level) + ']: ' + str(message))
+
+	def prompt_yn(self, prompt_text, default_resp=False):
+		self.send({'prompt':str(prompt_text) + ' [Y/N] >'})
+		return parse_yn(str(self.receive().get('answer', '')), default_resp)
+
+
+
+class command_server:
+	'''
+	  ' Serves console commands over a Unix domain socket. db_io must
+		' already be connected (see social_cli.py); ui gets the server's own
+		' log messages.
+	'''
+
+	def __init__(self, config, db_io, rend, ui, path=None):
+		self.config = config
+		self.db = db_io
+		self.rend = rend
+		self.ui = ui
+		self.path = path or config.retrieve('server_socket') or DEFAULT_SOCKET
+
+	def serve_forever(self):
+		'''
+		  ' Accepts clients until one sends `shutdown` or the process is
+			' interrupted, then saves pending changes and disconnects.
+			'
+			' Returns:
+			'   0 = stopped
+			'   1 = could not listen on the socket
+			'   2 = stopped, but pending changes could not be saved
+		'''
+		if os.path.exists(self.path):
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(self.path)
+				probe.close()
+				self.ui.log_error('A server is already listening on ' + str(self.path))
+				return 1
+			except OSError:
+				probe.close()
+				os.unlink(self.path) # left over from a server which died
+
+		listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		old_umask = os.umask(0o177) # only this user may connect
+		try:
+			listener.bind(self.path)
+		except OSError as err:
+			self.ui.log_error('Could not listen on ' + str(self.path) + ': ' + str(err))
+			listener.close()
+			return 1
+		finally:
+			os.umask(old_umask)
+		listener.listen(8)
+		self.ui.log('Listening on ' + str(self.path))
+
+		try:
+			while True:
+				conn, address = listener.accept()
+				with conn, conn.makefile('rwb') as stream:
+					client = socket_ui(self.config, self.db, self.rend, stream)
+					client.serve()
+				self.db.hook_ui(self.ui)
+				self.rend.hook_ui(self.ui)
+				if client.stop_server:
+					break
+		except KeyboardInterrupt:
+			pass
+		finally:
+			listener.close()
+			os.unlink(self.path)
+
+		self.ui.log('Server stopped.')
+		if self.db.end() != 0:
+			self.ui.log_error('Could not save pending changes.')
+			return 2
+		return 0
+
+
+
+def run_client(path=None, commands=None):
+	'''
+	  ' Forwards commands to a server and prints the replies.
+		'
+		' Parameters:
+		'   path = socket to connect to (default: from the config file)
+		'   commands = list of command lines; if None, they are read from
+		'              standard input, with a prompt on a terminal
+		'
+		' Returns:
+		'   0 = success
+		'   1 = could not connect to the server
+		'   2 = a command failed
+	'''
+	path = path or socket_path()
+	conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		conn.connect(path)
+	except OSError as err:
+		print('Could not connect to the pysocial server at ' + str(path) + ': ' + str(err))
+		return 1
+
+	failed = False
+	with conn, conn.makefile('rwb') as stream:
+		if commands is not None:
+			for command in commands:
+				still_open, file_name, ok = _forward(stream, command)
+				failed = failed or not ok
+				if not still_open:
+					break
+		else:
+			interactive = sys.stdin.isatty()
+			file_name = None
+			while True:
+				try:
+					if interactive:
+						prompt_string = '[pysocial] '
+						if file_name:
+							prompt_string = prompt_string + file_name + ' '
+						line = input(prompt_string + '>')
+					else:
+						line = sys.stdin.readline()
+						if not line:
+							break
+				except EOFError:
+					break
+				if not line.strip():
+					continue
+				still_open, file_name, ok = _forward(stream, line)
+				failed = failed or not ok
+				if not still_open:
+					break
+	sys.stdout.flush()
+	if failed:
+		return 2
+	return 0
+
+
+
+def _forward(stream, command):
+	'''
+	  ' Sends one command line to the server and prints the replies.
+		'
+		' Returns: (True, open file name, whether the command succeeded)
+		'          once the command is done, or (False, None, True) if the
+		'          server closed the connection
+	'''
+	def send(message):
+		stream.write((json.dumps(message) + '\n').encode('utf-8'))
+		stream.flush()
+
+	send({'command':command})
+	for line in stream:
+		reply = json.loads(line.decode('utf-8'))
+		if 'out' in reply:
+			sys.stdout.write(reply['out'])
+		elif 'prompt' in reply:
+			sys.stdout.flush()
+			try:
+				send({'answer':input(reply['prompt'])})
+			except EOFError:
+				send({'answer':''})
+		elif 'done' in reply:
+			sys.stdout.flush()
+			return (True, reply['file'], True)
+		elif 'error' in reply:
+			sys.stdout.flush()
+			sys.stderr.write('Command failed: ' + str(reply['error']) + '\n')
+			return (True, reply['file'], False)
+		elif 'bye' in reply:
+			break
+	return (False, None, True)
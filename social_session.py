@@ -0,0 +1,185 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import re
+import time
+
+
+def like_to_regex(pattern):
+	'''
+	  ' Translates a SQL LIKE pattern (% and _ wildcards) into a compiled
+		' regular expression with the same meaning.
+	'''
+	parts = []
+	for char in pattern:
+		if char == '%':
+			parts.append('.*')
+		elif char == '_':
+			parts.append('.')
+		else:
+			parts.append(re.escape(char))
+	return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+
+def _page(rows, key, limit, after):
+	if after is not None:
+		rows = [row for row in rows if row[key] > int(after)]
+	if limit is not None or after is not None:
+		rows.sort(key=lambda row: row[key])
+	if limit is not None:
+		rows = rows[:int(limit)]
+	return rows
+
+
+class graph_session:
+	'''
+	  ' In-memory copy of one file, used by database_io in write-behind
+		' mode. Lookups and listings are answered from memory; new nodes and
+		' connections are applied to memory immediately and queued in a
+		' mutation log until database_io.flush() writes them out in bulk.
+		'
+		' The session remembers how many rows the database held for the file
+		' when it last synchronized, which lets flush() notice cheaply when
+		' another session has written to the same file in the meantime.
+	'''
+
+	def __init__(self, file_id):
+		self.file_id = file_id
+		self.nodes = {}       # node id -> name
+		self.names = {}       # name -> list of node ids
+		self.connections = {} # connection id -> (first id, second id)
+		self.pairs = set()    # (min id, max id) for every connection
+		self.pending_nodes = []
+		self.pending_connections = []
+		self.db_node_count = 0
+		self.db_connection_count = 0
+		self.version = None   # files.version when loaded
+		self.last_flush = time.time()
+
+	def load(self, nodes, connections):
+		'''
+		  ' Absorbs rows read from the database.
+			'
+			' Parameters:
+			'   nodes = (name, id) rows
+			'   connections = (first_id, second_id, connection_id) rows
+		'''
+		for node in nodes:
+			self.__remember_node(node[0], node[1])
+		for cxn in connections:
+			self.__remember_connection(cxn[0], cxn[1], cxn[2])
+		self.db_node_count = self.db_node_count + len(nodes)
+		self.db_connection_count = self.db_connection_count + len(connections)
+
+	def __remember_node(self, name, node_id):
+		self.nodes[node_id] = name
+		if name in self.names:
+			self.names[name].append(node_id)
+		else:
+			self.names[name] = [node_id]
+
+	def __remember_connection(self, first_id, second_id, connection_id):
+		self.connections[connection_id] = (first_id, second_id)
+		self.pairs.add((min(first_id, second_id), max(first_id, second_id)))
+
+	def add_node(self, name, node_id):
+		self.__remember_node(name, node_id)
+		self.pending_nodes.append((name, node_id, self.file_id))
+
+	def add_connection(self, first_id, second_id, connection_id):
+		self.__remember_connection(first_id, second_id, connection_id)
+		self.pending_connections.append((first_id, second_id, connection_id, self.file_id))
+
+	def has_connection(self, first_id, second_id):
+		return (min(first_id, second_id), max(first_id, second_id)) in self.pairs
+
+	def lookup(self, name):
+		return [(name, node_id) for node_id in self.names.get(name, [])]
+
+	def list_nodes(self, limit=None, after=None, where=None):
+		rows = [(name, node_id) for node_id, name in self.nodes.items()]
+		if where is not None:
+			regex = like_to_regex(str(where))
+			rows = [row for row in rows if regex.match(row[0])]
+		return _page(rows, 1, limit, after)
+
+	def list_connections(self, limit=None, after=None, where=None):
+		rows = [(cxn[0], cxn[1], connection_id) for connection_id, cxn in self.connections.items()]
+		if where is not None:
+			regex = like_to_regex(str(where))
+			rows = [row for row in rows if regex.match(self.nodes.get(row[0], '')) or regex.match(self.nodes.get(row[1], ''))]
+		return _page(rows, 2, limit, after)
+
+	def pending(self):
+		return len(self.pending_nodes) + len(self.pending_connections)
+
+	def find_conflicts(self, db_nodes, db_connections):
+		'''
+		  ' Compares the file's current database contents against this
+			' session, and reports pending mutations which clash with writes
+			' made by somebody else since the last synchronization.
+			'
+			' Parameters:
+			'   db_nodes = (name, id) rows currently in the database
+			'   db_connections = (first_id, second_id, connection_id) rows
+			'
+			' Returns: (conflicts, foreign_nodes, foreign_connections), where
+			'   conflicts is a list of human-readable descriptions and the
+			'   other two are the rows written by other sessions.
+		'''
+		db_node_ids = set()
+		foreign_nodes = []
+		for node in db_nodes:
+			db_node_ids.add(node[1])
+			if node[1] not in self.nodes:
+				foreign_nodes.append(node)
+
+		foreign_connections = []
+		for cxn in db_connections:
+			if cxn[2] not in self.connections:
+				foreign_connections.append(cxn)
+
+		conflicts = []
+		foreign_names = set(node[0] for node in foreign_nodes)
+		for node in self.pending_nodes:
+			if node[0] in foreign_names:
+				conflicts.append('node "' + str(node[0]) + '" was also added by another session')
+
+		foreign_pairs = set((min(cxn[0], cxn[1]), max(cxn[0], cxn[1])) for cxn in foreign_connections)
+		pending_ids = set(node[1] for node in self.pending_nodes)
+		for cxn in self.pending_connections:
+			if (min(cxn[0], cxn[1]), max(cxn[0], cxn[1])) in foreign_pairs:
+				conflicts.append('connection ' + str(cxn[0]) + ' to ' + str(cxn[1]) + ' was also added by another session')
+			for endpoint in (cxn[0], cxn[1]):
+				if endpoint in self.nodes and endpoint not in pending_ids and endpoint not in db_node_ids:
+					conflicts.append('node ' + str(endpoint) + ' was removed by another session')
+
+		return conflicts, foreign_nodes, foreign_connections
+
+	def flushed(self):
+		'''
+		  ' Marks the mutation log as written to the database.
+		'''
+		self.db_node_count = self.db_node_count + len(self.pending_nodes)
+		self.db_connection_count = self.db_connection_count + len(self.pending_connections)
+		self.pending_nodes = []
+		self.pending_connections = []
+		self.last_flush = time.time()
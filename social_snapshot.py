@@ -0,0 +1,256 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import array
+import mmap
+import shutil
+import struct
+import sys
+import tempfile
+
+'''
+  ' Snapshot file layout
+	'
+	' A snapshot is a columnar, read-only copy of one file's graph. Every
+	' integer is a native-endian int64; the byte order is recorded in the
+	' header and checked on load.
+	'
+	'   header (64 bytes):
+	'     magic            8 bytes, b'PYSOCSNP'
+	'     version          uint32
+	'     byte order       uint32, 1 = little endian, 2 = big endian
+	'     file id          int64
+	'     node count       int64 (n)
+	'     edge count       int64 (m)
+	'     name count       int64 (k), number of distinct interned strings
+	'     blob size        int64, bytes of UTF-8 string data
+	'     file name index  int64, index of the file's name in the name table
+	'
+	'   node_ids           int64[n]
+	'   node_names         int64[n], index into the name table
+	'   name_offsets       int64[k + 1], byte offsets of each name in the blob
+	'   edge_first         int64[m]
+	'   edge_second        int64[m]
+	'   edge_ids           int64[m]
+	'   blob               UTF-8 bytes
+'''
+
+SNAPSHOT_MAGIC = b'PYSOCSNP'
+SNAPSHOT_VERSION = 1
+HEADER_FORMAT = '<8sIIqqqqqq'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ROWS_PER_CHUNK = 65536
+
+
+class snapshot_error(BaseException):
+	'''
+	  ' Raised when a snapshot file is missing, truncated or not a snapshot
+	'''
+
+
+
+def _byte_order_code():
+	if sys.byteorder == 'little':
+		return 1
+	return 2
+
+
+class _column_spool:
+	'''
+	  ' Accumulates one int64 column in a temporary file, so a snapshot of a
+		' huge file never holds more than one chunk of rows in memory.
+	'''
+	def __init__(self):
+		self.file = tempfile.TemporaryFile()
+		self.chunk = array.array('q')
+
+	def append(self, value):
+		self.chunk.append(value)
+		if len(self.chunk) >= ROWS_PER_CHUNK:
+			self.chunk.tofile(self.file)
+			self.chunk = array.array('q')
+
+	def copy_to(self, out_file):
+		self.chunk.tofile(self.file)
+		self.file.seek(0)
+		shutil.copyfileobj(self.file, out_file)
+		self.file.close()
+
+
+
+def write_snapshot(db_io, path):
+	'''
+	  ' Writes the file open in db_io to a snapshot, streaming rows from the
+		' database.
+		'
+		' Parameters:
+		'   db_io = connected database_io object with an open file
+		'   path = where to write the snapshot
+		'
+		' Returns: (node count, edge count)
+	'''
+	names = {}
+	name_list = []
+	def intern(name):
+		if name not in names:
+			names[name] = len(name_list)
+			name_list.append(name)
+		return names[name]
+
+	node_ids = _column_spool()
+	node_names = _column_spool()
+	node_count = 0
+	for node in db_io.iter_nodes():
+		node_ids.append(node[1])
+		node_names.append(intern(node[0]))
+		node_count = node_count + 1
+
+	edge_first = _column_spool()
+	edge_second = _column_spool()
+	edge_ids = _column_spool()
+	edge_count = 0
+	for cxn in db_io.iter_connections():
+		edge_first.append(cxn[0])
+		edge_second.append(cxn[1])
+		edge_ids.append(cxn[2])
+		edge_count = edge_count + 1
+
+	file_name_index = intern(str(db_io.current_file()))
+
+	name_offsets = array.array('q', [0])
+	encoded = []
+	for name in name_list:
+		data = str(name).encode('utf-8')
+		encoded.append(data)
+		name_offsets.append(name_offsets[-1] + len(data))
+
+	with open(path, 'wb') as out_file:
+		out_file.write(struct.pack(HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, _byte_order_code(), db_io.file_id, node_count, edge_count, len(name_list), name_offsets[-1], file_name_index))
+		node_ids.copy_to(out_file)
+		node_names.copy_to(out_file)
+		name_offsets.tofile(out_file)
+		edge_first.copy_to(out_file)
+		edge_second.copy_to(out_file)
+		edge_ids.copy_to(out_file)
+		for data in encoded:
+			out_file.write(data)
+
+	return (node_count, edge_count)
+
+
+
+class graph_snapshot:
+	'''
+	  ' Read-only view of a snapshot file. The file is memory-mapped and the
+		' columns are exposed as int64 memoryviews straight onto the mapping,
+		' so opening even a huge snapshot costs almost nothing: pages are
+		' only read when they are touched. numpy.frombuffer() on the columns
+		' gives zero-copy arrays for analytics code.
+		'
+		'    with graph_snapshot('friends.snap') as snap:
+		'      for i in range(snap.node_count):
+		'        print(snap.node_ids[i], snap.node_name(i))
+	'''
+
+	def __init__(self, path):
+		try:
+			self.file = open(path, 'rb')
+		except FileNotFoundError:
+			raise snapshot_error('Snapshot file ' + str(path) + ' does not exist')
+
+		try:
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			self.file.close()
+			raise snapshot_error('Snapshot file ' + str(path) + ' is empty')
+
+		if len(self.map) < HEADER_SIZE:
+			self.close()
+			raise snapshot_error('Snapshot file ' + str(path) + ' is truncated')
+
+		magic, version, byte_order, self.file_id, self.node_count, self.edge_count, self.name_count, blob_size, file_name_index = struct.unpack_from(HEADER_FORMAT, self.map, 0)
+		if magic != SNAPSHOT_MAGIC:
+			self.close()
+			raise snapshot_error(str(path) + ' is not a pysocial snapshot')
+		if version != SNAPSHOT_VERSION:
+			self.close()
+			raise snapshot_error('Unsupported snapshot version ' + str(version))
+		if byte_order != _byte_order_code():
+			self.close()
+			raise snapshot_error('Snapshot was written on a machine with a different byte order')
+
+		expected = HEADER_SIZE + 8 * (2 * self.node_count + self.name_count + 1 + 3 * self.edge_count) + blob_size
+		if len(self.map) != expected:
+			self.close()
+			raise snapshot_error('Snapshot file ' + str(path) + ' is truncated or corrupt')
+
+		self.views = []
+		offset = HEADER_SIZE
+		self.node_ids, offset = self.__column(offset, self.node_count)
+		self.node_names, offset = self.__column(offset, self.node_count)
+		self.name_offsets, offset = self.__column(offset, self.name_count + 1)
+		self.edge_first, offset = self.__column(offset, self.edge_count)
+		self.edge_second, offset = self.__column(offset, self.edge_count)
+		self.edge_ids, offset = self.__column(offset, self.edge_count)
+		self.blob = memoryview(self.map)[offset:offset + blob_size]
+		self.views.append(self.blob)
+		self.file_name = self.name(file_name_index)
+
+	def __column(self, offset, count):
+		view = memoryview(self.map)[offset:offset + 8 * count].cast('q')
+		self.views.append(view)
+		return view, offset + 8 * count
+
+	def name(self, name_index):
+		return str(self.blob[self.name_offsets[name_index]:self.name_offsets[name_index + 1]], 'utf-8')
+
+	def node_name(self, node_index):
+		return self.name(self.node_names[node_index])
+
+	def nodes(self):
+		'''
+		  ' Yields (name, id) rows, like database_io.list_nodes()
+		'''
+		for i in range(self.node_count):
+			yield (self.node_name(i), self.node_ids[i])
+
+	def connections(self):
+		'''
+		  ' Yields (first_id, second_id, connection_id) rows, like
+			' database_io.list_connections()
+		'''
+		for i in range(self.edge_count):
+			yield (self.edge_first[i], self.edge_second[i], self.edge_ids[i])
+
+	def close(self):
+		for view in getattr(self, 'views', []):
+			view.release()
+		self.views = []
+		if getattr(self, 'map', None):
+			self.map.close()
+			self.map = None
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, xtype, xvalue, xtraceback):
+		self.close()
@@ -0,0 +1,79 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import sqlite3
+
+from social_db import db_backend, database_cursor
+
+
+class sqlite_connect(db_backend):
+	'''
+	  ' Embedded SQLite backend, for single-user local work without a
+		' database server. Selected with "db_backend":"sqlite" in the config;
+		' the database lives in the file named by "db_path".
+		'
+		' The database runs in WAL mode, so readers never block the writer
+		' and a commit only needs to append to the log.
+	'''
+	database_error = sqlite3.Error
+	integrity_error = sqlite3.IntegrityError
+
+	def connect(self, cfg):
+		db_path = cfg.get('db_path', 'social.db')
+		self.ui.log('Opening SQLite database ' + str(db_path))
+
+		db = sqlite3.connect(db_path, cached_statements=256)
+		db.execute('PRAGMA journal_mode=WAL;')
+		db.execute('PRAGMA synchronous=NORMAL;')
+		return db
+
+	def list_tables(self):
+		with database_cursor(self.db) as cur:
+			cur.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+			return [result[0] for result in cur.fetchall()]
+
+	def list_columns(self, tname):
+		with database_cursor(self.db) as cur:
+			# table_info leaves out generated columns
+			cur.execute('SELECT name, type FROM pragma_table_xinfo(?);', (tname,))
+			return cur.fetchall()
+
+	def column_sql(self, column):
+		if 'generated' not in column:
+			return db_backend.column_sql(self, column)
+		# ALTER TABLE can only add VIRTUAL generated columns; an index on
+		# the column stores its values anyway
+		return column['name'] + ' ' + column['type'] + ' GENERATED ALWAYS AS (' + column['generated'] + ') VIRTUAL'
+
+	def build_statement(self, template, *tables):
+		return template.format(*['"' + self.tablify(table) + '"' for table in tables]).replace('%s', '?')
+
+	def sql_text(self, query):
+		return str(query)
+
+	def lock(self, cur, kind, *key):
+		# SQLite has one writer at a time, so the closest thing to a named
+		# lock is taking the write lock now, before anything is read
+		if not self.db.in_transaction:
+			cur.execute('BEGIN IMMEDIATE;')
+
+	def random_id_sql(self):
+		return '(random() % 9223372036854775807)'
@@ -0,0 +1,188 @@
+'''
+
+Copyright 2018 Alexander Shuping
+
+This file is part of Pysocial.
+
+Pysocial is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Pysocial is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import json
+import math
+import time
+
+
+class latency_histogram:
+	'''
+	  ' Log-scale latency histogram. Each power of two (in microseconds)
+		' is split into BUCKETS_PER_DOUBLING buckets, so percentiles are
+		' accurate to within ~20% no matter how wide the latency range is,
+		' while the memory used stays tiny.
+	'''
+	BUCKETS_PER_DOUBLING = 4
+
+	def __init__(self):
+		self.buckets = {}
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+
+	def record(self, seconds):
+		micros = max(seconds * 1000000.0, 1.0)
+		bucket = int(math.log2(micros) * self.BUCKETS_PER_DOUBLING)
+		self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+		self.count = self.count + 1
+		self.total = self.total + seconds
+		if self.min is None or seconds < self.min:
+			self.min = seconds
+		if self.max is None or seconds > self.max:
+			self.max = seconds
+
+	def percentile(self, pct):
+		'''
+		  ' Returns the (approximate) latency in seconds below which pct
+			' percent of the recorded samples fall, or None if there are no
+			' samples.
+		'''
+		if self.count == 0:
+			return None
+
+		threshold = self.count * pct / 100.0
+		seen = 0
+		for bucket in sorted(self.buckets.keys()):
+			seen = seen + self.buckets[bucket]
+			if seen >= threshold:
+				upper = (2 ** ((bucket + 1) / self.BUCKETS_PER_DOUBLING)) / 1000000.0
+				return min(upper, self.max)
+		return self.max
+
+	def to_dict(self):
+		return {
+			'count':self.count,
+			'total':self.total,
+			'min':self.min,
+			'max':self.max,
+			'p50':self.percentile(50),
+			'p90':self.percentile(90),
+			'p99':self.percentile(99)
+		}
+
+
+
+class query_stats:
+	'''
+	  ' Collects per-statement and per-operation timing information.
+		'
+		' Queries are keyed by their SQL template (the statement text before
+		' parameters are bound), so the same lookup issued a thousand times
+		' shows up as one line with a call count of 1000 - which is exactly
+		' what an N+1 pattern looks like.
+		'
+		' Other operations (commits, graphviz layout, ...) are recorded by
+		' name with record_timing().
+	'''
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.started = time.time()
+		self.queries = {}
+		self.timings = {}
+
+	def __query_entry(self, template):
+		if template not in self.queries:
+			self.queries[template] = {'rows':0, 'latency':latency_histogram()}
+		return self.queries[template]
+
+	def record_query(self, template, seconds):
+		self.__query_entry(template)['latency'].record(seconds)
+
+	def record_rows(self, template, rows):
+		self.__query_entry(template)['rows'] += rows
+
+	def record_timing(self, name, seconds):
+		if name not in self.timings:
+			self.timings[name] = latency_histogram()
+		self.timings[name].record(seconds)
+
+	def to_dict(self):
+		queries = []
+		for template, entry in self.queries.items():
+			query = entry['latency'].to_dict()
+			query['sql'] = template
+			query['rows'] = entry['rows']
+			queries.append(query)
+		queries.sort(key=lambda q: q['total'], reverse=True)
+
+		timings = {}
+		for name, hist in self.timings.items():
+			timings[name] = hist.to_dict()
+
+		return {
+			'started':self.started,
+			'elapsed':time.time() - self.started,
+			'queries':queries,
+			'timings':timings
+		}
+
+	def export_json(self, path):
+		'''
+		  ' Writes the collected statistics to a JSON file.
+			'
+			' Returns:
+			'   0 = success
+			'   3 = permission error
+		'''
+		try:
+			with open(path, 'w') as out_file:
+				json.dump(self.to_dict(), out_file, indent=2)
+		except PermissionError:
+			return 3
+		return 0
+
+	def report(self, limit=20):
+		'''
+		  ' Returns a list of human-readable lines describing the statistics,
+			' with the most expensive statements first.
+		'''
+		data = self.to_dict()
+		lines = []
+		lines.append('Statistics for the last ' + _fmt_time(data['elapsed']) + ':')
+		lines.append('  {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format('calls', 'rows', 'total', 'p50', 'p90', 'p99', 'statement'))
+		for query in data['queries'][:limit]:
+			template = ' '.join(query['sql'].split())
+			if len(template) > 60:
+				template = template[:57] + '...'
+			lines.append('  {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(query['count'], query['rows'], _fmt_time(query['total']), _fmt_time(query['p50']), _fmt_time(query['p90']), _fmt_time(query['p99']), template))
+		if len(data['queries']) > limit:
+			lines.append('  (' + str(len(data['queries']) - limit) + ' more statements omitted)')
+
+		for name in sorted(data['timings'].keys()):
+			timing = data['timings'][name]
+			lines.append('  {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}  [{}]'.format(timing['count'], '', _fmt_time(timing['total']), _fmt_time(timing['p50']), _fmt_time(timing['p90']), _fmt_time(timing['p99']), name))
+
+		return lines
+
+
+
+def _fmt_time(seconds):
+	if seconds is None:
+		return '-'
+	if seconds < 0.001:
+		return '{:.0f}us'.format(seconds * 1000000.0)
+	if seconds < 1.0:
+		return '{:.1f}ms'.format(seconds * 1000.0)
+	return '{:.2f}s'.format(seconds)
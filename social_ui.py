@@ -20,6 +20,7 @@ along with Pysocial.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import json
+import sys
 
 
 class polymorphism_error(BaseException):
@@ -28,6 +29,59 @@ class polymorphism_error(BaseException):
 	'''
 
 
+def parse_yn(resp, default_resp=False):
+	'''
+	  ' Interprets the answer to a yes/no prompt
+	'''
+	acceptable_ys = ['y','yes','t','true' ,'1']
+	acceptable_ns = ['n','no' ,'f','false','0']
+
+	if resp.lower() in acceptable_ys:
+		return True
+	elif resp.lower() in acceptable_ns:
+		return False
+	else:
+		return default_resp
+
+
+class buffered_writer:
+	'''
+	  ' Collects lines of output and writes them to a stream in large
+		' chunks, instead of making one write (and, on a terminal, one
+		' syscall) per line. Use it as a context manager so the last chunk
+		' is written out:
+		'
+		'    with buffered_writer(sys.stdout) as out:
+		'      for row in rows:
+		'        out.write(format(row))
+	'''
+	def __init__(self, stream, chunk_size=65536):
+		self.stream = stream
+		self.chunk_size = chunk_size
+		self.parts = []
+		self.size = 0
+
+	def write(self, message):
+		message = str(message) + '\n'
+		self.parts.append(message)
+		self.size = self.size + len(message)
+		if self.size >= self.chunk_size:
+			self.flush()
+
+	def flush(self):
+		if self.parts:
+			self.stream.write(''.join(self.parts))
+			self.parts = []
+			self.size = 0
+		self.stream.flush()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, xtype, xvalue, xtraceback):
+		self.flush()
+
+
 class ui:
 	'''
 	  ' Base class for polymorphism. DO NOT initialize it - if you need a
@@ -133,7 +187,23 @@ class basic_console_ui(ui):
 			'listfiles':self.cmd_list_files,
 			'lf':self.cmd_list_files,
 			'render':self.cmd_render,
-			'r':self.cmd_render
+			'r':self.cmd_render,
+			'stats':self.cmd_stats,
+			'profile':self.cmd_profile,
+			'save':self.cmd_save,
+			's':self.cmd_save,
+			'session':self.cmd_session,
+			'snapshot':self.cmd_snapshot,
+			'export':self.cmd_export,
+			'clone':self.cmd_clone,
+			'delete':self.cmd_delete,
+			'dedupe':self.cmd_dedupe,
+			'diff':self.cmd_diff,
+			'info':self.cmd_info,
+			'top':self.cmd_top,
+			'analyze':self.cmd_analyze,
+			'recompute':self.cmd_recompute,
+			'watch':self.cmd_watch
 			# TODO: add new commands here. The command name goes before the :,
 			# and the name of the function to call goes after it.
 		}
@@ -238,6 +308,9 @@ class basic_console_ui(ui):
 	
 
 	def cmd_exit(self, args):
+		if self.db.end() != 0:
+			self.log_error('Could not save pending changes. Use `save` to retry, or `session -discard` to drop them before exiting.')
+			return
 		self.write('Goodbye.\n\n')
 		self.keep_going = False
 	
@@ -314,26 +387,72 @@ class basic_console_ui(ui):
 			self.cmd_help(['connect'])
 	
 
+	def parse_list_options(self, args):
+		'''
+		  ' Parses the [-limit N] [-after ID] [-where PATTERN] options shared
+			' by the listing commands.
+			'
+			' Returns: a dict with keys limit, after and where (None when
+			'   absent), or None if the options are malformed.
+		'''
+		options = {'limit':None, 'after':None, 'where':None}
+		i = 0
+		while i < len(args):
+			option = args[i].lstrip('-')
+			if not args[i].startswith('-') or option not in options or i + 1 >= len(args):
+				return None
+			if option == 'where':
+				options[option] = args[i + 1]
+			else:
+				try:
+					options[option] = int(args[i + 1])
+				except ValueError:
+					return None
+			i = i + 2
+		return options
+
+
+	def list_paging_hint(self, command, options, rows, last_id):
+		if options['limit'] is not None and len(rows) == options['limit']:
+			hint = command + ' -limit ' + str(options['limit']) + ' -after ' + str(last_id)
+			if options['where'] is not None:
+				hint = hint + ' -where ' + options['where']
+			self.write('More results may be available: `' + hint + '`')
+
+
 	def cmd_list_nodes(self, args):
-		nodes = self.db.list_nodes()
+		options = self.parse_list_options(args)
+		if options is None:
+			self.cmd_help(['listnodes'])
+			return
+
+		nodes = self.db.list_nodes(options['limit'], options['after'], options['where'])
 		if self.db.current_file():
 			self.write('Listing nodes in current file...')
 		else:
 			self.write('Listing all nodes in all files...')
 
-		for node in nodes:
-			self.write('  "' + str(node[0]) + '" with id ' + str(node[1]) + ' (discrim ' + str(abs(node[1]) % 100000) + ')')
+		from social import discriminator
+		self.write_lines('  "' + str(node[0]) + '" with id ' + str(node[1]) + ' (discrim ' + str(discriminator(node[1])) + ')' for node in nodes)
+		if nodes:
+			self.list_paging_hint('listnodes', options, nodes, nodes[-1][1])
 	
 	
 	def cmd_list_connections(self, args):
-		cxns = self.db.list_connections()
+		options = self.parse_list_options(args)
+		if options is None:
+			self.cmd_help(['listconnections'])
+			return
+
+		cxns = self.db.list_connections(options['limit'], options['after'], options['where'])
 		if self.db.current_file():
 			self.write('Listing connections in current file...')
 		else:
 			self.write('Listing all connections in all files...')
 
-		for cxn in cxns:
-			self.write('  ' + str(cxn[0]) + ' to ' + str(cxn[1]) + ' with id ' + str(cxn[2]))
+		self.write_lines('  ' + str(cxn[0]) + ' to ' + str(cxn[1]) + ' with id ' + str(cxn[2]) for cxn in cxns)
+		if cxns:
+			self.list_paging_hint('listconnections', options, cxns, cxns[-1][2])
 	
 
 	def cmd_list_files(self, args):
@@ -345,15 +464,32 @@ class basic_console_ui(ui):
 	
 	def cmd_render(self, args):
 		output_path = 'render_output.png'
-		if len(args) == 0:
-			pass
-		elif len(args) == 1:
-			output_path = str(args[0])
-		else:
+		options = {'snapshot':None, 'budget':None, 'expand':None, 'prog':None, 'size':None, 'color':None}
+		positional = []
+		i = 0
+		while i < len(args):
+			if args[i].startswith('-') and args[i][1:] in options and i + 1 < len(args):
+				options[args[i][1:]] = args[i + 1]
+				i = i + 2
+			else:
+				positional.append(args[i])
+				i = i + 1
+
+		if len(positional) == 1:
+			output_path = str(positional[0])
+		elif len(positional) > 1:
 			self.cmd_help(['render'])
+			return
+		budget = None
+		if options['budget'] is not None:
+			try:
+				budget = int(options['budget'])
+			except ValueError:
+				self.cmd_help(['render'])
+				return
 		
 		self.write('Rendering graph to ' + str(output_path))
-		ret = self.rend.render(output_path)
+		ret = self.rend.render(output_path, options['prog'], snapshot_path=options['snapshot'], budget=budget, expand=options['expand'], size_metric=options['size'], color_metric=options['color'])
 
 		if ret == 0:
 			self.write('Success.')
@@ -361,10 +497,405 @@ class basic_console_ui(ui):
 			self.log_severe('DATABASE ERROR WHILE RENDERING.')
 		elif ret == 2:
 			self.log_error('No file open in database.')
+		elif ret == 3:
+			self.log_error('Could not load snapshot ' + str(options['snapshot']))
+		elif ret == 4:
+			self.log_error('No node named ' + str(options['expand']) + ' to expand.')
+		elif ret == 5:
+			self.log_error('Unknown metric; see `help analyze`.')
 		else:
 			self.log_error('Unknown error while rendering.')
 	
 
+	def cmd_watch(self, args):
+		options = {'prog':None, 'debounce':None}
+		positional = []
+		i = 0
+		while i < len(args):
+			if args[i].startswith('-') and args[i][1:] in options and i + 1 < len(args):
+				options[args[i][1:]] = args[i + 1]
+				i = i + 2
+			else:
+				positional.append(args[i])
+				i = i + 1
+
+		if len(positional) != 1:
+			self.cmd_help(['watch'])
+			return
+		debounce = None
+		if options['debounce'] is not None:
+			try:
+				debounce = float(options['debounce'])
+			except ValueError:
+				self.cmd_help(['watch'])
+				return
+
+		self.write('Rendering ' + str(positional[0]) + ' whenever the file changes. Press Ctrl-C to stop.')
+		ret = self.rend.watch(positional[0], options['prog'], debounce=debounce)
+		if ret == 0:
+			self.write('Stopped watching.')
+		elif ret == 1:
+			self.log_severe('DATABASE ERROR WHILE RENDERING.')
+		elif ret == 2:
+			self.log_error('No file open in database.')
+		elif ret == 4:
+			self.write('The file was deleted.')
+		else:
+			self.log_error('Unknown error while rendering.')
+
+
+	def cmd_snapshot(self, args):
+		if len(args) != 1:
+			self.cmd_help(['snapshot'])
+			return
+
+		ret = self.db.snapshot(args[0])
+		if ret == 0:
+			self.write('Snapshot written to ' + str(args[0]))
+		elif ret == 1:
+			self.log_error('No file open in database.')
+		else:
+			self.log_error('Could not write snapshot to ' + str(args[0]))
+	
+
+	def cmd_export(self, args):
+		compress = None
+		if '-gzip' in args:
+			compress = True
+			args = [arg for arg in args if arg != '-gzip']
+		if len(args) != 2:
+			self.cmd_help(['export'])
+			return
+
+		ret = self.db.export(args[0], args[1], compress)
+		if ret == 0:
+			self.write('Exported to ' + str(args[1]))
+		elif ret == 1:
+			self.log_error('No file open in database.')
+		elif ret == 2:
+			self.log_error('Could not export; see `help export` for the supported formats.')
+		else:
+			self.log_error('Could not write export to ' + str(args[1]))
+
+
+	def cmd_clone(self, args):
+		if len(args) != 2:
+			self.cmd_help(['clone'])
+			return
+
+		ret = self.db.clone_file(args[0], args[1])
+		if ret == 0:
+			self.write('Cloned "' + str(args[0]) + '" to "' + str(args[1]) + '".')
+		elif ret == 1:
+			self.log_error('Could not find a single file named "' + str(args[0]) + '".')
+		elif ret == 2:
+			self.log_error('A file named "' + str(args[1]) + '" already exists.')
+		else:
+			self.log_error('Database error while cloning.')
+
+
+	def cmd_delete(self, args):
+		if len(args) != 1:
+			self.cmd_help(['delete'])
+			return
+
+		if not self.prompt_yn('Really delete "' + str(args[0]) + '" and everything in it?'):
+			self.write('Not deleted.')
+			return
+
+		ret = self.db.delete_file(args[0])
+		if ret == 0:
+			self.write('Deleted "' + str(args[0]) + '".')
+		elif ret == 1:
+			self.log_error('Could not find a single file named "' + str(args[0]) + '".')
+		else:
+			self.log_error('Database error while deleting.')
+
+
+	def cmd_dedupe(self, args):
+		if len(args) > 1 or (len(args) == 1 and args[0] != '-dry'):
+			self.cmd_help(['dedupe'])
+			return
+		if not self.db.current_file():
+			self.log_warning('Cannot look for duplicates with no open file.')
+			return
+
+		groups = self.db.find_duplicates()
+		if not groups:
+			self.write('No duplicate node names in this file.')
+			return
+
+		extra = sum(group[1] - 1 for group in groups)
+		self.write(str(len(groups)) + ' name(s) are shared by more than one node; ' + str(extra) + ' node(s) would be merged:')
+		from social import discriminator
+		self.write_lines('  "' + str(group[0]) + '": ' + str(group[1]) + ' nodes, keeping id ' + str(group[2]) + ' (discrim ' + str(discriminator(group[2])) + ')' for group in groups)
+		if len(args) == 1:
+			return
+
+		if not self.prompt_yn('Merge these nodes? Their connections will be moved to the kept node.'):
+			self.write('Nothing merged.')
+			return
+
+		report = self.db.merge_duplicates()
+		if report is None:
+			self.log_error('Could not merge duplicates; nothing was changed.')
+			return
+		self.write('Merged ' + str(report['merged']) + ' node(s), moved ' + str(report['rewritten']) + ' connection end(s), and removed ' + str(report['self_loops']) + ' self-connection(s) and ' + str(report['duplicate_connections']) + ' duplicate connection(s).')
+
+
+	def cmd_diff(self, args):
+		if len(args) == 4 and args[2] == '-o':
+			report = self.db.diff_to_file(args[0], args[1], args[3])
+			if report is None:
+				self.log_error('Could not write the differences; nothing was changed.')
+				return
+			self.write('Wrote the differences to "' + str(args[3]) + '": ' + str(report['added_nodes']) + ' node(s) and ' + str(report['added_edges']) + ' connection(s) added (green), ' + str(report['removed_nodes']) + ' node(s) and ' + str(report['removed_edges']) + ' connection(s) removed (red).')
+			return
+		if len(args) != 2:
+			self.cmd_help(['diff'])
+			return
+
+		rows = self.db.iter_diff(args[0], args[1])
+		if rows is None:
+			self.log_error('Could not find a single file named "' + str(args[0]) + '" and one named "' + str(args[1]) + '".')
+			return
+		counts = {'+':0, '-':0}
+		def lines():
+			for row in rows:
+				counts[row[1]] += 1
+				if row[0] == 'node':
+					yield row[1] + ' node "' + str(row[2]) + '"'
+				else:
+					yield row[1] + ' connection "' + str(row[2]) + '" -- "' + str(row[3]) + '"'
+		self.write_lines(lines())
+		self.write(str(counts['+']) + ' addition(s), ' + str(counts['-']) + ' removal(s).')
+
+
+	def cmd_info(self, args):
+		if len(args) > 1 or (len(args) == 1 and args[0] != '-d'):
+			self.cmd_help(['info'])
+			return
+		info = self.db.file_info()
+		if info is None:
+			self.log_warning('Cannot show file information with no open file.')
+			return
+
+		self.write('"' + str(self.db.current_file()) + '": ' + str(info['nodes']) + ' node(s), ' + str(info['connections']) + ' connection(s), changed ' + str(info['changes']) + ' time(s).')
+		if info['nodes']:
+			self.write('Average degree ' + '{:.2f}'.format(2.0 * info['connections'] / info['nodes']) + ', maximum degree ' + str(info['max_degree']) + '.')
+		pending = self.db.pending_changes()
+		if pending:
+			self.write('(' + str(pending) + ' unsaved change(s) are not included.)')
+		if len(args) == 1:
+			self.write('Degree distribution:')
+			self.write_lines('  {:>6}: {}'.format(row[0], row[1]) for row in self.db.degree_distribution())
+
+
+	def cmd_top(self, args):
+		metric = None
+		if len(args) >= 2 and args[-2] == '-by':
+			metric = args[-1]
+			args = args[:-2]
+		from social import METRIC_COLUMNS, discriminator
+		if len(args) > 1 or (len(args) == 1 and not args[0].isdigit()) or (metric is not None and metric not in METRIC_COLUMNS):
+			self.cmd_help(['top'])
+			return
+		k = 10
+		if args:
+			k = int(args[0])
+
+		if metric is not None:
+			rows = self.db.top_by_metric(metric, k)
+		else:
+			rows = self.db.top_nodes(k)
+		if rows is None:
+			self.log_warning('Cannot list nodes with no open file.')
+			return
+		if metric is not None:
+			if not rows:
+				self.write('No ' + metric + ' values for this file yet; run `analyze` first.')
+				return
+			self.write_lines('  "' + str(row[0]) + '" (discrim ' + str(discriminator(row[1])) + '): ' + metric + ' ' + '{:.6g}'.format(row[2]) for row in rows)
+			return
+		if not rows:
+			self.write('No connected nodes in this file.')
+			return
+		self.write_lines('  "' + str(row[0]) + '" (discrim ' + str(discriminator(row[1])) + '): ' + str(row[2]) + ' connection(s)' for row in rows)
+
+
+	def cmd_analyze(self, args):
+		from social import METRIC_COLUMNS
+		options = {'samples':None, 'seed':'0'}
+		metrics = []
+		i = 0
+		while i < len(args):
+			if args[i].startswith('-') and args[i][1:] in options and i + 1 < len(args):
+				options[args[i][1:]] = args[i + 1]
+				i = i + 2
+			elif args[i] in METRIC_COLUMNS:
+				metrics.append(args[i])
+				i = i + 1
+			else:
+				self.cmd_help(['analyze'])
+				return
+		try:
+			samples = int(options['samples']) if options['samples'] is not None else None
+			seed = int(options['seed'])
+		except ValueError:
+			self.cmd_help(['analyze'])
+			return
+
+		report = self.db.analyze(metrics or None, samples, seed)
+		if report is None:
+			self.log_error('Could not analyze the open file.')
+			return
+		self.write('Analyzed ' + str(report['nodes']) + ' node(s) and ' + str(report['connections']) + ' connection(s); stored ' + ', '.join(report['metrics']) + '.')
+		self.write('See `top -by <metric>` for the highest values, and `render -size <metric> -color <metric>` to draw them.')
+
+
+	def cmd_recompute(self, args):
+		if len(args) > 1 or (len(args) == 1 and args[0] != '-all'):
+			self.cmd_help(['recompute'])
+			return
+		ret = self.db.recompute_stats(all_files=bool(args))
+		if ret == 0:
+			self.write('Statistics recomputed.')
+		elif ret == 1:
+			self.log_warning('No file is open; use `recompute -all` to recompute every file.')
+		else:
+			self.log_error('Database error while recomputing statistics.')
+
+
+	def cmd_save(self, args):
+		pending = self.db.pending_changes()
+		ret = self.db.flush()
+		if ret == 0:
+			self.write('Saved ' + str(pending) + ' pending change(s).')
+		elif ret == 2:
+			self.log_error('Another session changed this file in a conflicting way. Nothing was saved; use `session -discard` to reload the file.')
+		else:
+			self.log_error('Unknown error while saving.')
+
+
+	def cmd_session(self, args):
+		if len(args) == 0:
+			if self.db.write_behind:
+				self.write('Write-behind mode is on, with ' + str(self.db.pending_changes()) + ' unsaved change(s).')
+			else:
+				self.write('Write-behind mode is off.')
+		elif len(args) == 1 and args[0] == '-on':
+			self.db.set_write_behind(True)
+			self.write('Write-behind mode enabled. Use `save` to write changes to the database.')
+		elif len(args) == 1 and args[0] == '-off':
+			if self.db.set_write_behind(False) == 0:
+				self.write('Write-behind mode disabled.')
+			else:
+				self.log_error('Could not save pending changes; write-behind mode is still on.')
+		elif len(args) == 1 and args[0] == '-discard':
+			self.db.discard_pending()
+			self.write('Unsaved changes discarded.')
+		else:
+			self.cmd_help(['session'])
+
+
+	def cmd_stats(self, args):
+		if len(args) == 0:
+			stats = self.db.stats()
+			if not stats:
+				self.write('Instrumentation is off. Use `stats -on` to enable it.')
+				return
+			for line in stats.report():
+				self.write(line)
+		elif len(args) == 1 and args[0] == '-on':
+			self.db.database.enable_stats()
+			self.write('Instrumentation enabled.')
+		elif len(args) == 1 and args[0] == '-off':
+			self.db.database.disable_stats()
+			self.write('Instrumentation disabled.')
+		elif len(args) == 1 and args[0] == '-reset':
+			stats = self.db.stats()
+			if stats:
+				stats.reset()
+			self.write('Statistics cleared.')
+		elif len(args) == 2 and args[0] == '-json':
+			stats = self.db.stats()
+			if not stats:
+				self.write('Instrumentation is off. Use `stats -on` to enable it.')
+			elif stats.export_json(args[1]) == 0:
+				self.write('Statistics written to ' + str(args[1]))
+			else:
+				self.log_error('Could not write statistics to ' + str(args[1]))
+		else:
+			self.cmd_help(['stats'])
+	
+
+	def cmd_profile(self, args):
+		if len(args) == 0:
+			self.cmd_help(['profile'])
+			return
+		if args[0] == '-samples' and len(args) <= 2:
+			if not self.db.sampler:
+				self.write('Sampling is off. Use `profile -sampling on` to enable it.')
+				return
+			self.write_lines(self.db.sampler.report())
+			if len(args) == 2:
+				if self.db.sampler.write_collapsed(args[1]) == 0:
+					self.write('Collapsed stacks written to ' + str(args[1]))
+				else:
+					self.log_error('Could not write samples to ' + str(args[1]))
+			return
+		if args[0] == '-reset' and len(args) == 1:
+			if self.db.sampler:
+				self.db.sampler.reset()
+			self.write('Samples cleared.')
+			return
+		if args[0] == '-sampling' and len(args) == 2 and args[1] in ('on', 'off'):
+			if args[1] == 'on':
+				self.db.enable_sampling()
+				self.write('Sampling enabled.')
+			else:
+				self.db.disable_sampling()
+				self.write('Sampling disabled.')
+			return
+
+		from social_profile import command_profile
+		memory = False
+		limit = 20
+		output_path = 'profile.pstats'
+		i = 0
+		while i < len(args) and args[i].startswith('-'):
+			if args[i] == '-mem':
+				memory = True
+				i = i + 1
+			elif args[i] == '-top' and i + 1 < len(args) and args[i + 1].isdigit():
+				limit = int(args[i + 1])
+				i = i + 2
+			elif args[i] == '-o' and i + 1 < len(args):
+				output_path = args[i + 1]
+				i = i + 2
+			else:
+				self.cmd_help(['profile'])
+				return
+		if i >= len(args):
+			self.cmd_help(['profile'])
+			return
+		core = args[i]
+		if core not in self.command_lut.keys():
+			self.unknown_command(core)
+			return
+		if self.command_lut[core] == self.cmd_profile:
+			self.log_warning('Cannot profile `profile` itself.')
+			return
+
+		profile = command_profile(memory)
+		profile.run(self.command_lut[core], args[i + 1:])
+		self.write_lines(profile.report(limit))
+		if profile.dump(output_path) == 0:
+			self.write('Profile written to ' + str(output_path) + ' (see `python -m pstats ' + str(output_path) + '`)')
+		else:
+			self.log_error('Could not write the profile to ' + str(output_path))
+
+
 	def unknown_command(self, command_text):
 		self.log_warning('Unknown command: "' + str(command_text) + '"!')
 	
@@ -372,6 +903,11 @@ class basic_console_ui(ui):
 	def write(self, message):
 		print(str(message))
 
+	def write_lines(self, messages):
+		with buffered_writer(sys.stdout) as out:
+			for message in messages:
+				out.write(message)
+
 	def log(self, message, level=5):
 		print('[' + str(level) + ']: ' + str(message))
 	
@@ -388,13 +924,4 @@ class basic_console_ui(ui):
 		self.log(message, level=1)
 	
 	def prompt_yn(self, prompt_text, default_resp=False):
-		acceptable_ys = ['y','yes','t','true' ,'1']
-		acceptable_ns = ['n','no' ,'f','false','0']
-		resp = input(str(prompt_text) + ' [Y/N] >')
-
-		if resp.lower() in acceptable_ys:
-			return True
-		elif resp.lower() in acceptable_ns:
-			return False
-		else:
-			return default_resp
+		return parse_yn(input(str(prompt_text) + ' [Y/N] >'), default_resp)